@@ -0,0 +1,139 @@
+"""Benchmark of the aggregation engines (const.AGGREGATION_ENGINES) with per-statement timings.
+
+Synthetic, matched and classified areas of interest of increasing size (`benchmarks/synthetic_aoi.sql`)
+are created in the configured database (see bench_utils.get_database). Every engine aggregates each of them;
+the duration of every single SQL statement is reported, as well as whether the engines' group predictions agree.
+Engine "local" is the in-process aggregation of the local processing engine (modules.LocalEngine), timed as
+a whole including reading its inputs from and writing its predictions to the database.
+
+Usage:
+    python benchmarks/bench_aggregation.py --ways 100 1000 10000 --imgs_per_segment 3
+"""
+
+import argparse
+import os
+import time
+from pathlib import Path
+
+from bench_utils import get_database, sql_statements, timed_statements
+
+import constants as const
+from modules.AreaOfInterest import AreaOfInterest
+
+BENCH_NAME = "bench_aggregation"
+SYNTHETIC_AOI = Path(os.path.abspath(__file__)).parent / "synthetic_aoi.sql"
+
+# columns of the group predictions compared between engines
+PARITY_QUERY = """
+SELECT count(*) FROM (
+    (SELECT id, part_id, group_num, type_pred, round(quali_pred::numeric, 6), round(conf_score::numeric, 6), n_imgs
+     FROM {a} EXCEPT ALL
+     SELECT id, part_id, group_num, type_pred, round(quali_pred::numeric, 6), round(conf_score::numeric, 6), n_imgs
+     FROM {b})
+    UNION ALL
+    (SELECT id, part_id, group_num, type_pred, round(quali_pred::numeric, 6), round(conf_score::numeric, 6), n_imgs
+     FROM {b} EXCEPT ALL
+     SELECT id, part_id, group_num, type_pred, round(quali_pred::numeric, 6), round(conf_score::numeric, 6), n_imgs
+     FROM {a})
+) AS diff;
+"""
+
+
+def query_params(n_ways, imgs_per_segment):
+    return {
+        "name": BENCH_NAME,
+        "crs": 3035,
+        "n_ways": n_ways,
+        "imgs_per_segment": imgs_per_segment,
+        "seed": 0.42,
+        "additional_id_column": "",
+        "additional_ways_id_column": "",
+        "grouping_ids": "id,part_id,group_num",
+        "group_num": "0",
+    }
+
+
+def run_engine(db, engine, params):
+    timings = []
+    if engine == "local":
+        aoi = AreaOfInterest(
+            {"name": BENCH_NAME, "proj_crs": params["crs"], "processing_engine": "local"}
+        )
+        start = time.perf_counter()
+        aoi.aggregate_on_roads(db)
+        timings.append(
+            ("local", "LocalEngine.aggregate_on_roads", time.perf_counter() - start)
+        )
+    else:
+        for alg in [1, 2, 3]:
+            path = str(const.AGGREGATION_ENGINES[engine]).format(alg)
+            for statement, duration in timed_statements(
+                db, sql_statements(path, params)
+            ):
+                timings.append((f"alg{alg}", statement, duration))
+    db.execute_sql_query(
+        f"""DROP TABLE IF EXISTS {BENCH_NAME}_predictions_{engine};
+        ALTER TABLE {BENCH_NAME}_group_predictions RENAME TO {BENCH_NAME}_predictions_{engine};""",
+        is_file=False,
+    )
+    return timings
+
+
+def print_timings(engine, timings, top):
+    total = sum(duration for _, _, duration in timings)
+    print(f"  {engine}: {total:.3f} s in {len(timings)} statements, slowest:")
+    for alg, statement, duration in sorted(timings, key=lambda t: -t[2])[:top]:
+        summary = " ".join(statement.split())[:90]
+        print(f"    {duration:>9.3f} s  {alg}  {summary}")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench_aggregation")
+    parser.add_argument("--ways", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--imgs_per_segment", type=int, default=3)
+    parser.add_argument(
+        "--engines", nargs="+", default=list(const.AGGREGATION_ENGINES) + ["local"]
+    )
+    parser.add_argument(
+        "--top", type=int, default=5, help="number of slowest statements to list"
+    )
+    args = parser.parse_args()
+
+    db = get_database()
+    try:
+        for n_ways in args.ways:
+            params = query_params(n_ways, args.imgs_per_segment)
+            db.execute_sql_query(SYNTHETIC_AOI, params)
+            n_imgs = db.execute_sql_query(
+                f"SELECT count(*) FROM {BENCH_NAME}_img_metadata;",
+                is_file=False,
+                get_response=True,
+            )[0][0]
+            print(f"{n_ways} ways, {n_ways * 10} subsegments, {n_imgs} images")
+
+            totals = {}
+            for engine in args.engines:
+                timings = run_engine(db, engine, params)
+                totals[engine] = print_timings(engine, timings, args.top)
+            for engine in args.engines[1:]:
+                n_diff = db.execute_sql_query(
+                    PARITY_QUERY.format(
+                        a=f"{BENCH_NAME}_predictions_{args.engines[0]}",
+                        b=f"{BENCH_NAME}_predictions_{engine}",
+                    ),
+                    is_file=False,
+                    get_response=True,
+                )[0][0]
+                print(
+                    f"  {engine} vs {args.engines[0]}: speedup {totals[args.engines[0]] / totals[engine]:.1f}x, "
+                    f"{n_diff} differing prediction rows"
+                )
+    finally:
+        db.execute_sql_query(
+            f"""DROP TABLE IF EXISTS {BENCH_NAME}_segmented_ways, {BENCH_NAME}_partitions,
+            {BENCH_NAME}_img_metadata, {BENCH_NAME}_img_classifications, {BENCH_NAME}_eval_groups,
+            {BENCH_NAME}_img_selection, {BENCH_NAME}_group_predictions,
+            {", ".join(f"{BENCH_NAME}_predictions_{engine}" for engine in args.engines)};""",
+            is_file=False,
+        )
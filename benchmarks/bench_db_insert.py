@@ -0,0 +1,92 @@
+"""Benchmark of SurfaceDatabase.add_rows_to_table: COPY FROM STDIN versus batched INSERT statements.
+
+Synthetic image metadata rows are written into a temporary `{name}_img_metadata` table of the
+database configured in `configs/00_global_config.json` and `configs/02_credentials.json`
+(the database must already exist, e.g., from a previous pipeline run).
+
+Usage:
+    python benchmarks/bench_db_insert.py --rows 1000 10000 100000 --batch_size 10000
+"""
+
+import argparse
+import time
+
+import numpy as np
+from bench_utils import get_database
+
+import constants as const
+
+BENCH_NAME = "bench_db_insert"
+
+
+def synthetic_metadata_rows(n, seed=0):
+    rng = np.random.default_rng(seed)
+    img_ids = rng.integers(10**14, 10**15, n)
+    sequence_ids = [f"seq_{i:010d}" for i in rng.integers(0, 10**6, n)]
+    captured_at = rng.integers(1_400_000_000_000, 1_700_000_000_000, n)
+    compass_angle = rng.uniform(0, 360, n)
+    is_pano = rng.random(n) < 0.1
+    creator_ids = rng.integers(10**11, 10**12, n)
+    lon = rng.uniform(13.6, 13.8, n)
+    lat = rng.uniform(51.0, 51.1, n)
+    return list(
+        zip(
+            img_ids.tolist(),
+            sequence_ids,
+            captured_at.tolist(),
+            compass_angle.tolist(),
+            is_pano.tolist(),
+            creator_ids.tolist(),
+            lon.tolist(),
+            lat.tolist(),
+        )
+    )
+
+
+def load(db, rows, method, batch_size):
+    db.execute_sql_query(const.SQL_CREATE_IMG_METADATA_TABLE, {"name": BENCH_NAME})
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        db.add_rows_to_table(
+            f"{BENCH_NAME}_img_metadata",
+            const.IMG_METADATA_HEADER,
+            rows[i : i + batch_size],
+            method=method,
+        )
+    duration = time.perf_counter() - start
+    n_loaded = db.execute_sql_query(
+        f"SELECT count(*) FROM {BENCH_NAME}_img_metadata;",
+        is_file=False,
+        get_response=True,
+    )[0][0]
+    assert n_loaded == len(rows), f"{method}: loaded {n_loaded} of {len(rows)} rows"
+    return duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench_db_insert")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=10000,
+        help="rows per add_rows_to_table call (one call per tile / classification batch in the pipeline)",
+    )
+    args = parser.parse_args()
+
+    db = get_database()
+
+    print(f"{'rows':>10} {'method':>8} {'seconds':>10} {'rows/s':>12}")
+    try:
+        for n in args.rows:
+            rows = synthetic_metadata_rows(n)
+            results = {}
+            for method in ["insert", "copy"]:
+                duration = load(db, rows, method, args.batch_size)
+                results[method] = duration
+                print(f"{n:>10} {method:>8} {duration:>10.3f} {n / duration:>12.0f}")
+            print(f"{'':>10} {'speedup':>8} {results['insert'] / results['copy']:>10.1f}x")
+    finally:
+        db.execute_sql_query(
+            f"DROP TABLE IF EXISTS {BENCH_NAME}_img_metadata;", is_file=False
+        )
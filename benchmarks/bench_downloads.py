@@ -0,0 +1,122 @@
+"""Benchmark of MapillaryInterface downloads against the local Mapillary stand-in (mapillary_standin.py).
+
+For every combination of download mode and concurrency (`parallel_batch_size`, and `max_in_flight` in async
+mode, also the number of concurrent tile requests), a fresh MapillaryInterface requests the vector tiles of an area and resolves and downloads images, with
+the latency, failure rates and bandwidth caps configured for the stand-in. Reported are the throughput and the
+requests, retries and throttled responses, e.g., to find the concurrency at which throttling outweighs parallelism.
+
+Usage:
+    python benchmarks/bench_downloads.py --imgs 1000 --concurrency 1 10 50 100 \\
+        --latency lognormal:0.15,0.5 --rate_429 0.02 --max_in_flight 50 --retry_after 1
+"""
+
+import argparse
+import concurrent.futures
+import time
+
+import mercantile
+from mapillary_standin import LATENCY_DISTRIBUTIONS, MapillaryStandIn
+
+import constants as const
+from modules.MapillaryInterface import MapillaryInterface
+
+# bounding box of the tiles in tests/test_data/test_aoi
+BBOX = (12.0, 50.0, 12.03, 50.02)
+
+
+def run(args, standin, download_mode, concurrency):
+    mi = MapillaryInterface(
+        "MLY|STANDIN",
+        parallel=True,
+        parallel_batch_size=concurrency,
+        download_mode=download_mode,
+        max_in_flight=concurrency,
+        tile_url=standin.tile_url,
+        graph_url=standin.graph_url,
+        retry_backoff=args.retry_backoff,
+    )
+    before = standin.stats()
+    try:
+        start = time.perf_counter()
+        tiles = list(mercantile.tiles(*BBOX, const.ZOOM))
+        # tiles are requested with the same concurrency, which the HTTP client is sized for
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            columns = [c for c in executor.map(mi.metadata_columns_in_tile, tiles) if c is not None]
+        tile_seconds = time.perf_counter() - start
+
+        img_ids = [str(10**14 + i) for i in range(args.imgs)]
+        start = time.perf_counter()
+        downloaded = 0
+        for i in range(0, len(img_ids), args.batch_size):
+            ids, _ = mi.query_imgs(
+                img_ids[i : i + args.batch_size], "thumb_1024_url", return_ids=True
+            )
+            downloaded += len(ids)
+        img_seconds = time.perf_counter() - start
+        client = mi.http_stats()
+    finally:
+        mi.close()
+
+    after = standin.stats()
+    status = {
+        key: after["status"].get(key, 0) - before["status"].get(key, 0)
+        for key in after["status"]
+    }
+    return {
+        "mode": download_mode,
+        "concurrency": concurrency,
+        "tiles": len(columns),
+        "tile_seconds": tile_seconds,
+        "imgs": downloaded,
+        "img_seconds": img_seconds,
+        "requests": client["requests"],
+        "retries": client["retries"],
+        "mb": client["bytes"] / 2**20,
+        "throttled": status.get("429", 0),
+        "server_errors": sum(n for key, n in status.items() if key.startswith("5")),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench_downloads")
+    parser.add_argument("--imgs", type=int, default=500)
+    parser.add_argument("--batch_size", type=int, default=100, help="images per query_imgs call")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--download_modes", nargs="+", choices=const.DOWNLOAD_MODES, default=const.DOWNLOAD_MODES)
+    parser.add_argument("--retry_backoff", type=float, default=0.1)
+    # stand-in server
+    parser.add_argument("--latency", default="lognormal:0.05,0.5", help=f"one of {LATENCY_DISTRIBUTIONS}, see mapillary_standin.parse_latency")
+    parser.add_argument("--rate_429", type=float, default=0.0)
+    parser.add_argument("--rate_5xx", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=int)
+    parser.add_argument("--max_in_flight", type=int, help="server-side limit of concurrent requests")
+    parser.add_argument("--bandwidth", type=float, help="bytes per second of a single response")
+    parser.add_argument("--total_bandwidth", type=float, help="bytes per second of all responses")
+    parser.add_argument("--synthetic_tile_imgs", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(
+        f"{'mode':>8} {'conc.':>6} {'tiles':>6} {'tiles/s':>8} {'imgs':>6} {'imgs/s':>8} "
+        f"{'requests':>9} {'retries':>8} {'429':>6} {'5xx':>6} {'MB':>8}"
+    )
+    for download_mode in args.download_modes:
+        for concurrency in args.concurrency:
+            # a fresh server per run: same random draws for every setting
+            with MapillaryStandIn(
+                latency=args.latency,
+                rate_429=args.rate_429,
+                rate_5xx=args.rate_5xx,
+                retry_after=args.retry_after,
+                max_in_flight=args.max_in_flight,
+                bandwidth=args.bandwidth,
+                total_bandwidth=args.total_bandwidth,
+                synthetic_tile_imgs=args.synthetic_tile_imgs,
+                seed=args.seed,
+            ) as standin:
+                r = run(args, standin, download_mode, concurrency)
+            print(
+                f"{r['mode']:>8} {r['concurrency']:>6} {r['tiles']:>6} {r['tiles'] / r['tile_seconds']:>8.1f} "
+                f"{r['imgs']:>6} {r['imgs'] / r['img_seconds']:>8.1f} {r['requests']:>9} {r['retries']:>8} "
+                f"{r['throttled']:>6} {r['server_errors']:>6} {r['mb']:>8.1f}"
+            )
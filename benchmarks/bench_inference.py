@@ -0,0 +1,111 @@
+"""Benchmark of the inference backends (`inference_backend`, see modules/InferenceBackend.py).
+
+For every backend, a fresh ModelInterface classifies the same preprocessed synthetic JPEGs
+(ModelInterface.batch_inference). Reported are the load time of all models (including tracing, compilation or
+ONNX export and the parity check), the throughput in images/s (best of `--repeat` runs, after a warm-up batch),
+and the parity with the eager backend: the share of images with equal road type and surface type, and the
+maximum absolute difference of the probabilities and quality values.
+
+By default, the models are randomly initialized with the configured architecture (see
+bench_suite.synthetic_model_interface); with `--checkpoints`, the configured models are used (downloaded to
+`model_root` if missing).
+
+Usage:
+    python benchmarks/bench_inference.py --backends eager torchscript onnx --imgs 128
+    python benchmarks/bench_inference.py --checkpoints --threads 4
+"""
+
+import argparse
+import time
+
+import torch
+from bench_suite import preprocess, synthetic_model_interface, timed
+from bench_utils import global_config
+
+import constants as const
+import synthetic
+from modules import Models as md
+
+
+def model_interface(args, cg, backend):
+    if not args.checkpoints:
+        return synthetic_model_interface(cg, seed=args.seed, inference_backend=backend)
+    return md.ModelInterface(
+        {**cg, "inference_backend": backend}, registry=md.ModelRegistry()
+    )
+
+
+def parity(reference, results):
+    """Share of equal road and surface types, and max. difference of probabilities and quality values."""
+    equal_classes = sum(
+        r[0] == o[0] and r[2] == o[2] for r, o in zip(reference, results)
+    )
+    value_diffs = [
+        abs(r[i] - o[i])
+        for r, o in zip(reference, results)
+        for i in [1, 3, 4]
+        if r[i] is not None and o[i] is not None
+    ]
+    return equal_classes / len(reference), max(value_diffs, default=0.0)
+
+
+def run(args, cg, backend, batches):
+    interface = model_interface(args, cg, backend)
+    start = time.perf_counter()
+    for model in interface.model_files():
+        interface.get_model(model)
+    load_seconds = time.perf_counter() - start
+
+    road, surface = batches[0]
+    interface.batch_inference(road[:2], surface[:2])  # warm-up, e.g., compilation
+    seconds, results = timed(
+        lambda: [r for batch in batches for r in interface.batch_inference(*batch)],
+        args.repeat,
+    )
+    return load_seconds, seconds, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench_inference")
+    parser.add_argument(
+        "--backends", nargs="+", choices=const.INFERENCE_BACKENDS, default=const.INFERENCE_BACKENDS
+    )
+    parser.add_argument("--imgs", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, help="default: batch_size of the global config")
+    parser.add_argument("--jpegs", type=int, default=16, help="distinct synthetic JPEGs")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads (default: torch default)")
+    parser.add_argument(
+        "--checkpoints", action=argparse.BooleanOptionalAction, default=False,
+        help="use the configured models instead of random ones",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per backend, the best is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    cg = global_config()
+    if args.batch_size is not None:
+        cg["batch_size"] = args.batch_size
+    contents = synthetic.jpegs(args.jpegs, seed=args.seed)
+    contents = [contents[i % len(contents)] for i in range(args.imgs)]
+    batches = preprocess(synthetic_model_interface(cg), contents)
+
+    print(
+        f"{'backend':>12} {'load s':>8} {'imgs/s':>8} {'speedup':>8} {'classes':>8} {'max diff':>9}"
+    )
+    reference = None
+    for backend in ["eager"] + [b for b in args.backends if b != "eager"]:
+        try:
+            load_seconds, seconds, results = run(args, cg, backend, batches)
+        except ImportError as e:
+            print(f"{backend:>12} skipped: {e}")
+            continue
+        if reference is None:
+            reference, reference_seconds = results, seconds
+        agreement, max_diff = parity(reference, results)
+        if backend in args.backends:
+            print(
+                f"{backend:>12} {load_seconds:>8.1f} {args.imgs / seconds:>8.1f} "
+                f"{reference_seconds / seconds:>8.2f} {agreement:>8.1%} {max_diff:>9.1e}"
+            )
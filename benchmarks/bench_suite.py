@@ -0,0 +1,470 @@
+"""Reproducible benchmark suite of the pipeline's hot paths on synthetic inputs (see synthetic.py).
+
+For each scale (number of images), a synthetic road network and image point cloud are generated with a fixed
+seed, the images are encoded as Mapillary vector tiles, and the following stages are timed (best of
+`--repeat` runs):
+
+- tile_decode: VectorTile.decode_point_layer of all tiles
+- segmentation, matching, aggregation: the local processing engine (modules.LocalEngine)
+- preprocessing: decoding and transforming synthetic JPEGs (ModelInterface.batch_preprocessing)
+- inference: ModelInterface.batch_inference with randomly initialized models of the configured architecture
+  (no model download)
+- with `--db`: db_insert (COPY of the decoded tiles and geometry column), db_segmentation, db_matching and
+  db_aggregation (PostGIS scripts) in the database configured in `configs/` (see bench_utils.get_database)
+
+Every run is appended to a JSON lines history (`benchmarks/results/history.jsonl`) with the git commit,
+host and settings. Each stage is compared to the median of the previous runs of the same stage and size on
+the same host and with the same settings; with `--check`, the script exits with status 1 if a stage is slower
+than `--threshold` times this baseline, e.g., to catch regressions of hot paths in CI before production.
+`--preprocessing_engine`, `--preprocessing_workers` and `--jpeg_size` (e.g. 2048 1536 for `thumb_2048_url`)
+select the preprocessing path.
+
+Usage:
+    python benchmarks/bench_suite.py --imgs 1000 10000 100000 1000000
+    python benchmarks/bench_suite.py --imgs 10000 --stages tile_decode matching --check
+    python benchmarks/bench_suite.py --imgs 10000 100000 --db
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+from bench_utils import get_database, global_config, root_path
+
+import constants as const
+import synthetic
+from modules import Models as md
+from modules.AreaOfInterest import AreaOfInterest
+from modules.LocalEngine import rows_from_columns
+from modules.VectorTile import decode_point_layer
+
+BENCH_NAME = "bench_suite"
+HISTORY_FILE = Path(os.path.abspath(__file__)).parent / "results" / "history.jsonl"
+
+STAGES = ["tile_decode", "segmentation", "matching", "aggregation", "preprocessing", "inference"]
+DB_STAGES = ["db_insert", "db_segmentation", "db_matching", "db_aggregation"]
+# road network parameters of the synthetic area of interest
+AOI_CONFIG = {
+    "name": BENCH_NAME,
+    "proj_crs": 3035,
+    "dist_from_road": 10,
+    "segment_length": 20,
+    "min_road_length": 10,
+}
+TAG_COLUMNS = [
+    "sidewalk",
+    "sidewalk_left",
+    "sidewalk_right",
+    "cycleway_left",
+    "cycleway_right",
+    "cycleway_both",
+]
+
+CREATE_WAY_SELECTION = """
+DROP TABLE IF EXISTS {name}_way_selection;
+CREATE TABLE {name}_way_selection (
+    id bigint, road_type varchar, sidewalk text, sidewalk_left text, sidewalk_right text,
+    cycleway_left text, cycleway_right text, cycleway_both text, geom geometry
+);
+"""
+TRANSFORM_WAY_SELECTION = "UPDATE {name}_way_selection SET geom = ST_Transform(geom, {crs});"
+DROP_TABLES = """
+DROP TABLE IF EXISTS {name}_way_selection, {name}_segmented_ways, {name}_partitions, {name}_img_metadata,
+    {name}_img_classifications, {name}_eval_groups, {name}_img_selection, {name}_group_predictions;
+"""
+
+
+def timed(func, repeat):
+    """Best duration of `repeat` calls of func, and the result of the last call."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+    return min(durations), result
+
+
+def decode_tiles(tiles):
+    return [
+        decode_point_layer(content, x, y, z, const.TILE_LAYER, const.TILE_IMG_PROPERTIES)
+        for (x, y, z), content in tiles.items()
+    ]
+
+
+def synthetic_model_interface(cg, seed=0, inference_backend="eager"):
+    """ModelInterface with the configured transforms and batch size, which loads randomly initialized models of
+    the configured architecture instead of the checkpoints on Hugging Face. The same seed gives the same models,
+    also with different inference backends."""
+    config = {
+        key: cg[key]
+        for key in [
+            "transform_surface", "transform_road_type", "models", "batch_size", "gpu_kernel",
+            "preprocessing_engine", "preprocessing_workers", "batch_buffers",
+        ]
+        if key in cg
+    }
+    # e.g., ONNX exports of the random models, removed at exit
+    config["model_root"] = tempfile.mkdtemp(prefix="synthetic_models_")
+    atexit.register(shutil.rmtree, config["model_root"], ignore_errors=True)
+    config["inference_backend"] = inference_backend
+    interface = md.ModelInterface(config, registry=md.ModelRegistry())
+    road_type = dict(zip(synthetic.ROAD_TYPE_CLASSES, range(len(synthetic.ROAD_TYPE_CLASSES))))
+    surface_type = dict(zip(synthetic.SURFACE_TYPES, range(len(synthetic.SURFACE_TYPES))))
+    quality = dict(zip(synthetic.QUALITY_CLASSES, range(1, len(synthetic.QUALITY_CLASSES) + 1)))
+    models = [
+        (interface.models["road_type"], road_type, False),
+        (interface.models["surface_type"], surface_type, False),
+    ] + [(model, quality, True) for model in interface.models["surface_quality"].values()]
+    models = {
+        model: (seed + i, class_to_idx, is_regression)
+        for i, (model, class_to_idx, is_regression) in enumerate(models)
+    }
+    interface.load_model = lambda model: _random_model(*models[model])
+    return interface
+
+
+def _random_model(seed, class_to_idx, is_regression):
+    torch.manual_seed(seed)
+    model_cls = md.model_mapping[const.EFFNET_LINEAR]
+    model = model_cls(
+        num_classes=1 if is_regression else len(class_to_idx), class_to_idx=class_to_idx
+    )
+    return model, class_to_idx, is_regression
+
+
+def segment(engine, ways):
+    segments = engine.segment_ways(ways)
+    return segments, engine.separate_road_types(segments, ways)
+
+
+def preprocess(model_interface, contents):
+    # encoded images as downloaded, opened in process or by the preprocessing workers
+    return [
+        model_interface.batch_preprocessing(contents[i : i + model_interface.batch_size])
+        for i in range(0, len(contents), model_interface.batch_size)
+    ]
+
+
+def preprocess_and_release(model_interface, contents):
+    # as the pipeline, which returns the buffers of a batch after its inference
+    for batch in preprocess(model_interface, contents):
+        model_interface.release_batch(*batch)
+
+
+def infer(model_interface, batches):
+    return [model_interface.batch_inference(*batch) for batch in batches]
+
+
+def run_local_stages(args, n_imgs, stages):
+    """Time the in-process stages on a synthetic area of interest with n_imgs images.
+
+    Returns:
+        list(dict): stage, items (images, or ways of the segmentation), seconds
+    """
+    ways = synthetic.road_network(max(1, n_imgs // args.imgs_per_way), seed=args.seed)
+    imgs = synthetic.image_points(ways, n_imgs, seed=args.seed)
+    results = []
+    engine = AreaOfInterest(AOI_CONFIG).local_engine()
+
+    if "tile_decode" in stages:
+        tiles = synthetic.vector_tiles(imgs)
+        seconds, decoded = timed(partial(decode_tiles, tiles), args.repeat)
+        assert sum(len(columns["id"]) for columns in decoded) == n_imgs
+        results.append({"stage": "tile_decode", "items": n_imgs, "seconds": seconds})
+
+    if stages & {"segmentation", "matching", "aggregation"}:
+        seconds, (segments, partitions) = timed(partial(segment, engine, ways), args.repeat)
+        if "segmentation" in stages:
+            results.append(
+                {"stage": "segmentation", "items": len(ways["id"]), "seconds": seconds}
+            )
+    if stages & {"matching", "aggregation"}:
+        img_columns = {c: imgs[c] for c in ["img_id", "sequence_id", "captured_at", "geom"]}
+        seconds, matched = timed(
+            partial(engine.match_imgs_to_segments, img_columns, segments, partitions),
+            args.repeat,
+        )
+        if "matching" in stages:
+            results.append({"stage": "matching", "items": n_imgs, "seconds": seconds})
+    if "aggregation" in stages:
+        classifications = synthetic.classifications(imgs, ways, seed=args.seed)
+        seconds, _ = timed(
+            partial(engine.aggregate_on_roads, segments, partitions, matched, classifications),
+            args.repeat,
+        )
+        results.append({"stage": "aggregation", "items": n_imgs, "seconds": seconds})
+    return results
+
+
+def run_img_stages(args, stages):
+    """Time preprocessing and inference of synthetic JPEGs (independent of the scale).
+
+    Returns:
+        list(dict): stage, items (images), seconds
+    """
+    cg = {
+        **global_config(),
+        "preprocessing_engine": args.preprocessing_engine,
+        "preprocessing_workers": args.preprocessing_workers,
+    }
+    model_interface = synthetic_model_interface(cg, seed=args.seed)
+    contents = synthetic.jpegs(args.jpegs, seed=args.seed, size=tuple(args.jpeg_size))
+    results = []
+    if "preprocessing" in stages:
+        batch = [contents[i % len(contents)] for i in range(args.preprocess_imgs)]
+        seconds, _ = timed(partial(preprocess_and_release, model_interface, batch), args.repeat)
+        results.append(
+            {"stage": "preprocessing", "items": args.preprocess_imgs, "seconds": seconds}
+        )
+    if "inference" in stages:
+        batch = [contents[i % len(contents)] for i in range(args.inference_imgs)]
+        batches = preprocess(model_interface, batch)
+        infer(model_interface, [(road[:1], surface[:1]) for road, surface in batches[:1]])  # warm-up
+        seconds, _ = timed(partial(infer, model_interface, batches), args.repeat)
+        results.append(
+            {"stage": "inference", "items": args.inference_imgs, "seconds": seconds}
+        )
+    return results
+
+
+def run_db_stages(args, db, n_imgs, stages):
+    """Time the database stages on a synthetic area of interest with n_imgs images. As the stages replace
+    their input tables, the chain of stages is repeated as a whole.
+
+    Returns:
+        list(dict): stage, items (images), seconds
+    """
+    aoi = AreaOfInterest(AOI_CONFIG)
+    params = aoi.query_params
+    ways = synthetic.road_network(max(1, n_imgs // args.imgs_per_way), seed=args.seed)
+    imgs = synthetic.image_points(ways, n_imgs, seed=args.seed)
+    decoded = decode_tiles(synthetic.vector_tiles(imgs))
+    classifications = synthetic.classifications(imgs, ways, seed=args.seed)
+    quality = classifications["quality_pred"].astype(object)
+    quality[np.isnan(classifications["quality_pred"])] = None
+    classifications["quality_pred"] = quality
+    ways["geom"] = synthetic.lonlat_geometries(ways["geom"])
+    header = ["id", "road_type"] + TAG_COLUMNS + ["geom"]
+
+    def insert():
+        db.execute_sql_query(const.SQL_CREATE_IMG_METADATA_TABLE, params)
+        # one COPY per tile, as AreaOfInterest.get_and_write_img_metadata
+        for columns in decoded:
+            columns = {**columns, "img_id": columns["id"]}
+            rows = list(zip(*[columns[h].tolist() for h in const.IMG_METADATA_HEADER]))
+            db.add_rows_to_table(f"{BENCH_NAME}_img_metadata", const.IMG_METADATA_HEADER, rows)
+        db.execute_sql_query(const.SQL_ADD_GEOM_COLUMN, params)
+
+    def segmentation():
+        db.execute_sql_query(const.SQL_SEGMENT_WAYS, params)
+        db.execute_sql_query(const.SQL_PREPARE_PARTITIONS, params)
+        db.execute_sql_query(const.SQL_SEPARATE_ROAD_TYPES, params)
+
+    def aggregation():
+        db.execute_sql_query(const.SQL_RENAME_ROAD_TYPE_PRED, params)
+        aoi.aggregate_on_roads(db)
+
+    chain = [
+        ("db_insert", insert),
+        ("db_segmentation", segmentation),
+        ("db_matching", partial(db.execute_sql_query, const.SQL_MATCH_IMG_ROADS, params)),
+        ("db_aggregation", aggregation),
+    ]
+    durations = {}
+    try:
+        for _ in range(args.repeat):
+            db.execute_sql_query(DROP_TABLES, params, is_file=False)
+            db.execute_sql_query(CREATE_WAY_SELECTION, params, is_file=False)
+            db.add_rows_to_table(
+                f"{BENCH_NAME}_way_selection", header, rows_from_columns(ways, header, 4326)
+            )
+            db.execute_sql_query(TRANSFORM_WAY_SELECTION, params, is_file=False)
+            db.execute_sql_query(const.SQL_PREP_MODEL_RESULT, params)
+            db.add_rows_to_table(
+                f"{BENCH_NAME}_img_classifications",
+                list(classifications),
+                rows_from_columns(classifications, list(classifications), None),
+            )
+            # the stages of the chain run up to the last requested stage
+            last = max(i for i, (stage, _) in enumerate(chain) if stage in stages)
+            for stage, func in chain[: last + 1]:
+                start = time.perf_counter()
+                func()
+                durations.setdefault(stage, []).append(time.perf_counter() - start)
+    finally:
+        db.execute_sql_query(DROP_TABLES, params, is_file=False)
+    return [
+        {"stage": stage, "items": n_imgs, "seconds": min(durations[stage])}
+        for stage, _ in chain
+        if stage in stages
+    ]
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=root_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def read_history(path):
+    if not Path(path).exists():
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def baselines(history, host, n_runs, settings):
+    """Median duration of the last n_runs runs of each stage and size on the host with the same settings.
+
+    Returns:
+        dict: (stage, items) -> seconds
+    """
+    durations = {}
+    for run in history:
+        if run["host"] != host or run.get("settings") != settings:
+            continue
+        for result in run["results"]:
+            durations.setdefault((result["stage"], result["items"]), []).append(
+                result["seconds"]
+            )
+    return {
+        key: statistics.median(seconds[-n_runs:]) for key, seconds in durations.items()
+    }
+
+
+def print_results(results, baseline, threshold):
+    """Print the results with their baseline. Returns the results slower than threshold times the baseline."""
+    print(
+        f"{'stage':<16} {'items':>9} {'seconds':>10} {'items/s':>12} {'baseline s':>11} {'ratio':>7}"
+    )
+    regressions = []
+    for result in results:
+        base = baseline.get((result["stage"], result["items"]))
+        ratio = result["seconds"] / base if base else None
+        flag = ""
+        if ratio is not None and ratio > threshold:
+            regressions.append(result)
+            flag = "  REGRESSION"
+        print(
+            f"{result['stage']:<16} {result['items']:>9} {result['seconds']:>10.4f} "
+            f"{result['items'] / result['seconds']:>12.0f} "
+            f"{base if base is not None else float('nan'):>11.4f} "
+            f"{ratio if ratio is not None else float('nan'):>7.2f}{flag}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench_suite")
+    parser.add_argument("--imgs", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--stages", nargs="+", choices=STAGES + DB_STAGES, default=STAGES,
+        help="stages to time, the database stages require --db (default: all of them)",
+    )
+    parser.add_argument(
+        "--db", action=argparse.BooleanOptionalAction, default=False,
+        help="also time the database stages (DB_STAGES) in the configured database",
+    )
+    parser.add_argument("--imgs_per_way", type=int, default=25)
+    parser.add_argument("--jpegs", type=int, default=16, help="distinct synthetic JPEGs")
+    parser.add_argument("--jpeg_size", type=int, nargs=2, default=[1024, 768], help="width and height of the JPEGs")
+    parser.add_argument(
+        "--preprocessing_engine", choices=const.PREPROCESSING_ENGINES,
+        help="default: preprocessing_engine of the global config",
+    )
+    parser.add_argument(
+        "--preprocessing_workers", type=int,
+        help="default: preprocessing_workers of the global config",
+    )
+    parser.add_argument("--preprocess_imgs", type=int, default=256)
+    parser.add_argument("--inference_imgs", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", default=str(HISTORY_FILE))
+    parser.add_argument(
+        "--baseline_runs", type=int, default=5,
+        help="number of previous runs whose median is the baseline",
+    )
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument(
+        "--check", action=argparse.BooleanOptionalAction, default=False,
+        help="exit with status 1 if a stage is slower than threshold times its baseline",
+    )
+    parser.add_argument(
+        "--record", action=argparse.BooleanOptionalAction, default=True,
+        help="append the run to the history",
+    )
+    args = parser.parse_args()
+    if args.preprocessing_engine is None:
+        args.preprocessing_engine = global_config().get("preprocessing_engine", "transforms")
+    if args.preprocessing_workers is None:
+        args.preprocessing_workers = global_config().get("preprocessing_workers", 0)
+
+    stages = set(args.stages)
+    if args.db and not stages & set(DB_STAGES):
+        stages |= set(DB_STAGES)
+    results = []
+    for n_imgs in args.imgs:
+        results += run_local_stages(args, n_imgs, stages)
+    if stages & {"preprocessing", "inference"}:
+        results += run_img_stages(args, stages)
+    if args.db and stages & set(DB_STAGES):
+        db = get_database()
+        try:
+            for n_imgs in args.imgs:
+                results += run_db_stages(args, db, n_imgs, stages)
+        finally:
+            db.close()
+
+    run = {
+        **environment(),
+        "settings": {
+            key: getattr(args, key)
+            for key in [
+                "imgs_per_way", "jpegs", "jpeg_size", "preprocessing_engine",
+                "preprocessing_workers", "repeat", "seed",
+            ]
+        },
+        "results": results,
+    }
+    baseline = baselines(
+        read_history(args.history), run["host"], args.baseline_runs, run["settings"]
+    )
+    regressions = print_results(results, baseline, args.threshold)
+    if args.record:
+        Path(args.history).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(run) + "\n")
+    if regressions and args.check:
+        print(f"{len(regressions)} stages slower than {args.threshold}x their baseline.")
+        raise SystemExit(1)
@@ -0,0 +1,66 @@
+"""Shared helpers of the benchmark scripts."""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+root_path = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_path / "src"))
+
+from modules.SurfaceDatabase import SurfaceDatabase, split_sql_statements
+
+
+def global_config():
+    with open(root_path / "configs" / "00_global_config.json", "r") as f:
+        return json.load(f)
+
+
+def get_database():
+    """Connect to the database configured in `configs/00_global_config.json` and `configs/02_credentials.json`.
+    The database must already exist, e.g., from a previous pipeline run.
+
+    Returns:
+        SurfaceDatabase: the database
+    """
+    cg = global_config()
+    with open(root_path / "configs" / "02_credentials.json", "r") as f:
+        credentials = json.load(f)
+    return SurfaceDatabase(
+        **{
+            key: value
+            for key, value in {**cg, **credentials}.items()
+            if key in ["dbname", "dbuser", "dbpassword", "dbhost", "dbport"]
+        }
+    )
+
+
+def sql_statements(path, params):
+    """Split a SQL script into its single statements (comments are removed).
+
+    Args:
+        path (str): path to the SQL file
+        params (dict): parameters to format the SQL script with
+
+    Returns:
+        list(str): SQL statements
+    """
+    with open(path, "r") as f:
+        return split_sql_statements(f.read().format(**params))
+
+
+def timed_statements(db, statements):
+    """Execute SQL statements one by one in one transaction and measure their durations.
+
+    Returns:
+        list(tuple(str, float)): statement and its duration in seconds
+    """
+    timings = []
+    with db.transaction() as conn:
+        with conn.cursor() as cursor:
+            for statement in statements:
+                start = time.perf_counter()
+                cursor.execute(statement)
+                timings.append((statement, time.perf_counter() - start))
+    return timings
@@ -0,0 +1,381 @@
+"""Local stand-in for the Mapillary API, to load-test downloads without network access.
+
+Serves vector tiles (`.../maps/vtp/{coverage}/2/{z}/{x}/{y}`, with ETags), Graph API url lookups of single
+images (`/{img_id}`) and batches (`/images?image_ids=...`), and JPEG bodies of the returned thumbnail urls.
+Tiles are read from `{coverage}-2-{z}-{x}-{y}.pbf` files (as in `tests/test_data/test_aoi`), other tiles are
+synthetic (synthetic.encode_point_layer) or empty. JPEGs are the images of `tests/test_data`.
+
+Latency (fixed, uniform or lognormal), the shares of 429 and 5xx responses, a limit of concurrent requests
+(further requests are throttled with 429) and bandwidth caps per response and in total are configurable,
+and all random draws are seeded, thus load tests of download concurrency, retries and throttling are
+reproducible. Point a MapillaryInterface at the server with its `tile_url` and `graph_url`.
+
+Usage:
+    python benchmarks/mapillary_standin.py --port 8765 --latency lognormal:0.1,0.5 --rate_429 0.05
+    # configs: "tile_url": "http://127.0.0.1:8765/maps/vtp/{}/2/{}/{}/{}", "graph_url": "http://127.0.0.1:8765/{}"
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# without bench_utils: the server does not require the database dependencies
+root_path = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_path / "src"))
+
+import constants as const
+import synthetic
+
+TILES_DIR = root_path / "tests" / "test_data" / "test_aoi"
+JPEGS_DIR = root_path / "tests" / "test_data"
+LATENCY_DISTRIBUTIONS = ["none", "fixed", "uniform", "lognormal"]
+
+_TILE_PATH = re.compile(r"^/maps/vtp/([^/]+)/2/(\d+)/(\d+)/(\d+)$")
+_IMG_PATH = re.compile(r"^/img/(\d+)/([a-z0-9_]+)\.jpg$")
+_CHUNK_SIZE = 64 * 1024
+
+
+def parse_latency(spec):
+    """Parse a latency distribution: "none", "fixed:<s>", "uniform:<min s>,<max s>" or
+    "lognormal:<median s>,<sigma>".
+
+    Returns:
+        tuple(str, list(float)): distribution and its parameters
+    """
+    name, _, values = spec.partition(":")
+    if name not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"Invalid latency {spec}, options: {LATENCY_DISTRIBUTIONS}")
+    params = [float(v) for v in values.split(",")] if values else []
+    n_params = {"none": 0, "fixed": 1, "uniform": 2, "lognormal": 2}[name]
+    if len(params) != n_params:
+        raise ValueError(f"Invalid latency {spec}: {name} takes {n_params} parameters")
+    return name, params
+
+
+class Throttle:
+    """Bandwidth cap: sending n bytes blocks until the average rate is at most `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next_free = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + n / self.rate
+            wait = self._next_free - now
+        time.sleep(wait)
+
+
+class MapillaryStandIn:
+    """Local HTTP server with the endpoints of the Mapillary API used by MapillaryInterface."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        tiles_dir=TILES_DIR,
+        jpegs_dir=JPEGS_DIR,
+        latency="none",
+        rate_429=0.0,
+        rate_5xx=0.0,
+        retry_after=None,
+        max_in_flight=None,
+        bandwidth=None,
+        total_bandwidth=None,
+        synthetic_tile_imgs=0,
+        seed=0,
+    ):
+        """Initializes a MapillaryStandIn.
+
+        Args:
+            host (str, optional): host to listen on. Defaults to "127.0.0.1".
+            port (int, optional): port, 0 for a free port. Defaults to 0.
+            tiles_dir (str, optional): folder of `{coverage}-2-{z}-{x}-{y}.pbf` tiles. Defaults to TILES_DIR.
+            jpegs_dir (str, optional): folder of the served JPEGs. Defaults to JPEGS_DIR.
+            latency (str, optional): latency distribution of the responses, see parse_latency. Defaults to "none".
+            rate_429 (float, optional): share of requests throttled with 429. Defaults to 0.
+            rate_5xx (float, optional): share of requests failing with 500, 502 or 503. Defaults to 0.
+            retry_after (int, optional): Retry-After header of 429 responses, in seconds. Defaults to None.
+            max_in_flight (int, optional): concurrent requests above this limit are throttled with 429.
+                Defaults to None (no limit).
+            bandwidth (float, optional): bytes per second of a single response. Defaults to None (no cap).
+            total_bandwidth (float, optional): bytes per second of all responses. Defaults to None (no cap).
+            synthetic_tile_imgs (int, optional): images of tiles without file, 0 for empty tiles. Defaults to 0.
+            seed (int, optional): seed of latencies, failures and synthetic tiles. Defaults to 0.
+        """
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.max_in_flight = max_in_flight
+        self.bandwidth = bandwidth
+        self.total_throttle = Throttle(total_bandwidth) if total_bandwidth else None
+        self.synthetic_tile_imgs = synthetic_tile_imgs
+        self.seed = seed
+        self.tiles_dir = Path(tiles_dir)
+        self.jpegs = [
+            path.read_bytes() for path in sorted(Path(jpegs_dir).glob("*.jpg"))
+        ]
+        if len(self.jpegs) == 0:
+            raise ValueError(f"No JPEGs in {jpegs_dir}")
+
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._tiles = {}
+        self._in_flight = 0
+        self._stats = {"requests": 0, "bytes": 0, "status": {}}
+        self._thread = None
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def tile_url(self):
+        """Url template of the tiles, to be passed as MapillaryInterface(tile_url=...)."""
+        return self.url + "/maps/vtp/{}/2/{}/{}/{}"
+
+    @property
+    def graph_url(self):
+        """Url template of the Graph API, to be passed as MapillaryInterface(graph_url=...)."""
+        return self.url + "/{}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="mapillary-standin", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        """Requests, response bytes and number of responses per status code.
+
+        Returns:
+            dict: requests, bytes, status (str -> count)
+        """
+        with self._lock:
+            return {**self._stats, "status": dict(self._stats["status"])}
+
+    def _draw(self):
+        # latency and injected failure of a request, drawn in order of arrival
+        with self._lock:
+            name, params = self.latency
+            if name == "fixed":
+                latency = params[0]
+            elif name == "uniform":
+                latency = self._rng.uniform(*params)
+            elif name == "lognormal":
+                latency = params[0] * np.exp(self._rng.normal(0, params[1]))
+            else:
+                latency = 0.0
+            u = self._rng.random()
+            if u < self.rate_429:
+                failure = 429
+            elif u < self.rate_429 + self.rate_5xx:
+                failure = int(self._rng.choice([500, 502, 503]))
+            else:
+                failure = None
+        return latency, failure
+
+    def _enter(self):
+        with self._lock:
+            self._in_flight += 1
+            return self.max_in_flight is None or self._in_flight <= self.max_in_flight
+
+    def _leave(self, status, n_bytes):
+        with self._lock:
+            self._in_flight -= 1
+            self._stats["requests"] += 1
+            self._stats["bytes"] += n_bytes
+            key = str(status)
+            self._stats["status"][key] = self._stats["status"].get(key, 0) + 1
+
+    def tile(self, coverage, z, x, y):
+        key = (coverage, z, x, y)
+        with self._lock:
+            if key in self._tiles:
+                return self._tiles[key]
+        path = self.tiles_dir / f"{coverage}-2-{z}-{x}-{y}.pbf"
+        if path.exists():
+            content = path.read_bytes()
+        elif self.synthetic_tile_imgs > 0:
+            content = self._synthetic_tile(x, y, z)
+        else:
+            content = b""
+        with self._lock:
+            self._tiles[key] = content
+        return content
+
+    def _synthetic_tile(self, x, y, z, extent=4096):
+        n = self.synthetic_tile_imgs
+        rng = np.random.default_rng([self.seed, x, y, z])
+        # image ids are unique per tile
+        first_id = 10**14 + ((x * 2**z + y) % 10**9) * 10**4
+        properties = {
+            "id": (first_id + np.arange(n)).tolist(),
+            "sequence_id": [f"seq_{x}_{y}_{s}" for s in rng.integers(0, 20, n).tolist()],
+            "captured_at": rng.integers(1_400_000_000_000, 1_700_000_000_000, n).tolist(),
+            "compass_angle": rng.uniform(0, 360, n).tolist(),
+            "is_pano": (rng.random(n) < 0.05).tolist(),
+            "creator_id": rng.integers(10**11, 10**12, n).tolist(),
+        }
+        return synthetic.encode_point_layer(
+            const.TILE_LAYER,
+            rng.integers(0, extent, n).tolist(),
+            rng.integers(0, extent, n).tolist(),
+            properties,
+            extent,
+        )
+
+    def img_url(self, img_id, img_size):
+        return f"{self.url}/img/{img_id}/{img_size}.jpg"
+
+    def jpeg(self, img_id):
+        return self.jpegs[int(img_id) % len(self.jpegs)]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the Mapillary API
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        standin = self.server.standin
+        status, body, headers = 500, b"", {}
+        try:
+            if not standin._enter():
+                status, body, headers = self._throttled(standin)
+                return
+            latency, failure = standin._draw()
+            time.sleep(latency)
+            if failure == 429:
+                status, body, headers = self._throttled(standin)
+            elif failure is not None:
+                status, body = failure, b'{"error": "injected failure"}'
+            else:
+                status, body, headers = self._route(standin)
+        finally:
+            self._send(standin, status, body, headers)
+            standin._leave(status, len(body))
+
+    @staticmethod
+    def _throttled(standin):
+        headers = {}
+        if standin.retry_after is not None:
+            headers["Retry-After"] = str(standin.retry_after)
+        return 429, b'{"error": "too many requests"}', headers
+
+    def _route(self, standin):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/_stats":
+            return 200, json.dumps(standin.stats()).encode(), {}
+
+        match = _TILE_PATH.match(url.path)
+        if match is not None:
+            coverage, z, x, y = match.group(1), *map(int, match.groups()[1:])
+            content = standin.tile(coverage, z, x, y)
+            etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                return 304, b"", {"ETag": etag}
+            return 200, content, {"ETag": etag, "Content-Type": "application/x-protobuf"}
+
+        match = _IMG_PATH.match(url.path)
+        if match is not None:
+            return 200, standin.jpeg(match.group(1)), {"Content-Type": "image/jpeg"}
+
+        if url.path == "/images":
+            fields = query.get("fields", "id").split(",")
+            data = [
+                _graph_item(standin, img_id, fields)
+                for img_id in query.get("image_ids", "").split(",")
+                if img_id.isdigit()
+            ]
+            return 200, json.dumps({"data": data}).encode(), {}
+
+        if url.path[1:].isdigit():
+            fields = query.get("fields", "id").split(",")
+            return 200, json.dumps(_graph_item(standin, url.path[1:], fields)).encode(), {}
+
+        return 404, b'{"error": "not found"}', {}
+
+    def _send(self, standin, status, body, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        throttle = Throttle(standin.bandwidth) if standin.bandwidth else None
+        for i in range(0, len(body), _CHUNK_SIZE):
+            chunk = body[i : i + _CHUNK_SIZE]
+            if throttle is not None:
+                throttle.consume(len(chunk))
+            if standin.total_throttle is not None:
+                standin.total_throttle.consume(len(chunk))
+            self.wfile.write(chunk)
+
+
+def _graph_item(standin, img_id, fields):
+    item = {"id": img_id}
+    for field in fields:
+        if field.startswith("thumb_") and field.endswith("_url"):
+            item[field] = standin.img_url(img_id, field)
+    return item
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="mapillary_standin")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tiles_dir", default=str(TILES_DIR))
+    parser.add_argument("--jpegs_dir", default=str(JPEGS_DIR))
+    parser.add_argument("--latency", default="none", help="none, fixed:<s>, uniform:<min s>,<max s> or lognormal:<median s>,<sigma>")
+    parser.add_argument("--rate_429", type=float, default=0.0)
+    parser.add_argument("--rate_5xx", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=int, help="Retry-After header of 429 responses (seconds)")
+    parser.add_argument("--max_in_flight", type=int, help="throttle concurrent requests above this limit with 429")
+    parser.add_argument("--bandwidth", type=float, help="bytes per second of a single response")
+    parser.add_argument("--total_bandwidth", type=float, help="bytes per second of all responses")
+    parser.add_argument("--synthetic_tile_imgs", type=int, default=0, help="images of tiles without file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    standin = MapillaryStandIn(**vars(args))
+    print(f'Serving on {standin.url}: "tile_url": "{standin.tile_url}", "graph_url": "{standin.graph_url}"')
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        standin.server.server_close()
+        print(json.dumps(standin.stats()))
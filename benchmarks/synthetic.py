@@ -0,0 +1,367 @@
+"""Synthetic inputs of the benchmark suite: road networks, image point clouds along the roads, Mapillary vector
+tiles of the images and street-level JPEGs like those in `tests/test_data`.
+
+Geometries are generated in metres of a local equirectangular projection around CENTER, thus they can be
+used by the local processing engine as they are and be converted to EPSG:4326 (lon/lat) exactly. All
+generators are deterministic for a given seed.
+"""
+
+import io
+import math
+import struct
+
+import numpy as np
+import shapely
+from PIL import Image
+
+import constants as const
+from modules.LocalEngine import _object_array
+
+CENTER = (13.73, 51.05)  # lon, lat (Dresden)
+EARTH_RADIUS = 6378137.0
+
+ROAD_TYPES = ["road", "road", "road", "footway", "cycleway", "path", None]
+SURFACE_TYPES = ["asphalt", "concrete", "paving_stones", "sett", "unpaved"]
+# classes of the synthetic models (as in the checkpoints on Hugging Face)
+ROAD_TYPE_CLASSES = [
+    "1_1_road__1_1_road_general",
+    "1_2_bicycle__1_2_cycleway",
+    "1_2_bicycle__1_2_lane",
+    "1_3_pedestrian__1_3_footway",
+    "1_4_path__1_4_path_unspecified",
+]
+QUALITY_CLASSES = ["excellent", "good", "intermediate", "bad", "very_bad"]
+
+
+def to_lonlat(x, y):
+    """Local metres -> EPSG:4326."""
+    lat0 = math.radians(CENTER[1])
+    lon = CENTER[0] + np.degrees(np.asarray(x) / (EARTH_RADIUS * math.cos(lat0)))
+    lat = CENTER[1] + np.degrees(np.asarray(y) / EARTH_RADIUS)
+    return lon, lat
+
+
+def lonlat_geometries(geometries):
+    """Geometries in local metres -> geometries in EPSG:4326."""
+    return shapely.transform(geometries, lambda xy: np.column_stack(to_lonlat(*xy.T)))
+
+
+def road_network(n_ways, seed=0, way_length=200.0, spacing=100.0):
+    """Ways as polylines of a random walk with 2 to 5 legs, spread over a square of about `spacing`^2 per way.
+
+    Args:
+        n_ways (int): number of ways
+        seed (int, optional): random seed. Defaults to 0.
+        way_length (float, optional): mean length of a way in metres. Defaults to 200.
+        spacing (float, optional): side length of the area per way in metres. Defaults to 100.
+
+    Returns:
+        dict: columns of a `{name}_way_selection` table (LocalEngine.segment_ways): "id", "road_type",
+        the OSM tag columns of sidewalks and cycleways and "geom" (LineStrings in local metres)
+    """
+    rng = np.random.default_rng(seed)
+    side = math.sqrt(n_ways) * spacing
+    n_legs = rng.integers(2, 6, n_ways)
+    way_of_leg = np.repeat(np.arange(n_ways), n_legs)
+    # legs turn by at most 45 degrees
+    heading = np.repeat(rng.uniform(0, 2 * np.pi, n_ways), n_legs) + rng.uniform(
+        -np.pi / 4, np.pi / 4, len(way_of_leg)
+    )
+    leg_length = rng.uniform(0.5, 1.5, len(way_of_leg)) * way_length / n_legs[way_of_leg]
+    steps = np.column_stack([np.cos(heading), np.sin(heading)]) * leg_length[:, None]
+
+    # vertices: start point followed by the cumulated legs of each way
+    starts = rng.uniform(-side / 2, side / 2, (n_ways, 2))
+    first_leg = np.cumsum(n_legs) - n_legs
+    cumulated = np.cumsum(steps, axis=0)
+    cumulated -= np.repeat(cumulated[first_leg] - steps[first_leg], n_legs, axis=0)
+    n_vertices = n_legs + 1
+    coords = np.empty((n_vertices.sum(), 2))
+    offsets = np.cumsum(n_vertices) - n_vertices
+    coords[offsets] = starts
+    vertex = np.arange(len(way_of_leg)) - np.repeat(first_leg, n_legs) + 1
+    coords[np.repeat(offsets, n_legs) + vertex] = starts[way_of_leg] + cumulated
+
+    road_type = rng.choice(np.array(ROAD_TYPES, dtype=object), n_ways)
+    is_road = road_type == "road"
+    sidewalk = np.where(
+        is_road & (rng.random(n_ways) < 0.4),
+        rng.choice(np.array(["both", "left", "right"], dtype=object), n_ways),
+        None,
+    )
+    cycleway = np.where(
+        is_road & (rng.random(n_ways) < 0.2),
+        rng.choice(np.array(["lane", "track"], dtype=object), n_ways),
+        None,
+    )
+    ways = {
+        "id": _object_array(np.arange(1, n_ways + 1).tolist()),
+        "road_type": road_type.astype(object),
+        "sidewalk": sidewalk.astype(object),
+        "sidewalk_left": _object_array([None] * n_ways),
+        "sidewalk_right": _object_array([None] * n_ways),
+        "cycleway_left": _object_array([None] * n_ways),
+        "cycleway_right": _object_array([None] * n_ways),
+        "cycleway_both": cycleway.astype(object),
+        "geom": shapely.linestrings(coords, indices=np.repeat(np.arange(n_ways), n_vertices)),
+    }
+    return ways
+
+
+def image_points(ways, n_imgs, seed=0, jitter=3.0, unmatched_share=0.05):
+    """Images along the ways (chosen proportional to their length), displaced by normally distributed GPS
+    noise, and a share of images far away from any way.
+
+    Args:
+        ways (dict): road network, see road_network
+        n_imgs (int): number of images
+        seed (int, optional): random seed. Defaults to 0.
+        jitter (float, optional): standard deviation of the GPS noise in metres. Defaults to 3.
+        unmatched_share (float, optional): share of images placed randomly in the area. Defaults to 0.05.
+
+    Returns:
+        dict: columns of const.IMG_METADATA_HEADER (img_id, lon and lat as in the vector tiles) plus "geom"
+        (Points in local metres) and "way_id" (way the image was placed on, None for unmatched images)
+    """
+    rng = np.random.default_rng(seed)
+    lengths = shapely.length(ways["geom"])
+    way_idx = rng.choice(len(lengths), n_imgs, p=lengths / lengths.sum())
+    points = shapely.line_interpolate_point(
+        ways["geom"][way_idx], rng.random(n_imgs), normalized=True
+    )
+    xy = shapely.get_coordinates(points) + rng.normal(0, jitter, (n_imgs, 2))
+    is_unmatched = rng.random(n_imgs) < unmatched_share
+    xmin, ymin, xmax, ymax = shapely.total_bounds(ways["geom"])
+    xy[is_unmatched] = rng.uniform((xmin, ymin), (xmax, ymax), (is_unmatched.sum(), 2))
+
+    # images of a way are captured in sequences
+    sequence = way_idx * 4 + rng.integers(0, 4, n_imgs)
+    lon, lat = to_lonlat(xy[:, 0], xy[:, 1])
+    way_id = ways["id"][way_idx].copy()
+    way_id[is_unmatched] = None
+    return {
+        "img_id": 10**14 + rng.permutation(n_imgs).astype(np.int64),
+        "sequence_id": _object_array([f"seq_{s:010d}" for s in sequence.tolist()]),
+        "captured_at": rng.integers(1_400_000_000_000, 1_700_000_000_000, n_imgs),
+        "compass_angle": rng.uniform(0, 360, n_imgs),
+        "is_pano": rng.random(n_imgs) < 0.05,
+        "creator_id": rng.integers(10**11, 10**12, n_imgs),
+        "lon": lon,
+        "lat": lat,
+        "geom": shapely.points(xy),
+        "way_id": way_id,
+    }
+
+
+def classifications(imgs, ways, seed=0):
+    """Image classifications that are mostly consistent per way, such that most ways receive a prediction.
+
+    Args:
+        imgs (dict): images, see image_points
+        ways (dict): road network, see road_network
+
+    Returns:
+        dict: columns "img_id", "road_type_pred" (renamed, see
+        `rename_road_type_pred.sql`), "road_type_prob", "type_pred", "type_class_prob" and "quality_pred"
+    """
+    rng = np.random.default_rng(seed)
+    n = len(imgs["img_id"])
+    surface_of_way = rng.choice(np.array(SURFACE_TYPES, dtype=object), len(ways["id"]) + 1)
+    road_type_of_way = np.r_[ways["road_type"], None]
+    road_type_of_way[_is_none(road_type_of_way)] = "road"
+    # index len(ways) for unmatched images
+    way_idx = np.where(_is_none(imgs["way_id"]), 0, imgs["way_id"]).astype(np.int64) - 1
+    way_idx[way_idx < 0] = len(ways["id"])
+
+    type_pred = surface_of_way[way_idx]
+    deviates = rng.random(n) < 0.2
+    type_pred[deviates] = rng.choice(np.array(SURFACE_TYPES, dtype=object), deviates.sum())
+    road_type_pred = road_type_of_way[way_idx]
+    deviates = rng.random(n) < 0.1
+    road_type_pred[deviates] = "other"
+    quality_pred = rng.uniform(1, 5, n)
+    quality_pred[rng.random(n) < 0.05] = np.nan
+    return {
+        "img_id": imgs["img_id"].copy(),
+        "road_type_pred": road_type_pred.astype(object),
+        "road_type_prob": rng.uniform(0.4, 1, n),
+        "type_pred": type_pred.astype(object),
+        "type_class_prob": rng.uniform(0.4, 1, n),
+        "quality_pred": quality_pred,
+    }
+
+
+def _is_none(values):
+    return np.array([v is None for v in values.tolist()], dtype=bool)
+
+
+def tile_index(lon, lat, z):
+    """Fractional web mercator tile coordinates of points (the integer part is the tile x, y)."""
+    n = 2**z
+    x = (np.asarray(lon) + 180.0) / 360.0 * n
+    lat_rad = np.radians(lat)
+    y = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return x, y
+
+
+def vector_tiles(imgs, z=const.ZOOM, extent=4096):
+    """Encode the images as point features of Mapillary vector tiles (layer const.TILE_LAYER, properties
+    const.TILE_IMG_PROPERTIES), to be decoded by VectorTile.decode_point_layer.
+
+    Args:
+        imgs (dict): images, see image_points
+        z (int, optional): zoom level. Defaults to const.ZOOM.
+        extent (int, optional): tile extent. Defaults to 4096.
+
+    Returns:
+        dict: (x, y, z) -> tile content (bytes)
+    """
+    fx, fy = tile_index(imgs["lon"], imgs["lat"], z)
+    tx, ty = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+    px = np.minimum(np.round((fx - tx) * extent).astype(np.int64), extent - 1)
+    py = np.minimum(np.round((fy - ty) * extent).astype(np.int64), extent - 1)
+    properties = {
+        "id": imgs["img_id"],
+        "sequence_id": imgs["sequence_id"],
+        "captured_at": imgs["captured_at"],
+        "compass_angle": imgs["compass_angle"],
+        "is_pano": imgs["is_pano"],
+        "creator_id": imgs["creator_id"],
+    }
+    order = np.lexsort((ty, tx))
+    keys = np.column_stack([tx[order], ty[order]])
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    tiles = {}
+    for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+        idx = order[start:end]
+        tile = (int(tx[idx[0]]), int(ty[idx[0]]), z)
+        tiles[tile] = encode_point_layer(
+            const.TILE_LAYER,
+            px[idx].tolist(),
+            py[idx].tolist(),
+            {prop: values[idx].tolist() for prop, values in properties.items()},
+            extent,
+        )
+    return tiles
+
+
+def encode_point_layer(layer, px, py, properties, extent=4096):
+    """Minimal protobuf encoder of a vector tile with one layer of point features.
+
+    Args:
+        layer (str): layer name
+        px (list(int)): x positions of the points within the tile (0 to extent)
+        py (list(int)): y positions of the points within the tile (0 to extent, downwards)
+        properties (dict): property name -> list of values (int, float, bool or str) per point
+        extent (int, optional): tile extent. Defaults to 4096.
+
+    Returns:
+        bytes: the vector tile
+    """
+    keys = list(properties)
+    value_index = {}
+    values = []
+    features = []
+    columns = [properties[key] for key in keys]
+    for i in range(len(px)):
+        tags = []
+        for key_idx, column in enumerate(columns):
+            value = column[i]
+            # bool is a subclass of int, keep their value indices apart
+            value_key = (type(value), value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(_encode_value(value))
+            tags += [key_idx, value_index[value_key]]
+        geometry = [9, _zigzag(px[i]), _zigzag(py[i])]  # MoveTo(1)
+        features.append(
+            _field_bytes(2, _packed(tags))  # tags
+            + _field_varint(3, 1)  # type POINT
+            + _field_bytes(4, _packed(geometry))  # geometry
+        )
+    content = (
+        _field_varint(15, 2)  # version
+        + _field_bytes(1, layer.encode())
+        + b"".join(_field_bytes(2, feature) for feature in features)
+        + b"".join(_field_bytes(3, key.encode()) for key in keys)
+        + b"".join(_field_bytes(4, value) for value in values)
+        + _field_varint(5, extent)
+    )
+    return _field_bytes(3, content)
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _packed(values):
+    return b"".join(_varint(v) for v in values)
+
+
+def _field_varint(field, value):
+    return _varint(field << 3) + _varint(value)
+
+
+def _field_bytes(field, payload):
+    return _varint(field << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return _field_varint(7, int(value))
+    if isinstance(value, int):
+        return _field_varint(4, value & (2**64 - 1))  # int64
+    if isinstance(value, float):
+        return _varint(3 << 3 | 1) + struct.pack("<d", value)  # double
+    return _field_bytes(1, str(value).encode())
+
+
+def jpegs(n, seed=0, size=(1024, 768), quality=90):
+    """Street-level-like JPEGs (sky, road surface texture and lane markings), of the size of Mapillary
+    `thumb_1024_url` images as in `tests/test_data`.
+
+    Args:
+        n (int): number of images
+        seed (int, optional): random seed. Defaults to 0.
+        size (tuple, optional): width, height. Defaults to (1024, 768).
+        quality (int, optional): JPEG quality. Defaults to 90.
+
+    Returns:
+        list(bytes): JPEG contents
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    horizon = height // 2
+    rows = np.arange(height)[:, None, None]
+    contents = []
+    for _ in range(n):
+        sky = rng.uniform(140, 220, 3)
+        ground = rng.uniform(60, 140, 3)
+        img = np.where(
+            rows < horizon,
+            sky - rows / horizon * 40,
+            ground + rng.normal(0, 18, (height, width, 1)),
+        )
+        img = np.broadcast_to(img, (height, width, 3)).copy()
+        # lane marking converging at the horizon
+        lower = np.arange(horizon, height)
+        center = width / 2 + (lower - horizon) * rng.uniform(-0.3, 0.3)
+        half_width = 2 + (lower - horizon) * 0.02
+        columns = np.arange(width)[None, :]
+        is_marking = np.abs(columns - center[:, None]) < half_width[:, None]
+        img[horizon:][is_marking] = 235
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(
+            buffer, format="JPEG", quality=quality
+        )
+        contents.append(buffer.getvalue())
+    return contents
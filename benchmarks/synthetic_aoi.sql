@@ -0,0 +1,75 @@
+-- synthetic, matched and classified area of interest with {n_ways} parallel ways of 10 subsegments each
+SELECT setseed({seed});
+
+drop table if exists {name}_segmented_ways, {name}_partitions, {name}_img_metadata, {name}_img_classifications;
+
+CREATE TABLE {name}_segmented_ways AS
+SELECT
+    n AS segment_number,
+    (w || '_' || n) AS segment_id,
+    w::bigint AS id,
+    (ARRAY['road', 'footway', 'cycleway', 'path'])[1 + w % 4] AS road_type,
+    ST_SetSRID(ST_MakeLine(ST_MakePoint(n * 20, w * 50), ST_MakePoint((n + 1) * 20, w * 50)), {crs}) AS geom
+FROM generate_series(1, {n_ways}) AS w, generate_series(0, 9) AS n;
+
+CREATE INDEX {name}_segmented_ways_idx ON {name}_segmented_ways USING GIST(geom);
+
+-- every third road has a sidewalk partition
+CREATE TABLE {name}_partitions AS
+SELECT segment_id, road_type, geom, 1 AS part_id
+FROM {name}_segmented_ways;
+
+INSERT INTO {name}_partitions (segment_id, part_id, road_type, geom)
+SELECT segment_id, 2, 'footway', ST_OffsetCurve(geom, -5)
+FROM {name}_segmented_ways
+WHERE id % 3 = 0;
+
+CREATE INDEX {name}_partitions_segment_idx ON {name}_partitions (segment_id);
+
+-- images along the subsegments, 20% of the subsegments without images
+CREATE TABLE {name}_img_metadata AS
+SELECT
+    img.*,
+    ST_Distance(img.geom, seg.geom) AS dist,
+    CASE WHEN random() < 0.2 THEN 2 ELSE 1 END AS num_closeby_ways,
+    parts.part_ids,
+    parts.part_dists
+FROM (
+    SELECT
+        (seg.segment_id || '_' || k) AS img_id,
+        ('seq_' || seg.id) AS sequence_id,
+        (1600000000000 + k * 1000)::bigint AS captured_at,
+        seg.id AS way_id,
+        seg.segment_id,
+        ST_SetSRID(ST_MakePoint(seg.segment_number * 20 + random() * 20, seg.id * 50 + (random() - 0.5) * 12), {crs}) AS geom
+    FROM {name}_segmented_ways seg, generate_series(1, {imgs_per_segment}) AS k
+    WHERE hashtext(seg.segment_id) % 5 != 0
+) AS img
+JOIN {name}_segmented_ways seg
+ON seg.segment_id = img.segment_id
+CROSS JOIN LATERAL (
+    SELECT
+        array_agg(part.part_id ORDER BY part.part_id) AS part_ids,
+        array_agg(ST_Distance(part.geom, img.geom) ORDER BY part.part_id) AS part_dists
+    FROM {name}_partitions part
+    WHERE part.segment_id = img.segment_id
+) AS parts;
+
+CREATE INDEX {name}_img_metadata_idx ON {name}_img_metadata USING GIST(geom);
+
+-- mostly consistent predictions per road, so that roads receive a prediction
+CREATE TABLE {name}_img_classifications AS
+SELECT
+    img.img_id,
+    CASE WHEN random() < 0.8 THEN seg.road_type
+        ELSE (ARRAY['road', 'footway', 'cycleway', 'path', 'other'])[1 + floor(random() * 5)::int]
+    END AS road_type_pred,
+    random() AS road_type_prob,
+    CASE WHEN random() < 0.7 THEN (ARRAY['asphalt', 'concrete', 'paving_stones', 'sett', 'unpaved'])[1 + img.way_id % 5]
+        ELSE (ARRAY['asphalt', 'concrete', 'paving_stones', 'sett', 'unpaved'])[1 + floor(random() * 5)::int]
+    END AS type_pred,
+    random() AS type_class_prob,
+    1 + random() * 4 AS quality_pred
+FROM {name}_img_metadata img
+JOIN {name}_segmented_ways seg
+ON seg.segment_id = img.segment_id;
@@ -0,0 +1,209 @@
+"""Batch runner: process several areas of interest in one long-lived process.
+
+Compared to one `python src/main.py -c <config>` invocation per area of interest, the areas of interest share
+warm resources: torch and the models are loaded once (model registry), the database (connection pool and the
+check of the OSM import) and the Mapillary interface (HTTP client, image and tile caches) are set up once per
+distinct configuration. Images of overlapping areas of interest are classified once: their classifications
+are reused from the areas of interest processed before within the same database and with the same models.
+
+Usage:
+    python src/batch.py -c muenchen dresden osnabrueck neukoelln
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+## local modules
+import constants as const
+import main
+from modules import AreaOfInterest as area_of_interest_module
+from modules import Models as md
+
+# configuration keys that determine the image classifications of an area of interest
+CLASSIFICATION_PARAMS = [
+    "img_size",
+    "model_root",
+    "models",
+    "hf_model_repo",
+    "transform_surface",
+    "transform_road_type",
+    "inference_precision",
+    "calibration_imgs",
+]
+
+
+class SharedResources:
+    """Database, Mapillary interface and model interface shared by the areas of interest of a batch.
+    A resource is created on first use and reused by all areas of interest with the same configuration of it."""
+
+    def __init__(self):
+        self.databases = {}
+        self.mapillary_interfaces = {}
+
+    @staticmethod
+    def _key(cg, credentials, params):
+        values = {**cg, **credentials}
+        return json.dumps({key: values.get(key) for key in params}, sort_keys=True)
+
+    def database(self, cg, credentials):
+        key = self._key(cg, credentials, main.DATABASE_PARAMS)
+        if key not in self.databases:
+            self.databases[key] = main.setup_database(cg, credentials)
+        return self.databases[key]
+
+    def mapillary_interface(self, cg, credentials):
+        key = self._key(
+            cg,
+            credentials,
+            main.MAPILLARY_PARAMS
+            + ["img_cache_dir", "img_cache_max_bytes", "tile_cache_dir", "tile_cache_ttl"],
+        )
+        if key not in self.mapillary_interfaces:
+            self.mapillary_interfaces[key] = main.setup_mapillary(cg, credentials)
+        return self.mapillary_interfaces[key]
+
+    def classification_group(self, cg, credentials):
+        """Areas of interest of the same group can reuse each other's image classifications."""
+        return self._key(cg, credentials, main.DATABASE_PARAMS + CLASSIFICATION_PARAMS)
+
+    def close(self):
+        for mapillary_interface in self.mapillary_interfaces.values():
+            mapillary_interface.close()
+        for db in self.databases.values():
+            db.close()
+
+
+def run_batch(args):
+    """Process the areas of interest of all config files in `args.configfiles` one after another. A failing area
+    of interest is logged and reported, and the batch continues with the next one.
+
+    Returns:
+        list: throughput report, one dict per area of interest (with key `error` if it failed)
+    """
+    resources = SharedResources()
+    processed = {}  # classification group -> names of processed areas of interest
+    report = []
+    try:
+        for configfile in args.configfiles:
+            try:
+                report.append(process_config(args, configfile, resources, processed))
+            except Exception as e:
+                logging.exception(f"Area of interest {configfile} failed.")
+                report.append({"name": configfile, "error": str(e)})
+                continue
+            logging.info(f"Area of interest {report[-1]['name']}: {report[-1]}")
+    finally:
+        resources.close()
+    return report
+
+
+def process_config(args, configfile, resources, processed):
+    """Process the area of interest of a config file with the shared resources.
+
+    Returns:
+        dict: throughput of the area of interest
+    """
+    cg, credentials = main.get_config(configfile, main.root_path)
+    start = time.perf_counter()
+    if cg.get("shard_tiles") is not None:
+        # shards run in worker processes with their own resources
+        main.run_sharded_pipeline(args, cg, credentials)
+        return {"name": cg["name"], "seconds": time.perf_counter() - start}
+
+    # group before ModelInterface adds the normalization to the transforms
+    group = resources.classification_group(cg, credentials)
+    db = resources.database(cg, credentials)
+    mi = resources.mapillary_interface(cg, credentials)
+    aoi = area_of_interest_module.AreaOfInterest(cg)
+    model_interface = md.ModelInterface(cg)
+
+    logging.info(f"Process area of interest {aoi.name} ({configfile}).")
+    counts = main.process_area(
+        args,
+        db,
+        aoi,
+        mi,
+        model_interface,
+        shared_classifications=processed.get(group, []),
+    )
+    processed.setdefault(group, []).append(aoi.name)
+    main.results_to_files(aoi, db, args.export_results, args.export_img_predictions)
+
+    seconds = time.perf_counter() - start
+    n_imgs = db.execute_sql_query(
+        f"SELECT count(*) FROM {aoi.name}_img_metadata;",
+        is_file=False,
+        get_response=True,
+    )[0][0]
+    return {
+        "name": aoi.name,
+        "seconds": seconds,
+        "imgs": n_imgs,
+        **counts,
+        "imgs_per_second": n_imgs / seconds,
+        "classified_per_second": counts["classified"] / seconds,
+    }
+
+
+def log_report(report):
+    lines = [
+        f"{'area of interest':<20} {'seconds':>10} {'imgs':>10} {'classified':>10} {'reused':>10} {'imgs/s':>10}"
+    ]
+    for row in report:
+        if "error" in row:
+            lines.append(f"{row['name']:<20} failed: {row['error']}")
+            continue
+        if "imgs" not in row:
+            lines.append(f"{row['name']:<20} {row['seconds']:>10.1f} (sharded)")
+            continue
+        lines.append(
+            f"{row['name']:<20} {row['seconds']:>10.1f} {row['imgs']:>10} {row['classified']:>10} "
+            f"{row['reused']:>10} {row['imgs_per_second']:>10.1f}"
+        )
+    logging.info("Batch throughput:\n" + "\n".join(lines))
+    logging.info(f"Model registry: {md.model_registry.stats()}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="surfaceAI-batch")
+    parser.add_argument(
+        "-c", "--configfiles", nargs="+", required=True, help="Names of the configuration files in the configs folder, processed in the given order."
+    )
+    parser.add_argument(
+        "--recreate_roads", action=argparse.BooleanOptionalAction, default=False, help="If False, omit preprocessing or road segments if already present in database (to save time given multiple runs on the same area of interest)."
+    )
+    parser.add_argument(
+        "--query_images", action=argparse.BooleanOptionalAction, default=True, help="If False, skip classification of newly queried images and only use existing image classifications in database."
+    )
+    parser.add_argument(
+        "--export_results", action=argparse.BooleanOptionalAction, default=True, help="Export results to Shapefile"
+    )
+    parser.add_argument(
+        "--export_img_predictions", action=argparse.BooleanOptionalAction, default=False, help="Export single image predictions to Shapefile"
+    )
+    parser.add_argument(
+        "--force_stages", nargs="+", choices=const.PIPELINE_STAGES, default=[], help="Run these pipeline stages even if they are up to date."
+    )
+    parser.add_argument(
+        "--report_dir", help="Write a run report of the pipeline stages (<NAME>_run_report.json) and a Prometheus textfile (<NAME>.prom) to this folder."
+    )
+    parser.add_argument(
+        "--explain_analyze", action=argparse.BooleanOptionalAction, default=False, help="Add the EXPLAIN (ANALYZE, BUFFERS) query plans of the SQL scripts to the run report (statements are executed one by one)."
+    )
+    parser.add_argument(
+        "--report", help="Write the per area of interest throughput report to this JSON file."
+    )
+    args = parser.parse_args()
+
+    report = run_batch(args)
+    log_report(report)
+    if args.report is not None:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+    if any("error" in row for row in report):
+        sys.exit(1)
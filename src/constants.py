@@ -17,16 +17,98 @@ SQL_PREPARE_PARTITIONS = SQL_FOLDER / "prepare_partitions.sql"
 SQL_PREP_MODEL_RESULT = SQL_FOLDER / "prepare_model_result_insert.sql"
 SQL_RENAME_ROAD_TYPE_PRED = SQL_FOLDER / "rename_road_type_pred.sql"
 SQL_AGGREGATE_ON_ROADS = SQL_FOLDER / "aggregation_alg{}.sql"
+SQL_AGGREGATE_ON_ROADS_SET_BASED = SQL_FOLDER / "aggregation_set_based_alg{}.sql"
 SQL_SEPARATE_ROAD_TYPES = SQL_FOLDER / "separate_road_types.sql"
 SQL_SEPARATE_NULL_ROAD_TYPES = SQL_FOLDER / "separate_null_road_types.sql"
 SQL_CLEAN_SURFACE = SQL_FOLDER / "clean_surface.sql"
+SQL_CREATE_IMG_URL_TABLE = SQL_FOLDER / "create_img_url_table.sql"
+SQL_PERSIST_IMG_URLS = SQL_FOLDER / "persist_img_urls.sql"
+SQL_CREATE_IMG_METADATA_DELTA_TABLE = SQL_FOLDER / "create_img_metadata_delta_table.sql"
+SQL_CREATE_TILE_WATERMARKS_TABLE = SQL_FOLDER / "create_tile_watermarks_table.sql"
+SQL_MATCH_IMG_DELTA = SQL_FOLDER / "match_img_delta_to_segments.sql"
+SQL_SNAPSHOT_AGGREGATED_IMGS = SQL_FOLDER / "snapshot_aggregated_imgs.sql"
+SQL_PREPARE_DIRTY_AGGREGATION = SQL_FOLDER / "prepare_dirty_aggregation.sql"
+SQL_MERGE_DIRTY_AGGREGATION = SQL_FOLDER / "merge_dirty_aggregation.sql"
+SQL_DROP_DIRTY_AGGREGATION = SQL_FOLDER / "drop_dirty_aggregation.sql"
+SQL_CREATE_PIPELINE_STAGES_TABLE = SQL_FOLDER / "create_pipeline_stages_table.sql"
+SQL_SHARD_WAY_SELECTION = SQL_FOLDER / "shard_way_selection.sql"
+SQL_DROP_SHARD_CONTEXT_IMGS = SQL_FOLDER / "drop_shard_context_imgs.sql"
+SQL_CREATE_LOCAL_NETWORK_TABLES = SQL_FOLDER / "create_local_network_tables.sql"
+SQL_INDEX_LOCAL_NETWORK_TABLES = SQL_FOLDER / "index_local_network_tables.sql"
+SQL_CREATE_LOCAL_IMG_MATCHES_TABLE = SQL_FOLDER / "create_local_img_matches_table.sql"
+SQL_RENAME_LOCAL_IMG_MATCHES = SQL_FOLDER / "rename_local_img_matches.sql"
+SQL_CREATE_LOCAL_GROUP_PREDICTIONS_TABLE = (
+    SQL_FOLDER / "create_local_group_predictions_table.sql"
+)
+SQL_TRANSFORM_LOCAL_GROUP_PREDICTIONS = (
+    SQL_FOLDER / "transform_local_group_predictions.sql"
+)
 
 # Mapilary settings
 MAPILLARY_TILE_URL = "https://tiles.mapillary.com/maps/vtp/{}/2/{}/{}/{}"
 MAPILLARY_GRAPH_URL = "https://graph.mapillary.com/{}"
+MAPILLARY_GRAPH_BATCH_SIZE = 100  # image ids per Graph API request
+# responses that are retried with backoff: throttled or server errors
+MAPILLARY_RETRY_STATUSES = (429, 500, 502, 503, 504)
 TILE_COVERAGE = "mly1_public"
 TILE_LAYER = "image"  # "overview"
 ZOOM = 14
+DOWNLOAD_MODES = ["threads", "async"]
+IMG_METADATA_HEADER = [
+    "img_id",
+    "sequence_id",
+    "captured_at",
+    "compass_angle",
+    "is_pano",
+    "creator_id",
+    "lon",
+    "lat",
+]
+# image layer properties and their column types (decoded from vector tiles)
+TILE_IMG_PROPERTIES = {
+    "id": "int64",
+    "sequence_id": "object",
+    "captured_at": "int64",
+    "compass_angle": "float64",
+    "is_pano": "bool",
+    "creator_id": "int64",
+}
+
+# Aggregation engines: SQL script templates of the aggregation algorithm steps
+AGGREGATION_ENGINES = {
+    "sql": SQL_AGGREGATE_ON_ROADS,
+    "set_based": SQL_AGGREGATE_ON_ROADS_SET_BASED,
+}
+
+# stages of the pipeline (main.build_stage_graph), in processing order
+PIPELINE_STAGES = [
+    "way_selection",
+    "img_metadata",
+    "segments",
+    "matching",
+    "classification",
+    "aggregation",
+]
+
+# Processing engines of segmentation, partitioning, matching and aggregation:
+# PostGIS scripts or in-process with NumPy and Shapely (modules.LocalEngine)
+PROCESSING_ENGINES = ["postgis", "local"]
+# columns of the matched image metadata table (match_imgs_to_segments.sql)
+IMG_MATCH_HEADER = [
+    "img_id",
+    "sequence_id",
+    "captured_at",
+    "way_id",
+    "segment_id",
+    "geom",
+    "dist",
+    "num_closeby_ways",
+    "part_ids",
+    "part_dists",
+]
+
+# Classification pipeline stages
+CLASSIFICATION_STAGES = ["download", "preprocess", "inference", "db_write"]
 
 # Model settings
 EFFNET_LINEAR = "efficientNetV2SLinear"
@@ -35,3 +117,10 @@ CROP_LOWER_MIDDLE_HALF = "lower_middle_half"
 CROP_LOWER_HALF = "lower_half"
 NORM_MEAN = [0.42834484577178955, 0.4461250305175781, 0.4350937306880951]
 NORM_SD = [0.22991590201854706, 0.23555299639701843, 0.26348039507865906]
+QUALITY_SUB_BATCH_SIZE = 64  # max. images per surface quality model call with batch_buffers
+PREPROCESSING_ENGINES = ["transforms", "decode_once"]
+INFERENCE_BACKENDS = ["eager", "torchscript", "compile", "onnx"]
+INFERENCE_PRECISIONS = ["fp32", "bf16", "int8_dynamic", "int8_static"]
+QUANTIZATION_CALIBRATION_IMGS = 64  # max. images to calibrate int8_static
+INFERENCE_EXAMPLE_SIZE = 384  # input size of the backend example batch, if transform has no resize
+INFERENCE_PARITY_TOLERANCE = 1e-3  # max. difference of probabilities / regression values vs. eager
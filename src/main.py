@@ -1,74 +1,420 @@
 import argparse
+import concurrent.futures
 import json
 import logging
+import multiprocessing
 import os
+import time
 from pathlib import Path
 
 ## local modules
 import constants as const
-from modules import AreaOfInterest as aoi
+from modules import AreaOfInterest as area_of_interest_module
+from modules import ImageCache as ic
+from modules import Instrumentation as ins
 from modules import MapillaryInterface as mi
 from modules import Models as md
+from modules import StageGraph as sg
 from modules import SurfaceDatabase as sd
+from modules import TileCache as tc
+
+root_path = Path(os.path.abspath(__file__)).parent.parent
+
+# configuration (and credential) keys passed on to MapillaryInterface and SurfaceDatabase
+MAPILLARY_PARAMS = [
+    "mapillary_token",
+    "parallel",
+    "parallel_batch_size",
+    "download_mode",
+    "max_in_flight",
+    "http2",
+    "graph_batch_size",
+    "offline",
+    "tile_url",
+    "graph_url",
+    "retry_backoff",
+]
+DATABASE_PARAMS = [
+    "dbname",
+    "dbuser",
+    "dbpassword",
+    "dbhost",
+    "dbport",
+    "dbpool_size",
+    "pbf_folder",
+    "osm_region",
+    "road_network_path",
+    "sql_custom_way_prep",
+]
 
 
 def run_pipeline(args, root_path):
     cg, credentials = get_config(args.configfile, root_path)
+    if cg.get("shard_tiles") is not None:
+        run_sharded_pipeline(args, cg, credentials)
+        return
+
     db, aoi, mi, md = setup_pipeline(cg, credentials)
+    process_area(args, db, aoi, mi, md)
+
+    results_to_files(aoi, db, args.export_results, args.export_img_predictions)
+    db.close()
+
+
+def create_way_selection(db, aoi):
+    logging.info("Create road segments in bounding box.")
+    query_path = (
+        const.SQL_WAY_SELECTION if db.osm_region else const.SQL_WAY_SELECTION_CUSTOM
+    )
+    db.execute_sql_query(query_path, aoi.query_params)
 
-    has_img_metadata = db.table_exists(f"{aoi.name}_img_metadata")
-    if (not has_img_metadata) or args.query_images:
-        logging.info(f"query img metadata and store in database {db.dbname}")
-        aoi.get_and_write_img_metadata(mi, db)
-    else:
-        logging.info(
-            "Configured to not query new image metadata. Skip image metadata download."
-        )
 
+def select_ways(args, db, aoi):
+    """Select the ways within the bounding box, unless they exist and are not to be recreated.
+
+    Returns:
+        bool: whether the ways were (re)created
+    """
     has_road_seg_table = db.table_exists(f"{aoi.name}_way_selection")
     if (not has_road_seg_table) or args.recreate_roads:
-        logging.info("Create road segments in bounding box.")
-        query_path = (
-            const.SQL_WAY_SELECTION if db.osm_region else const.SQL_WAY_SELECTION_CUSTOM
+        create_way_selection(db, aoi)
+        return True
+    logging.info("Previous road segments found. Skip road segment creation.")
+    return False
+
+
+def process_area(args, db, aoi, mi, md, roads_recreated=None, shared_classifications=()):
+    """Way selection, image metadata, subsegments, matching, classification and aggregation of an area of interest.
+    Stages that are up to date are skipped (see build_stage_graph).
+
+    Args:
+        roads_recreated (bool, optional): whether the ways of a shard were (re)created by
+            AreaOfInterest.create_shards. Defaults to None, i.e., the ways are selected by the pipeline.
+        shared_classifications (list, optional): names of areas of interest in the same database, whose image
+            classifications (of the same models) are reused instead of classifying the images again.
+
+    Returns:
+        dict: number of classified and reused images
+    """
+    instrumentation = ins.Instrumentation(
+        aoi.name, db, mi, explain_analyze=getattr(args, "explain_analyze", False)
+    )
+    graph = build_stage_graph(
+        args, db, aoi, mi, md, roads_recreated, shared_classifications, instrumentation
+    )
+    try:
+        results = graph.run()
+    finally:
+        db.instrumentation = None
+        instrumentation.log_summary()
+        if getattr(args, "report_dir", None) is not None:
+            instrumentation.write(args.report_dir)
+    return results.get("classification", {"classified": 0, "reused": 0})
+
+
+def build_stage_graph(
+    args,
+    db,
+    aoi,
+    mi,
+    md,
+    roads_recreated=None,
+    shared_classifications=(),
+    instrumentation=None,
+):
+    """The pipeline as StageGraph. Each stage records a fingerprint of its parameters, SQL scripts and upstream
+    outputs in `{name}_pipeline_stages`, such that reruns skip stages whose inputs are unchanged and an
+    interrupted run resumes with the first incomplete stage.
+
+    Returns:
+        StageGraph: the stages of the pipeline
+    """
+    graph = sg.StageGraph(
+        db,
+        aoi.name,
+        force=getattr(args, "force_stages", None) or [],
+        instrumentation=instrumentation,
+    )
+    params = aoi.query_params
+    osm = db.osm_region is not None
+
+    if roads_recreated is None:
+        graph.add(
+            sg.PipelineStage(
+                "way_selection",
+                lambda: create_way_selection(db, aoi),
+                params={
+                    **{key: params[key] for key in ["bbox0", "bbox1", "bbox2", "bbox3", "crs"]},
+                    "osm_region": db.osm_region,
+                    "road_network_path": db.road_network_path,
+                    "sql_custom_way_prep": db.sql_custom_way_prep,
+                },
+                outputs=[f"{aoi.name}_way_selection"],
+                scripts=[const.SQL_WAY_SELECTION if osm else const.SQL_WAY_SELECTION_CUSTOM],
+                policy="always" if args.recreate_roads else "stale",
+            )
         )
-        db.execute_sql_query(query_path, aoi.query_params)
     else:
-        logging.info("Previous road segments found. Skip road segment creation.")
-
-    logging.info(f"Cut lines into subsegments of length {aoi.segment_length}.")
-    db.execute_sql_query(const.SQL_SEGMENT_WAYS, aoi.query_params)
+        # ways of a shard are selected by AreaOfInterest.create_shards, within its cell
+        graph.add(
+            sg.PipelineStage(
+                "way_selection",
+                lambda: None,
+                params={"shard_cell": aoi.shard_cell},
+                outputs=[f"{aoi.name}_way_selection"],
+                policy="always" if roads_recreated else "stale",
+            )
+        )
 
-    logging.info("Match images to subsegments.")
-    db.execute_sql_query(const.SQL_MATCH_IMG_ROADS, aoi.query_params)
+    def img_metadata():
+        logging.info(f"query img metadata and store in database {db.dbname}")
+        match_mode = aoi.get_and_write_img_metadata(mi, db)
+        if mi.tile_cache is not None:
+            logging.info(f"Tile cache: {mi.tile_cache.stats()}")
+        return match_mode
 
-    ##### classify images
     if args.query_images:
-        logging.info("Classify images")
-        aoi.classify_images(mi, db, md)
-    else:
-        logging.info(
-            "Only use existing image classifications. Skip classification step."
+        # load models in the background while image metadata is queried
+        md.preload_models()
+    graph.add(
+        sg.PipelineStage(
+            "img_metadata",
+            img_metadata,
+            params={
+                **{key: params[key] for key in ["bbox0", "bbox1", "bbox2", "bbox3"]},
+                "use_pano": aoi.use_pano,
+                "userid": aoi.userid,
+                "incremental_metadata": aoi.incremental_metadata,
+            },
+            outputs=[f"{aoi.name}_img_metadata"],
+            # new images are only queried if configured (query_images)
+            policy="always" if args.query_images else "missing",
+            digest=lambda: img_metadata_digest(db, aoi),
         )
-    db.execute_sql_query(const.SQL_RENAME_ROAD_TYPE_PRED, aoi.query_params)
+    )
 
+    def segments():
+        logging.info(f"Cut lines into subsegments of length {aoi.segment_length}.")
+        if aoi.processing_engine == "local":
+            # subsegments and partitions are computed in-process and written to the same tables
+            aoi.segment_ways_local(db, osm=osm)
+            return
+        db.execute_sql_query(const.SQL_SEGMENT_WAYS, params)
+
+        # partitions are created before matching, as distances to partitions are computed during matching
+        db.execute_sql_query(const.SQL_PREPARE_PARTITIONS, params)
+        if osm:
+            logging.info("Create partitions for each road type of a road segment.")
+            db.execute_sql_query(const.SQL_SEPARATE_ROAD_TYPES, params)
+        else:
+            db.execute_sql_query(const.SQL_SEPARATE_NULL_ROAD_TYPES, params)
+            logging.info(
+                "Custom road network - create cycleway and sidewalk partitions for all null valued roads."
+            )
+
+    graph.add(
+        sg.PipelineStage(
+            "segments",
+            segments,
+            params={
+                "segment_length": aoi.segment_length,
+                "min_road_length": aoi.min_road_length,
+                "additional_id_column": aoi.additional_id_column,
+                "processing_engine": aoi.processing_engine,
+                "osm": osm,
+            },
+            upstream=["way_selection"],
+            outputs=[f"{aoi.name}_segmented_ways", f"{aoi.name}_partitions"],
+            scripts=[
+                const.SQL_SEGMENT_WAYS,
+                const.SQL_PREPARE_PARTITIONS,
+                const.SQL_SEPARATE_ROAD_TYPES if osm else const.SQL_SEPARATE_NULL_ROAD_TYPES,
+            ],
+        )
+    )
 
-    db.execute_sql_query(const.SQL_PREPARE_PARTITIONS, aoi.query_params)
-    if db.osm_region is not None:  # is OSM file?
-        logging.info("Create partitions for each road type of a road segment.")
-        db.execute_sql_query(const.SQL_SEPARATE_ROAD_TYPES, aoi.query_params)
-    else:
-        db.execute_sql_query(const.SQL_SEPARATE_NULL_ROAD_TYPES, aoi.query_params)
-        logging.info(
-            "Custom road network - create cycleway and sidewalk partitions for all null valued roads."
+    def matching():
+        is_delta = db.table_exists(f"{aoi.name}_img_metadata_delta")
+        if is_delta:
+            logging.info("Match new images to subsegments.")
+            db.execute_sql_query(const.SQL_MATCH_IMG_DELTA, params)
+        if not is_delta or "segments" in graph.ran:
+            # new subsegments invalidate all matches
+            logging.info("Match images to subsegments.")
+            if aoi.processing_engine == "local":
+                aoi.match_imgs_local(db)
+            else:
+                db.execute_sql_query(const.SQL_MATCH_IMG_ROADS, params)
+        if aoi.shard:
+            # images closest to ways of neighbouring shards are classified there
+            db.execute_sql_query(const.SQL_DROP_SHARD_CONTEXT_IMGS, params)
+
+    graph.add(
+        sg.PipelineStage(
+            "matching",
+            matching,
+            params={
+                "dist_from_road": aoi.dist_from_road,
+                "processing_engine": aoi.processing_engine,
+                "shard": aoi.shard,
+            },
+            upstream=["segments", "img_metadata"],
+            outputs=[f"{aoi.name}_img_metadata"],
+            scripts=[
+                const.SQL_MATCH_IMG_ROADS,
+                const.SQL_MATCH_IMG_DELTA,
+                const.SQL_DROP_SHARD_CONTEXT_IMGS,
+            ],
+            # (re)created image metadata or new images of an incremental harvest are not matched yet
+            complete=lambda: db.column_exists(f"{aoi.name}_img_metadata", "part_dists")
+            and not db.table_exists(f"{aoi.name}_img_metadata_delta"),
+            digest=lambda: db.execute_sql_query(
+                f"SELECT count(*), max(captured_at), sum(dist) FROM {aoi.name}_img_metadata;",
+                is_file=False,
+                get_response=True,
+            )[0],
+        )
+    )
+
+    def classification():
+        counts = {"classified": 0, "reused": 0}
+        if shared_classifications:
+            counts["reused"] = aoi.reuse_classifications(db, shared_classifications)
+            logging.info(
+                f"Reuse {counts['reused']} image classifications of {', '.join(shared_classifications)}"
+            )
+        logging.info("Classify images")
+        counts["classified"] = aoi.classify_images(mi, db, md)
+        logging.info(f"Model registry: {md.registry.stats()}")
+        if mi.image_cache is not None:
+            logging.info(f"Image cache: {mi.image_cache.stats()}")
+        return counts
+
+    if not args.query_images:
+        logging.info("Only use existing image classifications. Skip classification step.")
+    graph.add(
+        sg.PipelineStage(
+            "classification",
+            classification,
+            params={
+                "img_size": aoi.img_size,
+                "models": md.models,
+                "model_root": md.model_root,
+                "hf_model_repo": md.hf_model_repo,
+                # reduced precisions change the classifications, fp32 keeps earlier fingerprints valid
+                **(
+                    {"inference_precision": md.inference_precision}
+                    if md.inference_precision != "fp32"
+                    else {}
+                ),
+            },
+            upstream=["matching"],
+            outputs=[f"{aoi.name}_img_classifications"],
+            policy="stale" if args.query_images else "never",
+            # images without classification, e.g., after an interrupted classification
+            complete=lambda: not db.execute_sql_query(
+                f"""SELECT EXISTS (
+                    SELECT 1 FROM {aoi.name}_img_metadata img
+                    LEFT JOIN {aoi.name}_img_classifications res ON img.img_id = res.img_id
+                    WHERE res.img_id IS NULL
+                );""",
+                is_file=False,
+                get_response=True,
+            )[0][0],
+            digest=lambda: db.execute_sql_query(
+                f"SELECT count(*) FROM {aoi.name}_img_classifications;",
+                is_file=False,
+                get_response=True,
+            )[0],
+        )
+    )
+
+    def aggregation():
+        db.execute_sql_query(const.SQL_RENAME_ROAD_TYPE_PRED, params)
+        logging.info("Aggregate by road segment.")
+        aoi.aggregate_on_roads(db, full="segments" in graph.ran)
+
+    graph.add(
+        sg.PipelineStage(
+            "aggregation",
+            aggregation,
+            params={
+                "segments_per_group": aoi.segments_per_group,
+                "aggregation_engine": aoi.aggregation_engine,
+                "processing_engine": aoi.processing_engine,
+                "incremental_aggregation": aoi.incremental_aggregation,
+            },
+            upstream=["segments", "matching", "classification"],
+            outputs=[f"{aoi.name}_group_predictions"],
+            scripts=[
+                const.SQL_RENAME_ROAD_TYPE_PRED,
+                *[
+                    str(const.AGGREGATION_ENGINES[aoi.aggregation_engine]).format(alg)
+                    for alg in [1, 2, 3]
+                ],
+            ],
         )
+    )
+    return graph
+
+
+def img_metadata_digest(db, aoi):
+    # new images of an incremental harvest are kept in {name}_img_metadata_delta until they are matched
+    tables = [f"{aoi.name}_img_metadata", f"{aoi.name}_img_metadata_delta"]
+    return [
+        db.execute_sql_query(
+            f"SELECT count(*), max(captured_at) FROM {table};",
+            is_file=False,
+            get_response=True,
+        )[0]
+        for table in tables
+        if db.table_exists(table)
+    ]
+
+
+def run_sharded_pipeline(args, cg, credentials):
+    """Split the area of interest into shards aligned to the zoom-14 tile grid and process them in parallel
+    worker processes, each with its own table namespace `{name}_s{k}`. Shard results are merged into the
+    tables of the area of interest."""
+    db = setup_database(cg, credentials)
+    aoi = area_of_interest_module.AreaOfInterest(cg)
+    roads_recreated = select_ways(args, db, aoi)
+    shards = aoi.create_shards(db)
+    logging.info(
+        f"Process {len(shards)} shards with {aoi.shard_workers} worker processes."
+    )
 
-    logging.info("Aggregate by road segment.")
-    # split into three scripts for faster execution
-    db.execute_sql_query(str(const.SQL_AGGREGATE_ON_ROADS).format(1), aoi.query_params)
-    db.execute_sql_query(str(const.SQL_AGGREGATE_ON_ROADS).format(2), aoi.query_params)
-    db.execute_sql_query(str(const.SQL_AGGREGATE_ON_ROADS).format(3), aoi.query_params)
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=aoi.shard_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        futures = [
+            executor.submit(run_shard, args, shard_cg, credentials, roads_recreated)
+            for shard_cg in shards
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            logging.info(
+                f"Shard {future.result()} done after {time.perf_counter() - start:.0f} s."
+            )
 
+    logging.info("Merge shard results.")
+    aoi.merge_shards(db, [shard_cg["name"] for shard_cg in shards])
     results_to_files(aoi, db, args.export_results, args.export_img_predictions)
+    db.close()
+
+
+def run_shard(args, cg, credentials, roads_recreated):
+    # entry point of a worker process
+    logging.basicConfig(
+        format=f"%(levelname)s:{cg['name']}:%(message)s", level=logging.INFO
+    )
+    db, aoi, mi, md = setup_pipeline(cg, credentials)
+    try:
+        process_area(args, db, aoi, mi, md, roads_recreated)
+    finally:
+        db.close()
+    return aoi.name
 
 
 def get_config(configfile, root_path):
@@ -93,36 +439,39 @@ def get_config(configfile, root_path):
 
 
 def setup_pipeline(cg, credentials):
+    mapillary_interface = setup_mapillary(cg, credentials)
+    area_of_interest = area_of_interest_module.AreaOfInterest(cg)
+    model_interface = md.ModelInterface(cg)
+    surface_database = setup_database(cg, credentials)
+
+    return surface_database, area_of_interest, mapillary_interface, model_interface
+
+
+def setup_mapillary(cg, credentials):
     mi_params = {
         key: value
         for key, value in {**cg, **credentials}.items()
-        if key in ["mapillary_token", "parallel", "parallel_batch_size"]
+        if key in MAPILLARY_PARAMS
     }
-    mapillary_interface = mi.MapillaryInterface(**mi_params)
+    if cg.get("img_cache_dir") is not None:
+        mi_params["image_cache"] = ic.ImageCache(
+            cg["img_cache_dir"], cg.get("img_cache_max_bytes")
+        )
+    if cg.get("tile_cache_dir") is not None:
+        mi_params["tile_cache"] = tc.TileCache(
+            cg["tile_cache_dir"], cg.get("tile_cache_ttl", 86400)
+        )
+    return mi.MapillaryInterface(**mi_params)
 
-    area_of_interest = aoi.AreaOfInterest(cg)
-    model_interface = md.ModelInterface(cg)
 
+def setup_database(cg, credentials):
     # only pass on provided parameters - for missing values set SurfaceDatabase defaults
     sd_params = {
         key: value
         for key, value in {**cg, **credentials}.items()
-        if key
-        in [
-            "dbname",
-            "dbuser",
-            "dbpassword",
-            "dbhost",
-            "dbport",
-            "pbf_folder",
-            "osm_region",
-            "road_network_path",
-            "sql_custom_way_prep",
-        ]
+        if key in DATABASE_PARAMS
     }
-    surface_database = sd.SurfaceDatabase(**sd_params)
-
-    return surface_database, area_of_interest, mapillary_interface, model_interface
+    return sd.SurfaceDatabase(**sd_params)
 
 
 def results_to_files(area_of_interest, surface_database, export_results, export_img_predictions):
@@ -162,10 +511,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "--export_img_predictions", action=argparse.BooleanOptionalAction, default=False, help="Export single image predictions to Shapefile"
     )
+    parser.add_argument(
+        "--force_stages", nargs="+", choices=const.PIPELINE_STAGES, default=[], help="Run these pipeline stages even if they are up to date."
+    )
+    parser.add_argument(
+        "--report_dir", help="Write a run report of the pipeline stages (<NAME>_run_report.json) and a Prometheus textfile (<NAME>.prom) to this folder."
+    )
+    parser.add_argument(
+        "--explain_analyze", action=argparse.BooleanOptionalAction, default=False, help="Add the EXPLAIN (ANALYZE, BUFFERS) query plans of the SQL scripts to the run report (statements are executed one by one)."
+    )
     args = parser.parse_args()
 
-    root_path = Path(os.path.abspath(__file__)).parent.parent
-
     run_pipeline(args, root_path)
 
     # surface_database.remove_temp_tables(area_of_interest.name)
@@ -1,10 +1,11 @@
+import concurrent.futures
 import logging
 import os
+import re
 import sys
 from pathlib import Path
 
 import mercantile
-import numpy as np
 
 # local modules
 src_dir = Path(os.path.abspath(__file__)).parent.parent
@@ -12,6 +13,14 @@ sys.path.append(str(src_dir))
 from tqdm import tqdm
 
 import constants as const
+from modules.Instrumentation import interval_peak_rss
+from modules.LocalEngine import (
+    OSM_PARTITION_TAGS,
+    LocalEngine,
+    columns_from_rows,
+    rows_from_columns,
+)
+from modules.StagedPipeline import Stage, StagedPipeline
 
 
 class AreaOfInterest:
@@ -36,6 +45,28 @@ class AreaOfInterest:
                 - segment_length (int, optional): Length of subsegments for aggregation algorithm.
                 - segments_per_group (int, optional): Number of segments per group.
                 - additional_id_column (str, optional): Additional column to use as an ID for custom road networks. Defaults to None.
+                - pipeline_depth (dict, optional): Maximum number of batches queued in front of each classification stage
+                  (keys: download, preprocess, inference, db_write). Defaults to 2 per stage.
+                - download_workers (int, optional): Number of batches downloaded concurrently. Defaults to 1.
+                - persist_img_urls (bool, optional): Store resolved image urls in the table `{name}_img_urls`, which
+                  is kept across runs. Defaults to False.
+                - tile_workers (int, optional): Number of vector tiles requested concurrently for image metadata. Defaults to 8.
+                - incremental_metadata (bool, optional): Only add images captured after the last metadata harvest
+                  (per tile), instead of reloading all image metadata. Defaults to False.
+                - incremental_aggregation (bool, optional): Only re-aggregate ways with new or changed image
+                  classifications since the last aggregation. Defaults to False.
+                - aggregation_engine (str, optional): Implementation of the aggregation algorithm, one of
+                  const.AGGREGATION_ENGINES. Defaults to "sql".
+                - processing_engine (str, optional): Implementation of segmentation, partitioning, image matching and
+                  aggregation, one of const.PROCESSING_ENGINES: "postgis" (SQL scripts) or "local" (in-process
+                  with NumPy and Shapely, see modules.LocalEngine). Defaults to "postgis".
+                - shard_tiles (int, optional): Split the bounding box into shards of shard_tiles x shard_tiles
+                  zoom-14 tiles, processed in parallel (see create_shards). Defaults to None (no sharding).
+                - shard_workers (int, optional): Number of shards processed concurrently. Defaults to 2.
+                - shard (bool, optional): Whether this area of interest is a shard of a larger area of interest,
+                  set by create_shards. Defaults to False.
+                - shard_cell (list, optional): (west, south, east, north) of the cell of a shard, set by
+                  create_shards. Defaults to None.
         """
 
         # TODO: verify config inputs
@@ -66,6 +97,42 @@ class AreaOfInterest:
 
         # customizations
         self.additional_id_column = config.get("additional_id_column", None)
+
+        # classification pipeline
+        self.pipeline_depth = {
+            **{stage: 2 for stage in const.CLASSIFICATION_STAGES},
+            **config.get("pipeline_depth", {}),
+        }
+        self.download_workers = config.get("download_workers", 1)
+        self.persist_img_urls = config.get("persist_img_urls", False)
+        self.tile_workers = config.get("tile_workers", 8)
+        self.incremental_metadata = config.get("incremental_metadata", False)
+        self.incremental_aggregation = config.get("incremental_aggregation", False)
+        self.aggregation_engine = config.get("aggregation_engine", "sql")
+        if self.aggregation_engine not in const.AGGREGATION_ENGINES:
+            raise ValueError(
+                f"Invalid aggregation_engine {self.aggregation_engine}, options: {list(const.AGGREGATION_ENGINES)}"
+            )
+        self.processing_engine = config.get("processing_engine", "postgis")
+        if self.processing_engine not in const.PROCESSING_ENGINES:
+            raise ValueError(
+                f"Invalid processing_engine {self.processing_engine}, options: {const.PROCESSING_ENGINES}"
+            )
+        if self.processing_engine == "local" and (
+            self.incremental_metadata or self.incremental_aggregation
+        ):
+            raise ValueError(
+                "incremental_metadata and incremental_aggregation require processing_engine postgis"
+            )
+        self._local_network = None  # subsegments and partitions of the local processing engine
+        self.batch_memory = []  # per classified batch: images and peak RSS
+        self.shard_tiles = config.get("shard_tiles", None)
+        if self.shard_tiles is not None and self.shard_tiles < 1:
+            raise ValueError(f"Invalid shard_tiles {self.shard_tiles}, options: None or >= 1")
+        self.shard_workers = config.get("shard_workers", 2)
+        self.shard = config.get("shard", False)
+        self.shard_cell = config.get("shard_cell", None)
+
         self.query_params = self._get_query_params()
 
     def _get_query_params(self):
@@ -104,37 +171,145 @@ class AreaOfInterest:
         }
 
     def get_and_write_img_metadata(self, mi, db):
-        # get all relevant tile ids
-        db.execute_sql_query(const.SQL_CREATE_IMG_METADATA_TABLE, self.query_params)
+        """Query the image metadata of all tiles within the bounding box and write it to the database.
+
+        With `incremental_metadata`, the most recent capture time of each tile is kept in `{name}_tile_watermarks`.
+        If the image metadata has been harvested and matched before, only images captured after the watermark
+        of their tile are written to `{name}_img_metadata_delta`, to be matched and merged by `SQL_MATCH_IMG_DELTA`.
 
+        Args:
+            mi (MapillaryInterface): interface to the Mapillary API
+            db (SurfaceDatabase): database
+
+        Returns:
+            str: "delta" if only new images were written, "full" if `{name}_img_metadata` was recreated
+        """
+        is_delta = self.incremental_metadata and self.img_metadata_is_matched(db)
+        if is_delta:
+            db.execute_sql_query(
+                const.SQL_CREATE_IMG_METADATA_DELTA_TABLE, self.query_params
+            )
+            table = f"{self.name}_img_metadata_delta"
+            watermarks = {
+                (x, y, z): captured_at
+                for x, y, z, captured_at in db.execute_sql_query(
+                    f"SELECT x, y, z, captured_at FROM {self.name}_tile_watermarks;",
+                    is_file=False,
+                    get_response=True,
+                )
+            }
+        else:
+            db.execute_sql_query(const.SQL_CREATE_IMG_METADATA_TABLE, self.query_params)
+            table = f"{self.name}_img_metadata"
+            watermarks = {}
+
+        # get all relevant tile ids
         tiles = list(
             mercantile.tiles(
                 self.minLon, self.minLat, self.maxLon, self.maxLat, const.ZOOM
             )
         )
 
-        for i in tqdm(range(0, len(tiles))):
-            # TODO: parallellize?
-            tile = tiles[i]
-            header, output = mi.metadata_in_tile(tile)
-            rows = np.array(output)
-            if len(rows) == 0:
-                continue
-            rows = rows[
-                (rows[:, header.index("lon")].astype(float) >= self.minLon)
-                & (rows[:, header.index("lon")].astype(float) <= self.maxLon)
-                & (rows[:, header.index("lat")].astype(float) >= self.minLat)
-                & (rows[:, header.index("lat")].astype(float) <= self.maxLat)
-            ]
-            if not self.use_pano and len(rows) > 0:
-                rows = rows[rows[:, header.index("is_pano")] == "False"]
-            if self.userid and len(rows) > 0:
-                rows = rows[rows[:, header.index("creator_id")] == self.userid]
-            if len(rows) > 0:
-                db.add_rows_to_table(f"{self.name}_img_metadata", header, rows)
+        # tiles are requested concurrently, rows are written to the database as tiles arrive
+        new_watermarks = []
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.tile_workers
+        ) as executor:
+            futures = {
+                executor.submit(mi.metadata_columns_in_tile, tile): tile
+                for tile in tiles
+            }
+            for future in tqdm(
+                concurrent.futures.as_completed(futures), total=len(futures)
+            ):
+                tile = futures[future]
+                watermark = self._write_tile_metadata(
+                    db, future.result(), table, watermarks.get(tuple(tile))
+                )
+                if watermark is not None:
+                    new_watermarks.append((*tile, watermark))
+
+        if is_delta:
+            # merged into {name}_tile_watermarks together with the images
+            db.add_rows_to_table(
+                f"{self.name}_tile_watermarks_delta",
+                ["x", "y", "z", "captured_at"],
+                new_watermarks,
+            )
+            return "delta"
+
         db.execute_sql_query(const.SQL_ADD_GEOM_COLUMN, self.query_params)
+        if self.incremental_metadata:
+            db.execute_sql_query(
+                const.SQL_CREATE_TILE_WATERMARKS_TABLE, self.query_params
+            )
+            db.add_rows_to_table(
+                f"{self.name}_tile_watermarks",
+                ["x", "y", "z", "captured_at"],
+                new_watermarks,
+            )
+        return "full"
+
+    def img_metadata_is_matched(self, db):
+        """Whether `{name}_img_metadata` holds images matched to road segments (by `SQL_MATCH_IMG_ROADS`),
+        with tile watermarks to refresh them incrementally.
+
+        Args:
+            db (SurfaceDatabase): database
+
+        Returns:
+            bool: True if the image metadata can be refreshed incrementally
+        """
+        return (
+            db.table_exists(f"{self.name}_tile_watermarks")
+            and db.table_exists(f"{self.name}_img_metadata")
+            and db.column_exists(f"{self.name}_img_metadata", "part_dists")
+        )
+
+    def filter_img_metadata(self, columns):
+        """Vectorized filter of image metadata columns: keep images within the bounding box,
+        exclude panoramic images (unless use_pano) and images of other users (if userid is set).
+
+        Args:
+            columns (dict): column name -> np.ndarray, see MapillaryInterface.metadata_columns_in_tile
+
+        Returns:
+            np.ndarray: boolean mask of images to keep
+        """
+        lon = columns["lon"]
+        lat = columns["lat"]
+        mask = (
+            (lon >= self.minLon)
+            & (lon <= self.maxLon)
+            & (lat >= self.minLat)
+            & (lat <= self.maxLat)
+        )
+        if not self.use_pano:
+            mask &= ~columns["is_pano"]
+        if self.userid:
+            mask &= columns["creator_id"] == int(self.userid)
+        return mask
+
+    def _write_tile_metadata(self, db, columns, table, watermark=None):
+        # returns the most recent capture time within the tile
+        if columns is None or len(columns["img_id"]) == 0:
+            return watermark
+        mask = self.filter_img_metadata(columns)
+        if watermark is not None:
+            mask &= columns["captured_at"] > watermark
+        if mask.any():
+            header = const.IMG_METADATA_HEADER
+            rows = list(zip(*[columns[h][mask].tolist() for h in header]))
+            db.add_rows_to_table(table, header, rows)
+        latest = int(columns["captured_at"].max())
+        return latest if watermark is None else max(latest, watermark)
 
     def classify_images(self, mi, db, md):
+        """Download and classify all images of `{name}_img_metadata` without classification.
+
+        Returns:
+            int: number of images to classify
+        """
         img_ids = db.img_ids_from_dbtable(f"{self.name}_img_metadata")
         if db.table_exists(f"{self.name}_img_classifications"):
             existing_img_ids = db.img_ids_from_dbtable(
@@ -144,35 +319,529 @@ class AreaOfInterest:
             img_ids = list(set(img_ids) - set(existing_img_ids))
 
         db.execute_sql_query(const.SQL_PREP_MODEL_RESULT, self.query_params)
+        img_urls = (
+            self.resolve_img_urls(mi, db, img_ids) if self.persist_img_urls else None
+        )
 
-        for i in tqdm(
-            range(0, len(img_ids), md.batch_size),
-            desc=f"Download and classify {len(img_ids)} images",
-        ):
-            j = min(i + md.batch_size, len(img_ids))
+        header = [
+            "img_id",
+            "road_type_pred",
+            "road_type_prob",
+            "type_pred",
+            "type_class_prob",
+            "quality_pred",
+        ]
+        batches = [
+            img_ids[i : i + md.batch_size] for i in range(0, len(img_ids), md.batch_size)
+        ]
+        progress = tqdm(
+            total=len(batches), desc=f"Download and classify {len(img_ids)} images"
+        )
 
-            img_data = mi.query_imgs(
-                img_ids[i:j],
+        def download(batch_img_ids):
+            known_urls = (
+                {} if img_urls is None else {str(i): img_urls.get(str(i)) for i in batch_img_ids}
+            )
+            # encoded images: decoded one by one in preprocessing (or by the preprocessing workers)
+            downloaded = mi.query_imgs(
+                batch_img_ids,
                 self.img_size,
+                return_ids=True,
+                img_urls=img_urls,
+                decode=False,
             )
-            model_output = md.batch_classifications(img_data)
+            if img_urls is not None:
+                # urls resolved again after failed downloads (see MapillaryInterface.query_imgs)
+                self._persist_img_urls(
+                    db,
+                    {
+                        img_id: img_urls[img_id]
+                        for img_id, url in known_urls.items()
+                        if img_urls.get(img_id) != url
+                    },
+                )
+            return downloaded
+
+        def preprocess(batch):
+            batch_img_ids, img_data = batch
+            if len(img_data) == 0:
+                progress.update()
+                return None
+            return batch_img_ids, md.batch_preprocessing(img_data)
 
+        def inference(batch):
+            batch_img_ids, model_input = batch
+            try:
+                return batch_img_ids, md.batch_inference(*model_input)
+            finally:
+                md.release_batch(*model_input)
+
+        def db_write(batch):
+            batch_img_ids, model_output = batch
             # add img_id to model_output
-            # start = time.time()
             value_list = [
-                [img_id] + mo for img_id, mo in zip(img_ids[i:j], model_output)
-            ]
-            header = [
-                "img_id",
-                "road_type_pred",
-                "road_type_prob",
-                "type_pred",
-                "type_class_prob",
-                "quality_pred",
+                [img_id] + mo for img_id, mo in zip(batch_img_ids, model_output)
             ]
             db.add_rows_to_table(f"{self.name}_img_classifications", header, value_list)
-            # print(f"db insert {time.time() - start}")
+            # peak since the previous batch was written (batches overlap), to size batch_size and batch_buffers
+            peak_rss = interval_peak_rss()
+            self.batch_memory.append({"imgs": len(value_list), "peak_rss_bytes": peak_rss})
+            if peak_rss is not None:
+                progress.set_postfix(batch_peak_rss=f"{peak_rss / 2**30:.2f} GB")
+            progress.update()
+
+        # download, preprocessing, inference and db insert of subsequent batches overlap
+        pipeline = StagedPipeline(
+            [
+                Stage(
+                    "download",
+                    download,
+                    self.pipeline_depth["download"],
+                    self.download_workers,
+                ),
+                Stage("preprocess", preprocess, self.pipeline_depth["preprocess"]),
+                Stage("inference", inference, self.pipeline_depth["inference"]),
+                Stage("db_write", db_write, self.pipeline_depth["db_write"]),
+            ]
+        )
+        self.batch_memory = []
+        interval_peak_rss()  # the first batch starts now
+        try:
+            pipeline.run(batches)
+        finally:
+            progress.close()
+        peaks = [m["peak_rss_bytes"] for m in self.batch_memory if m["peak_rss_bytes"] is not None]
+        if len(peaks) > 0:
+            logging.info(
+                f"Peak RSS of classification: {max(peaks) / 2**30:.2f} GB "
+                f"(batch_size {md.batch_size}, buffers {md.buffer_stats()})"
+            )
+        return len(img_ids)
+
+    def reuse_classifications(self, db, other_names):
+        """Copy the classifications of images that were already classified for other areas of interest
+        (with the same models) into `{name}_img_classifications`, so that images of overlapping areas of
+        interest are downloaded and classified once.
+
+        Args:
+            db (SurfaceDatabase): database
+            other_names (list): names of the other areas of interest
+
+        Returns:
+            int: number of reused classifications
+        """
+        tables = [
+            f"{name}_img_classifications"
+            for name in other_names
+            if db.table_exists(f"{name}_img_classifications")
+        ]
+        if len(tables) == 0:
+            return 0
+        db.execute_sql_query(const.SQL_PREP_MODEL_RESULT, self.query_params)
+        shared = "\nUNION ALL\n".join(f"SELECT * FROM {table}" for table in tables)
+        query = f"""
+        WITH Reused AS (
+            INSERT INTO {self.name}_img_classifications
+            SELECT DISTINCT ON (shared.img_id) shared.*
+            FROM ({shared}) AS shared
+            JOIN {self.name}_img_metadata img
+            ON img.img_id = shared.img_id
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {self.name}_img_classifications res
+                WHERE res.img_id = shared.img_id
+            )
+            ORDER BY shared.img_id
+            RETURNING 1
+        )
+        SELECT count(*) FROM Reused;"""
+        return db.execute_sql_query(query, is_file=False, get_response=True)[0][0]
+
+    def resolve_img_urls(self, mi, db, img_ids):
+        """Resolve the image urls of `img_size` with batched Graph API requests and persist them
+        in the table `{name}_img_urls`. Already persisted urls are not resolved again.
+
+        Args:
+            mi (MapillaryInterface): interface to the Mapillary API
+            db (SurfaceDatabase): database
+            img_ids (list): ids of the images to resolve
+
+        Returns:
+            dict: img_id (as str) -> img_url
+        """
+        db.execute_sql_query(const.SQL_CREATE_IMG_URL_TABLE, self.query_params)
+        rows = db.execute_sql_query(
+            f"SELECT img_id, img_url FROM {self.name}_img_urls WHERE img_size = '{self.img_size}';",
+            is_file=False,
+            get_response=True,
+        )
+        img_urls = {str(row[0]): row[1] for row in rows}
+
+        missing = [img_id for img_id in img_ids if str(img_id) not in img_urls]
+        if len(missing) > 0:
+            logging.info(f"Resolve image urls of {len(missing)} images")
+            new_img_urls = mi.query_img_urls(missing, self.img_size)
+            self._persist_img_urls(db, new_img_urls)
+            img_urls.update(new_img_urls)
+        return img_urls
+
+    def _persist_img_urls(self, db, img_urls):
+        if len(img_urls) > 0:
+            db.execute_many_sql_query(
+                const.SQL_PERSIST_IMG_URLS,
+                [(img_id, self.img_size, url) for img_id, url in img_urls.items()],
+                self.query_params,
+            )
 
+    def aggregate_on_roads(self, db, full=False):
+        """Aggregate image classifications by road segment (group) with the aggregation algorithm (`SQL_AGGREGATE_ON_ROADS`).
+
+        With `incremental_aggregation`, the classified images are snapshot after each aggregation. Subsequent
+        aggregations only recompute the ways (dirty set) whose images changed since the snapshot: the aggregation
+        scripts run on tables restricted to these ways (prefixed with `{name}_dirty`) and the results are merged
+        into `{name}_group_predictions`.
+
+        With the local processing engine, the aggregation runs in-process (`LocalEngine.aggregate_on_roads`)
+        and its result is written to `{name}_group_predictions`.
+
+        Args:
+            db (SurfaceDatabase): database
+            full (bool, optional): aggregate all ways, e.g., if the road segments changed. Defaults to False.
+        """
+        if self.processing_engine == "local":
+            self._run_local_aggregation(db)
+            return
+
+        incremental = (
+            self.incremental_aggregation
+            and not full
+            and db.table_exists(f"{self.name}_group_predictions")
+            and db.table_exists(f"{self.name}_aggregated_imgs")
+        )
+        if not incremental:
+            self._run_aggregation(db, self.query_params)
+        else:
+            db.execute_sql_query(const.SQL_PREPARE_DIRTY_AGGREGATION, self.query_params)
+            n_dirty = db.execute_sql_query(
+                f"SELECT count(*) FROM {self.name}_dirty_ways;",
+                is_file=False,
+                get_response=True,
+            )[0][0]
+            logging.info(f"Re-aggregate {n_dirty} ways with changed images.")
+            if n_dirty > 0:
+                self._run_aggregation(
+                    db, {**self.query_params, "name": f"{self.name}_dirty"}
+                )
+                db.execute_sql_query(
+                    const.SQL_MERGE_DIRTY_AGGREGATION, self.query_params
+                )
+            db.execute_sql_query(const.SQL_DROP_DIRTY_AGGREGATION, self.query_params)
+
+        if self.incremental_aggregation:
+            db.execute_sql_query(const.SQL_SNAPSHOT_AGGREGATED_IMGS, self.query_params)
+
+    def _run_aggregation(self, db, params):
+        # split into three scripts for faster execution
+        scripts = str(const.AGGREGATION_ENGINES[self.aggregation_engine])
+        for alg in [1, 2, 3]:
+            db.execute_sql_query(scripts.format(alg), params)
+
+    def local_engine(self):
+        """The local processing engine with the road network parameters of this area of interest.
+
+        Returns:
+            LocalEngine: the engine
+        """
+        return LocalEngine(
+            self.segment_length,
+            self.min_road_length,
+            self.dist_from_road,
+            self.segments_per_group,
+            self.additional_id_column,
+        )
+
+    def segment_ways_local(self, db, osm=True):
+        """Cut ways into subsegments and create their partitions with the local processing engine, instead of
+        `SQL_SEGMENT_WAYS`, `SQL_PREPARE_PARTITIONS` and `SQL_SEPARATE_ROAD_TYPES` (`SQL_SEPARATE_NULL_ROAD_TYPES`).
+        Both are written to `{name}_segmented_ways` and `{name}_partitions` and kept in memory for matching and aggregation.
+
+        Args:
+            db (SurfaceDatabase): database
+            osm (bool, optional): whether the ways are OSM ways with sidewalk and cycleway tags. Defaults to True.
+        """
+        tag_columns = sorted({c for tags in OSM_PARTITION_TAGS.values() for c in tags})
+        columns = self._id_columns() + ["id", "road_type"]
+        columns += tag_columns if osm else []
+        ways = self._read_columns(
+            db,
+            f"{self.name}_way_selection",
+            {**{c: object for c in columns}, "geom": "geometry"},
+        )
+        engine = self.local_engine()
+        segments = engine.segment_ways(ways)
+        partitions = engine.separate_road_types(segments, ways if osm else None)
+
+        db.execute_sql_query(const.SQL_CREATE_LOCAL_NETWORK_TABLES, self.query_params)
+        self._write_columns(db, f"{self.name}_segmented_ways", segments)
+        self._write_columns(db, f"{self.name}_partitions", partitions)
+        db.execute_sql_query(const.SQL_INDEX_LOCAL_NETWORK_TABLES, self.query_params)
+        self._local_network = (segments, partitions)
+
+    def match_imgs_local(self, db):
+        """Match images to subsegments with the local processing engine, instead of `SQL_MATCH_IMG_ROADS`.
+        `{name}_img_metadata` is replaced by the matched images.
+
+        Args:
+            db (SurfaceDatabase): database
+        """
+        segments, partitions = self._get_local_network(db)
+        imgs = self._read_columns(
+            db,
+            f"{self.name}_img_metadata",
+            {
+                "img_id": object,
+                "sequence_id": object,
+                "captured_at": "int64",
+                "geom": "geometry",
+            },
+        )
+        matched = self.local_engine().match_imgs_to_segments(imgs, segments, partitions)
+        logging.info(f"{len(matched['img_id'])} of {len(imgs['img_id'])} images matched.")
+
+        db.execute_sql_query(const.SQL_CREATE_LOCAL_IMG_MATCHES_TABLE, self.query_params)
+        self._write_columns(
+            db,
+            f"{self.name}_img_matches",
+            {c: matched[c] for c in const.IMG_MATCH_HEADER},
+        )
+        db.execute_sql_query(const.SQL_RENAME_LOCAL_IMG_MATCHES, self.query_params)
+
+    def _run_local_aggregation(self, db):
+        segments, partitions = self._get_local_network(db)
+        imgs = self._read_columns(
+            db,
+            f"{self.name}_img_metadata",
+            {
+                "img_id": object,
+                "way_id": object,
+                "segment_id": object,
+                "captured_at": "int64",
+                "num_closeby_ways": "int64",
+                "part_ids": "array",
+                "part_dists": "array",
+            },
+        )
+        classifications = self._read_columns(
+            db,
+            f"{self.name}_img_classifications",
+            {
+                "img_id": object,
+                "road_type_pred": object,
+                "type_pred": object,
+                "type_class_prob": "float64",
+                "quality_pred": "float64",
+            },
+        )
+        predictions = self.local_engine().aggregate_on_roads(
+            segments, partitions, imgs, classifications
+        )
+        db.execute_sql_query(
+            const.SQL_CREATE_LOCAL_GROUP_PREDICTIONS_TABLE, self.query_params
+        )
+        self._write_columns(db, f"{self.name}_local_group_predictions", predictions)
+        db.execute_sql_query(
+            const.SQL_TRANSFORM_LOCAL_GROUP_PREDICTIONS, self.query_params
+        )
+
+    def _get_local_network(self, db):
+        # subsegments and partitions of this run, or as stored in the database by a previous run
+        if self._local_network is None:
+            segments = self._read_columns(
+                db,
+                f"{self.name}_segmented_ways",
+                {
+                    "segment_number": "int64",
+                    **{c: object for c in self._id_columns()},
+                    "segment_id": object,
+                    "id": object,
+                    "road_type": object,
+                    "geom": "geometry",
+                },
+            )
+            partitions = self._read_columns(
+                db,
+                f"{self.name}_partitions",
+                {
+                    "segment_id": object,
+                    "part_id": "int64",
+                    "road_type": object,
+                    "geom": "geometry",
+                },
+            )
+            self._local_network = (segments, partitions)
+        return self._local_network
+
+    def _id_columns(self):
+        return [] if self.additional_id_column is None else [self.additional_id_column]
+
+    def _read_columns(self, db, table, dtypes):
+        # geometries are read as WKB in the projected CRS
+        select = ", ".join(
+            f"ST_AsBinary(ST_Transform({column}, {self.proj_crs}))"
+            if dtype == "geometry"
+            else column
+            for column, dtype in dtypes.items()
+        )
+        rows = db.execute_sql_query(
+            f"SELECT {select} FROM {table};", is_file=False, get_response=True
+        )
+        return columns_from_rows(rows, dtypes)
+
+    def _write_columns(self, db, table, columns):
+        header = list(columns)
+        db.add_rows_to_table(
+            table, header, rows_from_columns(columns, header, self.proj_crs)
+        )
+
+    def shard_cells(self):
+        """Cells of shard_tiles x shard_tiles zoom-14 tiles covering the bounding box.
+
+        Cell boundaries are tile boundaries, thus every vector tile of image metadata lies within one cell
+        (apart from the tiles harvested as context of ways close to the boundary, see create_shards).
+
+        Returns:
+            list: (west, south, east, north) of each cell in EPSG:4326, in row-major tile order
+        """
+        cells = {}
+        for tile in mercantile.tiles(
+            self.minLon, self.minLat, self.maxLon, self.maxLat, const.ZOOM
+        ):
+            cells.setdefault(
+                (tile.y // self.shard_tiles, tile.x // self.shard_tiles), []
+            ).append(mercantile.bounds(tile))
+        return [
+            (
+                min(bounds.west for bounds in cell),
+                min(bounds.south for bounds in cell),
+                max(bounds.east for bounds in cell),
+                max(bounds.north for bounds in cell),
+            )
+            for _, cell in sorted(cells.items())
+        ]
+
+    def create_shards(self, db):
+        """Split the selected ways (`{name}_way_selection`) into shards `{name}_s{k}` of the shard cells.
+
+        Each way is owned by the shard whose cell contains its start point, so that ways crossing a cell boundary
+        are processed (and aggregated) exactly once. A shard additionally holds the context ways close to its owned
+        ways, such that images are matched to the same way as in an unsharded run. The image metadata of a shard is
+        harvested within the extent of its owned ways plus `dist_from_road`, thus boundary tiles are requested by
+        several shards (and deduplicated by a shared tile cache).
+
+        The ways of all shards are selected again in every run, as the cells change with `shard_tiles` or the
+        bounding box; tables of shards beyond the current number of cells are dropped.
+
+        Args:
+            db (SurfaceDatabase): database
+
+        Returns:
+            list: configuration of each shard with owned ways, to create its AreaOfInterest
+        """
+        cells = self.shard_cells()
+        self.drop_shards(db, keep=len(cells))
+        shards = []
+        for k, cell in enumerate(cells):
+            name = f"{self.name}_s{k}"
+            db.execute_sql_query(
+                const.SQL_SHARD_WAY_SELECTION,
+                {
+                    **self.query_params,
+                    "name": name,
+                    "parent": self.name,
+                    **{f"cell{i}": value for i, value in enumerate(cell)},
+                },
+            )
+            query = f"""
+            SELECT ST_XMin(harvest.bbox), ST_YMin(harvest.bbox), ST_XMax(harvest.bbox), ST_YMax(harvest.bbox)
+            FROM (
+                SELECT ST_Transform(
+                    ST_SetSRID(ST_Expand(ST_Extent(geom)::geometry, {self.dist_from_road}), {self.proj_crs}), 4326
+                ) AS bbox
+                FROM {name}_way_selection
+                WHERE owned
+            ) AS harvest;"""
+            bbox = db.execute_sql_query(query, is_file=False, get_response=True)[0]
+            if bbox[0] is None:
+                logging.info(f"Shard {name} has no ways, skip.")
+                continue
+            shards.append(
+                {
+                    **self.config,
+                    "name": name,
+                    "minLon": max(bbox[0], self.minLon),
+                    "minLat": max(bbox[1], self.minLat),
+                    "maxLon": min(bbox[2], self.maxLon),
+                    "maxLat": min(bbox[3], self.maxLat),
+                    "shard_tiles": None,
+                    "shard": True,
+                    "shard_cell": list(cell),
+                }
+            )
+        return shards
+
+    def drop_shards(self, db, keep=0):
+        """Drop the tables `{name}_s{k}_*` of all shards k >= keep."""
+        rows = db.execute_sql_query(
+            f"""SELECT table_name FROM information_schema.tables
+            WHERE table_schema = 'public' AND table_name LIKE '{self.name}\\_s%';""",
+            is_file=False,
+            get_response=True,
+        )
+        pattern = re.compile(rf"{re.escape(self.name)}_s(\d+)_\w+")
+        matches = [pattern.fullmatch(row[0]) for row in rows]
+        tables = [
+            match.group(0)
+            for match in matches
+            if match is not None and int(match.group(1)) >= keep
+        ]
+        if len(tables) > 0:
+            logging.info(f"Drop {len(tables)} tables of former shards.")
+            db.execute_sql_query(f"DROP TABLE IF EXISTS {', '.join(tables)};", is_file=False)
+
+    def merge_shards(self, db, shard_names):
+        """Merge the results of the shards into `{name}_group_predictions`, `{name}_img_metadata`
+        and `{name}_img_classifications`. Only predictions of ways owned by a shard are kept.
+
+        Args:
+            db (SurfaceDatabase): database
+            shard_names (list): names of the processed shards, as returned by create_shards
+        """
+        predictions = "\nUNION ALL\n".join(
+            f"""SELECT gp.* FROM {shard}_group_predictions gp
+            WHERE gp.id IN (SELECT id FROM {shard}_way_selection WHERE owned)"""
+            for shard in shard_names
+        )
+        queries = [
+            f"""
+            DROP TABLE IF EXISTS {self.name}_group_predictions;
+            CREATE TABLE {self.name}_group_predictions AS
+            {predictions};"""
+        ]
+        for table in ["img_metadata", "img_classifications"]:
+            # images are dropped from all shards but the one owning their way, DISTINCT ON only resolves ties
+            imgs = "\nUNION ALL\n".join(
+                f"SELECT {k} AS shard_num, img.* FROM {shard}_{table} img"
+                for k, shard in enumerate(shard_names)
+            )
+            queries.append(
+                f"""
+                DROP TABLE IF EXISTS {self.name}_{table};
+                CREATE TABLE {self.name}_{table} AS
+                SELECT DISTINCT ON (img_id) * FROM ({imgs}) AS imgs
+                ORDER BY img_id, shard_num;
+                ALTER TABLE {self.name}_{table} DROP COLUMN shard_num;"""
+            )
+        for query in queries:
+            db.execute_sql_query(query, is_file=False)
 
     def imgs_to_shapefile(self, db, output_path):
         query = f"""
@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+class ImageCache:
+    """Local on-disk cache of downloaded images, keyed by (img_id, img_size).
+
+    Files are written atomically (temporary file + rename), so an interrupted run never leaves
+    truncated images behind. If the total size exceeds `max_bytes`, the least recently used
+    images are evicted. Recency is kept in the file modification time, thus it persists across runs.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """Initializes an ImageCache.
+
+        Args:
+            cache_dir (str): folder to store cached images in
+            max_bytes (int, optional): maximum total size of cached images in bytes. Defaults to None (unbounded).
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> size, least recently used first
+        self._total_bytes = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        files = []
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith(".jpg"):
+                    path = Path(root) / filename
+                    stat = path.stat()
+                    files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._entries[path] = size
+            self._total_bytes += size
+        logging.info(
+            f"Image cache at {self.cache_dir}: {len(self._entries)} images, {self._total_bytes / 1e6:.1f} MB"
+        )
+
+    def _path(self, img_id, img_size):
+        key = hashlib.sha1(f"{img_id}/{img_size}".encode()).hexdigest()
+        return self.cache_dir / key[:2] / f"{key}.jpg"
+
+    def __contains__(self, key):
+        img_id, img_size = key
+        with self._lock:
+            return self._path(img_id, img_size) in self._entries
+
+    def get(self, img_id, img_size):
+        """Get the content of a cached image
+
+        Args:
+            img_id (str): Mapillary image id
+            img_size (str): image size, e.g. thumb_1024_url
+
+        Returns:
+            bytes: image content, or None if the image is not cached
+        """
+        path = self._path(img_id, img_size)
+        with self._lock:
+            if path not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:  # evicted in the meantime
+            with self._lock:
+                self._discard(path)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def put(self, img_id, img_size, content):
+        """Add an image to the cache and evict least recently used images if the cache is too large.
+
+        Args:
+            img_id (str): Mapillary image id
+            img_size (str): image size, e.g. thumb_1024_url
+            content (bytes): image content
+        """
+        path = self._path(img_id, img_size)
+        atomic_write(path, content)
+
+        with self._lock:
+            self._discard(path)
+            self._entries[path] = len(content)
+            self._total_bytes += len(content)
+            self._evict()
+
+    def _discard(self, path):
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self._total_bytes > self.max_bytes and len(self._entries) > 0:
+            path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Hit/miss statistics and size of the cache.
+
+        Returns:
+            dict: hits, misses, evictions, number of cached images and total bytes
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "images": len(self._entries),
+                "bytes": self._total_bytes,
+            }
+
+
+def atomic_write(path, content):
+    """Write content to a temporary file next to `path` and rename it, so readers never see partial files.
+
+    Args:
+        path (Path): target file path
+        content (bytes): file content
+    """
+    os.makedirs(path.parent, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
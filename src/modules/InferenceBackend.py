@@ -0,0 +1,244 @@
+"""Inference backends (const.INFERENCE_BACKENDS) and precisions (const.INFERENCE_PRECISIONS) of the
+classification models.
+
+Backends:
+- eager: the PyTorch model as loaded
+- torchscript: traced and frozen TorchScript module, optimized for inference, in channels_last memory format
+- compile: `torch.compile` of the model in channels_last memory format
+- onnx: the model exported to ONNX (next to its checkpoint) and run with ONNX Runtime on CPU
+
+Precisions:
+- fp32: the model as loaded
+- bf16: weights and inputs in bfloat16
+- int8_dynamic: dynamic quantization of the linear layers (weights int8, activations quantized on the fly)
+- int8_static: post-training static quantization of all layers (FX graph mode), calibrated on sample images
+"""
+
+import copy
+import os
+import sys
+from pathlib import Path
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+try:
+    import onnxruntime
+except ImportError:  # optional dependency of the onnx inference backend
+    onnxruntime = None
+
+# local modules
+src_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(src_dir))
+import constants as const
+
+
+class BackendModel:
+    """A model run by an inference backend: the forward pass runs with the backend, the mapping of the outputs
+    to classes and values (`get_class_and_value`) with the eager model."""
+
+    def __init__(self, model, forward, backend, channels_last=False):
+        """Initializes a BackendModel.
+
+        Args:
+            model (nn.Module): eager model
+            forward (callable): forward pass of the backend, batch tensor -> output tensor
+            backend (str): name of the backend
+            channels_last (bool, optional): convert inputs to channels_last memory format. Defaults to False.
+        """
+        self.model = model
+        self.forward = forward
+        self.backend = backend
+        self.channels_last = channels_last
+
+    def __call__(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.forward(x)
+
+    def get_class_and_value(self, x):
+        return self.model.get_class_and_value(x)
+
+    # the backend is bound to the device and mode of the eager model when it is built
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+class PrecisionModel(nn.Module):
+    """A reduced-precision version of a model: inputs are cast to `dtype`, outputs to float32, and classes and
+    values are mapped as by the original model."""
+
+    def __init__(self, module, model, dtype=None):
+        """Initializes a PrecisionModel.
+
+        Args:
+            module (nn.Module): reduced-precision module
+            model (nn.Module): original model, only its mapping of outputs to classes and values is kept
+            dtype (torch.dtype, optional): input dtype of the module. Defaults to None (no cast).
+        """
+        super().__init__()
+        self.module = module
+        self.dtype = dtype
+        self.head = _output_mapping(model)
+
+    def forward(self, x):
+        if self.dtype is not None:
+            x = x.to(self.dtype)
+        return self.module(x).float()
+
+    def get_class_and_value(self, x):
+        return self.head.get_class_and_value(x)
+
+
+def _output_mapping(model):
+    """Shallow copy of a model without its layers and weights, e.g., for its get_class_and_value."""
+    head = copy.copy(model)
+    head._modules, head._parameters, head._buffers = {}, {}, {}
+    return head
+
+
+def reduce_precision(precision, model, example, calibration_batches=None):
+    """Convert a model to an inference precision.
+
+    Args:
+        precision (str): one of const.INFERENCE_PRECISIONS
+        model (nn.Module): model in eval mode. Converted in place for bf16 and int8_dynamic.
+        example (Tensor): example input batch, to trace the model for int8_static
+        calibration_batches (list(Tensor), optional): input batches to calibrate the activation ranges,
+            required for int8_static. Defaults to None.
+
+    Returns:
+        nn.Module: the model in the given precision
+    """
+    if precision not in const.INFERENCE_PRECISIONS:
+        raise ValueError(
+            f"Invalid inference_precision {precision}, options: {const.INFERENCE_PRECISIONS}"
+        )
+    if precision == "fp32":
+        return model
+    if precision == "bf16":
+        return PrecisionModel(model.to(torch.bfloat16), model, dtype=torch.bfloat16)
+    if precision == "int8_dynamic":
+        return torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+    if not calibration_batches:
+        raise ValueError("inference_precision int8_static requires calibration images")
+    prepared = prepare_fx(
+        model,
+        get_default_qconfig_mapping(torch.backends.quantized.engine),
+        example_inputs=(example,),
+    )
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+    return PrecisionModel(convert_fx(prepared), model)
+
+
+def build_backend(backend, model, example, onnx_path=None, checkpoint_path=None):
+    """Build the inference backend of a model.
+
+    Args:
+        backend (str): one of const.INFERENCE_BACKENDS
+        model (nn.Module): eager model, on its device and in eval mode. The torchscript and compile backends
+            convert its weights to channels_last memory format.
+        example (Tensor): example input batch, to trace and export the model
+        onnx_path (str, optional): file of the ONNX export, required for backend onnx. Defaults to None.
+        checkpoint_path (str, optional): checkpoint of the model, the ONNX export is renewed if it is older.
+            Defaults to None.
+
+    Returns:
+        nn.Module or BackendModel: the model for ModelInterface.predict
+    """
+    if backend not in const.INFERENCE_BACKENDS:
+        raise ValueError(
+            f"Invalid inference_backend {backend}, options: {const.INFERENCE_BACKENDS}"
+        )
+    if backend == "eager":
+        return model
+
+    if backend == "onnx":
+        if onnxruntime is None:
+            raise ImportError(
+                "onnxruntime is required for the onnx inference backend: poetry install --extras onnx"
+            )
+        if onnx_path is None:
+            raise ValueError("inference_backend onnx requires the path of the ONNX export")
+        export_onnx(model, example, onnx_path, checkpoint_path)
+        session = onnxruntime.InferenceSession(
+            str(onnx_path), providers=["CPUExecutionProvider"]
+        )
+
+        def forward(x):
+            output = session.run(None, {"input": x.cpu().numpy()})[0]
+            return torch.from_numpy(output)
+
+        return BackendModel(model, forward, backend)
+
+    model = model.to(memory_format=torch.channels_last)
+    if backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(
+                model, example.contiguous(memory_format=torch.channels_last)
+            )
+        forward = torch.jit.optimize_for_inference(traced)
+    else:
+        forward = torch.compile(model)
+    return BackendModel(model, forward, backend, channels_last=True)
+
+
+def export_onnx(model, example, onnx_path, checkpoint_path=None):
+    """Export a model to ONNX with dynamic batch size, unless an export newer than the checkpoint exists."""
+    onnx_path = Path(onnx_path)
+    if onnx_path.exists() and (
+        checkpoint_path is None
+        or not Path(checkpoint_path).exists()
+        or onnx_path.stat().st_mtime >= Path(checkpoint_path).stat().st_mtime
+    ):
+        return
+    onnx_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = onnx_path.with_suffix(f".{os.getpid()}.tmp")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            example,
+            str(tmp_path),
+            input_names=["input"],
+            output_names=["output"],
+            dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+            opset_version=17,
+        )
+    os.replace(tmp_path, onnx_path)
+
+
+def check_parity(reference, candidate, data):
+    """Compare the predictions of a backend with the eager model on the same input.
+
+    Args:
+        reference (nn.Module): eager model
+        candidate (nn.Module or BackendModel): model of the backend
+        data (Tensor): input batch
+
+    Returns:
+        dict: class_agreement (share of equal classes) and max_value_diff (maximum absolute difference
+        of the class probabilities or regression values)
+    """
+    with torch.no_grad():
+        classes, values = reference.get_class_and_value(reference(data))
+        other_classes, other_values = candidate.get_class_and_value(candidate(data))
+    return {
+        "class_agreement": sum(a == b for a, b in zip(classes, other_classes))
+        / len(classes),
+        "max_value_diff": max(abs(a - b) for a, b in zip(values, other_values)),
+    }
+
+
+def is_consistent(check, tolerance=const.INFERENCE_PARITY_TOLERANCE):
+    """Whether a parity check (see check_parity) shows equal classes and values within the tolerance."""
+    return check["class_agreement"] == 1 and check["max_value_diff"] <= tolerance
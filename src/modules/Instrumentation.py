@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# local modules
+src_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(src_dir))
+from modules.ImageCache import atomic_write
+
+# Prometheus metrics of the stage records: metric name -> (record key, help text)
+PROMETHEUS_METRICS = {
+    "surfaceai_stage_wall_seconds": ("wall_seconds", "Wall time of a pipeline stage."),
+    "surfaceai_stage_cpu_seconds": (
+        "cpu_seconds",
+        "CPU time (all threads) of a pipeline stage.",
+    ),
+    "surfaceai_stage_peak_rss_bytes": (
+        "peak_rss_bytes",
+        "Peak resident set size during a pipeline stage.",
+    ),
+    "surfaceai_stage_http_requests": (
+        "http_requests",
+        "HTTP requests to Mapillary of a pipeline stage.",
+    ),
+    "surfaceai_stage_http_bytes": (
+        "http_bytes",
+        "Bytes received from Mapillary in a pipeline stage.",
+    ),
+}
+
+
+# peak resident set size before the resets of interval_peak_rss within the current stage, in bytes
+_peak_floor = 0
+_peak_lock = threading.Lock()
+
+
+def _clear_peak_rss():
+    # Linux: reset the peak resident set size (VmHWM) of the process
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _reset_peak_rss():
+    global _peak_floor
+    with _peak_lock:
+        _peak_floor = 0
+        return _clear_peak_rss()
+
+
+def _vm_hwm():
+    try:
+        with open("/proc/self/status", "r") as file:
+            match = re.search(r"VmHWM:\s+(\d+) kB", file.read())
+        if match is not None:
+            return int(match.group(1)) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss(is_reset):
+    """Peak resident set size in bytes: since the last reset if possible, else of the process lifetime."""
+    if is_reset:
+        peak = _vm_hwm()
+        if peak is not None:
+            return max(peak, _peak_floor)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def interval_peak_rss():
+    """Peak resident set size in bytes since the previous call, e.g., per batch. The peak is reset without losing
+    the peak of the current Instrumentation stage. If the peak cannot be reset, the peak of the process lifetime
+    is returned; None if not available.
+    """
+    global _peak_floor
+    with _peak_lock:
+        peak = _vm_hwm()
+        if peak is None or not _clear_peak_rss():
+            return _peak_rss(False)
+        _peak_floor = max(_peak_floor, peak)
+        return peak
+
+
+class Instrumentation:
+    """Run report of the pipeline stages: wall time, CPU time, peak RSS, row counts of the produced tables,
+    HTTP requests and bytes, and the SQL queries executed through `SurfaceDatabase.execute_sql_query`
+    (optionally with their `EXPLAIN (ANALYZE, BUFFERS)` plans).
+    """
+
+    def __init__(self, name, db=None, mi=None, explain_analyze=False):
+        """Initializes an Instrumentation and attaches it to the database, such that it records the SQL queries.
+
+        Args:
+            name (str): name of the area of interest
+            db (SurfaceDatabase, optional): database, to record queries and count rows of produced tables. Defaults to None.
+            mi (MapillaryInterface, optional): Mapillary interface, to count HTTP requests. Defaults to None.
+            explain_analyze (bool, optional): record the query plans of SQL scripts with EXPLAIN (ANALYZE, BUFFERS).
+                The statements are executed one by one. Defaults to False.
+        """
+        self.name = name
+        self.db = db
+        self.mi = mi
+        self.explain_analyze = explain_analyze
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.stages = []
+        self._current = None
+        self._lock = threading.Lock()
+        if db is not None:
+            db.instrumentation = self
+
+    @contextmanager
+    def stage(self, name, tables=()):
+        """Record a pipeline stage.
+
+        Args:
+            name (str): name of the stage
+            tables (list, optional): tables produced by the stage, whose rows are counted afterwards. Defaults to ().
+
+        Yields:
+            dict: record of the stage
+        """
+        record = {"stage": name, "queries": []}
+        http_before = self.mi.http_stats() if self.mi is not None else None
+        is_reset = _reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        with self._lock:
+            self._current = record
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall_start
+            record["cpu_seconds"] = time.process_time() - cpu_start
+            record["peak_rss_bytes"] = _peak_rss(is_reset)
+            with self._lock:
+                self._current = None
+            if http_before is not None:
+                http_after = self.mi.http_stats()
+                record["http_requests"] = http_after["requests"] - http_before["requests"]
+                record["http_bytes"] = http_after["bytes"] - http_before["bytes"]
+            if self.db is not None:
+                record["rows"] = self._count_rows(tables)
+            self.stages.append(record)
+
+    def skipped(self, name):
+        """Record a stage that was skipped, e.g., as it is up to date."""
+        self.stages.append({"stage": name, "skipped": True})
+
+    def _count_rows(self, tables):
+        rows = {}
+        for table in tables:
+            if self.db.table_exists(table):
+                rows[table] = self.db.execute_sql_query(
+                    f"SELECT count(*) FROM {table};", is_file=False, get_response=True
+                )[0][0]
+        return rows
+
+    def record_query(self, query, seconds, plans=None):
+        """Record a SQL query of the current stage (called by SurfaceDatabase.execute_sql_query).
+
+        Args:
+            query (str): name of the SQL script, or the query
+            seconds (float): duration
+            plans (list, optional): EXPLAIN (ANALYZE, BUFFERS) output of the statements. Defaults to None.
+        """
+        with self._lock:
+            if self._current is None:
+                return
+            entry = {"query": query, "seconds": seconds}
+            if plans is not None:
+                entry["plans"] = plans
+            self._current["queries"].append(entry)
+
+    def report(self):
+        """The run report.
+
+        Returns:
+            dict: name, start time and the records of all stages
+        """
+        return {"name": self.name, "started_at": self.started_at, "stages": self.stages}
+
+    def log_summary(self):
+        lines = [
+            f"{'stage':<16} {'wall s':>10} {'cpu s':>10} {'peak MB':>10} {'http':>8} {'http MB':>10} {'sql s':>10}"
+        ]
+        for record in self.stages:
+            if record.get("skipped"):
+                lines.append(f"{record['stage']:<16} {'skipped':>10}")
+                continue
+            peak = record["peak_rss_bytes"]
+            lines.append(
+                f"{record['stage']:<16} {record['wall_seconds']:>10.2f} {record['cpu_seconds']:>10.2f} "
+                f"{(peak or 0) / 2**20:>10.0f} {record.get('http_requests', 0):>8} "
+                f"{record.get('http_bytes', 0) / 2**20:>10.1f} "
+                f"{sum(q['seconds'] for q in record['queries']):>10.2f}"
+            )
+        logging.info(f"Run report of {self.name}:\n" + "\n".join(lines))
+
+    def write_json(self, path):
+        atomic_write(Path(path), json.dumps(self.report(), indent=2).encode())
+
+    def prometheus_text(self):
+        """The stage records in the Prometheus text exposition format (e.g., for the textfile collector
+        of the node exporter)."""
+        stages = [record for record in self.stages if not record.get("skipped")]
+        lines = []
+        for metric, (key, help_text) in PROMETHEUS_METRICS.items():
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+            for record in stages:
+                if record.get(key) is not None:
+                    lines.append(
+                        f'{metric}{{aoi="{self.name}",stage="{record["stage"]}"}} {record[key]}'
+                    )
+        lines += [
+            "# HELP surfaceai_stage_table_rows Rows of a table produced by a pipeline stage.",
+            "# TYPE surfaceai_stage_table_rows gauge",
+        ]
+        for record in stages:
+            for table, n in record.get("rows", {}).items():
+                lines.append(
+                    f'surfaceai_stage_table_rows{{aoi="{self.name}",stage="{record["stage"]}",table="{table}"}} {n}'
+                )
+        lines += [
+            "# HELP surfaceai_stage_sql_seconds Duration of the SQL queries of a pipeline stage.",
+            "# TYPE surfaceai_stage_sql_seconds gauge",
+        ]
+        for record in stages:
+            lines.append(
+                f'surfaceai_stage_sql_seconds{{aoi="{self.name}",stage="{record["stage"]}"}} '
+                f"{sum(q['seconds'] for q in record['queries'])}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        atomic_write(Path(path), self.prometheus_text().encode())
+
+    def write(self, report_dir):
+        """Write the run report as `{name}_run_report.json` and Prometheus textfile `{name}.prom`."""
+        report_dir = Path(report_dir)
+        self.write_json(report_dir / f"{self.name}_run_report.json")
+        self.write_prometheus(report_dir / f"{self.name}.prom")
+        logging.info(f"Run report written to {report_dir}.")
@@ -0,0 +1,693 @@
+"""In-process implementation of the geometric pipeline steps with NumPy and Shapely.
+
+`LocalEngine` computes the same tables as the PostGIS scripts, without a database:
+subsegments (`segment_ways.sql`), partitions (`prepare_partitions.sql`, `separate_road_types.sql`,
+`separate_null_road_types.sql`), matches of images to subsegments (`match_imgs_to_segments.sql`) and
+the group predictions of the aggregation algorithm (`aggregation_alg{1,2,3}.sql`).
+
+Tables are columnar: dicts of column name -> np.ndarray of equal length (as decoded by VectorTile),
+geometries are object arrays of Shapely geometries in the projected CRS.
+"""
+
+from datetime import datetime, timezone
+
+import numpy as np
+
+try:
+    import shapely
+except ImportError:  # optional dependency of the local processing engine
+    shapely = None
+
+# partitions of other road types, shifted to the side of the road (part_id, road_type, offset).
+# As with ST_OffsetCurve, a positive offset is left of the line direction.
+PARTITIONS = [
+    (2, "footway", -5.0),
+    (3, "footway", 5.0),
+    (4, "bike_lane", -2.0),
+    (5, "bike_lane", 2.0),
+    (6, "cycleway", -3.5),
+    (7, "cycleway", 3.5),
+]
+# OSM tags (way selection column -> values) that create a partition
+OSM_PARTITION_TAGS = {
+    2: {"sidewalk": ("right", "both"), "sidewalk_right": ("yes",)},
+    3: {"sidewalk": ("left", "both"), "sidewalk_left": ("yes",)},
+    4: {"cycleway_right": ("lane",), "cycleway_both": ("lane",)},
+    5: {"cycleway_left": ("lane",), "cycleway_both": ("lane",)},
+    6: {"cycleway_right": ("track",), "cycleway_both": ("track",)},
+    7: {"cycleway_left": ("track",), "cycleway_both": ("track",)},
+}
+# length of a subsegment assumed to compute n_segments of a group (as in aggregation_alg3.sql)
+N_SEGMENTS_LENGTH = 20
+
+GROUP_PREDICTION_COLUMNS = [
+    "type_pred",
+    "segment_vote_count",
+    "avg_rt_share",
+    "conf_score",
+    "quali_pred",
+    "road_type",
+    "n_segments",
+    "n_rated_segments",
+    "avg_img_counts",
+    "n_imgs",
+    "way_length",
+    "min_date",
+    "max_date",
+    "geometry",
+]
+
+
+class LocalEngine:
+    """Segmentation, partitioning, image matching and aggregation on in-memory tables."""
+
+    def __init__(
+        self,
+        segment_length,
+        min_road_length,
+        dist_from_road,
+        segments_per_group=None,
+        additional_id_column=None,
+    ):
+        """Initializes a LocalEngine.
+
+        Args:
+            segment_length (float): length of a subsegment, in unit of the projected CRS
+            min_road_length (float): ways up to this length are excluded
+            dist_from_road (float): maximum distance of an image to a subsegment to be matched
+            segments_per_group (int, optional): number of subsegments per group. Defaults to None (one group per way).
+            additional_id_column (str, optional): column of custom road networks passed on to the predictions. Defaults to None.
+        """
+        if shapely is None:
+            raise ImportError(
+                "shapely is required for the local processing engine: pip install 'shapely>=2.0'"
+            )
+        self.segment_length = segment_length
+        self.min_road_length = min_road_length
+        self.dist_from_road = dist_from_road
+        self.segments_per_group = segments_per_group
+        self.additional_id_column = additional_id_column
+
+    @property
+    def _id_columns(self):
+        return [] if self.additional_id_column is None else [self.additional_id_column]
+
+    def segment_ways(self, ways):
+        """Cut ways into subsegments of equal length, no longer than `segment_length` (as `segment_ways.sql`).
+
+        Args:
+            ways (dict): columns "id", "road_type", "geom" (LineStrings) and the additional id column, if set
+
+        Returns:
+            dict: columns "segment_number", "segment_id", "id", "road_type", "geom" (and the additional id column)
+        """
+        lengths = shapely.length(ways["geom"])
+        ways = _take(ways, np.flatnonzero(lengths > self.min_road_length))
+
+        # vertices of all ways and their cumulative distance along the way
+        xy, way_of_vertex = shapely.get_coordinates(ways["geom"], return_index=True)
+        n_vertices = np.bincount(way_of_vertex, minlength=len(ways["geom"]))
+        first = np.cumsum(n_vertices) - n_vertices
+        last = first + n_vertices - 1
+        step = np.r_[0.0, np.hypot(*np.diff(xy, axis=0).T)]
+        step[first] = 0
+        dist = np.cumsum(step)
+        lengths = dist[last] - dist[first]
+
+        # subsegment n of k spans the fraction n/k to (n+1)/k of the way
+        n_segments = np.ceil(lengths / self.segment_length).astype(np.int64)
+        way = np.repeat(np.arange(len(n_segments)), n_segments)
+        number = np.arange(len(way)) - np.repeat(
+            np.cumsum(n_segments) - n_segments, n_segments
+        )
+        start = dist[first[way]] + lengths[way] * number / n_segments[way]
+        end = dist[first[way]] + lengths[way] * np.minimum(
+            (number + 1) / n_segments[way], 1
+        )
+        start_xy = _interpolate(xy, dist, start, first[way], last[way])
+        end_xy = _interpolate(xy, dist, end, first[way], last[way])
+        is_first = number == 0
+        is_last = number == n_segments[way] - 1
+        start_xy[is_first] = xy[first[way[is_first]]]
+        end_xy[is_last] = xy[last[way[is_last]]]
+
+        # vertices strictly between start and end of a subsegment
+        lo = np.maximum(np.searchsorted(dist, start, "right"), first[way] + 1)
+        hi = np.maximum(np.minimum(np.searchsorted(dist, end, "left"), last[way]), lo)
+        n_inner = hi - lo
+        n_coords = n_inner + 2
+        offsets = np.cumsum(n_coords) - n_coords
+        coords = np.empty((n_coords.sum(), 2))
+        coords[offsets] = start_xy
+        coords[offsets + n_coords - 1] = end_xy
+        inner = np.arange(n_inner.sum()) - np.repeat(np.cumsum(n_inner) - n_inner, n_inner)
+        coords[np.repeat(offsets + 1, n_inner) + inner] = xy[np.repeat(lo, n_inner) + inner]
+
+        segments = {"segment_number": number}
+        for column in self._id_columns:
+            segments[column] = ways[column][way]
+        ids = ways["id"][way]
+        segments["segment_id"] = _object_array(
+            [f"{i}_{n}" for i, n in zip(ids.tolist(), number.tolist())]
+        )
+        segments["id"] = ids
+        segments["road_type"] = ways["road_type"][way]
+        segments["geom"] = shapely.linestrings(
+            coords, indices=np.repeat(np.arange(len(way)), n_coords)
+        )
+        return segments
+
+    def separate_road_types(self, segments, ways=None):
+        """Create the partitions of subsegments: the subsegment itself (part_id 1) and offset geometries of
+        sidewalks and cycleways (part_ids 2-7, see PARTITIONS).
+
+        Args:
+            segments (dict): subsegments, see segment_ways
+            ways (dict, optional): OSM way selection with the tag columns of OSM_PARTITION_TAGS, to create
+                partitions as tagged (`separate_road_types.sql`). If None (custom road network), subsegments
+                without road type get road type "road" and all other partitions (`separate_null_road_types.sql`).
+
+        Returns:
+            dict: columns "segment_id", "part_id", "road_type", "geom"
+        """
+        no_road_type = _is_null(segments["road_type"])
+        road_type = segments["road_type"].copy()
+        if ways is None:
+            road_type[no_road_type] = "road"
+        else:
+            segment_idx, way_idx = _join_index([segments["id"]], [ways["id"]])
+        tables = [
+            {
+                "segment_id": segments["segment_id"],
+                "part_id": np.ones(len(road_type), dtype=np.int64),
+                "road_type": road_type,
+                "geom": segments["geom"],
+            }
+        ]
+        for part_id, part_road_type, offset in PARTITIONS:
+            if ways is None:
+                idx = np.flatnonzero(no_road_type)
+            else:
+                is_tagged = np.zeros(len(way_idx), dtype=bool)
+                for column, values in OSM_PARTITION_TAGS[part_id].items():
+                    for value in values:
+                        is_tagged |= ways[column][way_idx] == value
+                idx = segment_idx[is_tagged]
+            tables.append(
+                {
+                    "segment_id": segments["segment_id"][idx],
+                    "part_id": np.full(len(idx), part_id, dtype=np.int64),
+                    "road_type": _object_array([part_road_type] * len(idx)),
+                    "geom": shapely.offset_curve(segments["geom"][idx], offset),
+                }
+            )
+        return _concat(tables)
+
+    def match_imgs_to_segments(self, imgs, segments, partitions):
+        """Match images to the nearest subsegment within `dist_from_road` (as `match_imgs_to_segments.sql`).
+        Candidate subsegments are found with an STRtree, distances are computed once per candidate.
+
+        Args:
+            imgs (dict): images with column "geom" (Points in the projected CRS) and any other columns
+            segments (dict): subsegments, see segment_ways
+            partitions (dict): partitions, see separate_road_types
+
+        Returns:
+            dict: matched images with all input columns and "way_id", "segment_id", "dist", "num_closeby_ways",
+            "part_ids" and "part_dists" (arrays of the partitions of the matched subsegment, ordered by part_id)
+        """
+        tree = shapely.STRtree(segments["geom"])
+        img_idx, segment_idx = tree.query(
+            imgs["geom"], predicate="dwithin", distance=self.dist_from_road
+        )
+        dist = shapely.distance(imgs["geom"][img_idx], segments["geom"][segment_idx])
+        way_id = segments["id"][segment_idx]
+
+        # number of distinct ways within reach of each image
+        _, first_of_way = _group_index(img_idx, way_id)
+        num_closeby_ways = np.bincount(img_idx[first_of_way], minlength=len(imgs["geom"]))
+
+        # nearest subsegment of each image
+        order = np.lexsort((dist, img_idx))
+        img_idx, segment_idx, dist = img_idx[order], segment_idx[order], dist[order]
+        nearest = _run_starts(img_idx)
+        matched = _take(imgs, img_idx[nearest])
+        matched["way_id"] = way_id[order][nearest]
+        matched["segment_id"] = segments["segment_id"][segment_idx[nearest]]
+        matched["dist"] = dist[nearest]
+        matched["num_closeby_ways"] = num_closeby_ways[img_idx[nearest]]
+
+        # distances to the partitions of the matched subsegment
+        match_idx, part_idx = _join_index(
+            [matched["segment_id"]], [partitions["segment_id"]]
+        )
+        order = np.lexsort((partitions["part_id"][part_idx], match_idx))
+        match_idx, part_idx = match_idx[order], part_idx[order]
+        part_dists = shapely.distance(
+            matched["geom"][match_idx], partitions["geom"][part_idx]
+        )
+        splits = np.cumsum(np.bincount(match_idx, minlength=len(matched["geom"])))[:-1]
+        matched["part_ids"] = _object_array(
+            np.split(partitions["part_id"][part_idx], splits)
+        )
+        matched["part_dists"] = _object_array(np.split(part_dists, splits))
+        return matched
+
+    def aggregate_on_roads(self, segments, partitions, imgs, classifications):
+        """Aggregate image classifications by group (way or `segments_per_group` subsegments) and partition,
+        with the majority votes, thresholds and confidence score of `aggregation_alg{1,2,3}.sql`.
+
+        Args:
+            segments (dict): subsegments, see segment_ways
+            partitions (dict): partitions, see separate_road_types
+            imgs (dict): matched images, see match_imgs_to_segments (columns "img_id", "way_id",
+                "segment_id", "captured_at", "num_closeby_ways", "part_ids", "part_dists")
+            classifications (dict): columns "img_id", "road_type_pred", "type_pred", "type_class_prob"
+                and "quality_pred" (float, NaN if missing), with road types renamed (`rename_road_type_pred.sql`)
+
+        Returns:
+            dict: group predictions with the columns of `{name}_group_predictions`: the grouping ids
+            (additional id column, "id", "part_id", "group_num") and GROUP_PREDICTION_COLUMNS. Values
+            of groups without prediction are None, geometries are in the projected CRS.
+        """
+        eval_groups = self._eval_groups(segments, partitions)
+        selection = self._img_selection(segments, partitions, imgs, classifications)
+        votes = _group_votes(selection)
+        return self._group_predictions(eval_groups, votes, selection)
+
+    def _group_num(self, segment_number):
+        if self.segments_per_group is None:
+            return np.zeros(len(segment_number), dtype=np.int64)
+        return segment_number // self.segments_per_group
+
+    def _eval_groups(self, segments, partitions):
+        # aggregation_alg1.sql: merged geometry of each group and partition
+        segment_idx, part_idx = _join_index(
+            [segments["segment_id"]], [partitions["segment_id"]]
+        )
+        group_num = self._group_num(segments["segment_number"])[segment_idx]
+        keys = [segments[c][segment_idx] for c in self._id_columns + ["id"]]
+        keys += [partitions["part_id"][part_idx], group_num]
+        keys.append(partitions["road_type"][part_idx])
+        groups, first = _group_index(*keys)
+
+        order = np.lexsort((segments["segment_number"][segment_idx], groups))
+        geoms = partitions["geom"][part_idx[order]]
+        bounds = np.r_[0, np.cumsum(np.bincount(groups))]
+        geometry = _object_array(
+            [
+                shapely.line_merge(shapely.union_all(geoms[a:b]))
+                for a, b in zip(bounds[:-1], bounds[1:])
+            ]
+        )
+        eval_groups = {
+            column: values[first]
+            for column, values in zip(
+                self._id_columns + ["id", "part_id", "group_num", "road_type"], keys
+            )
+        }
+        eval_groups["geometry"] = geometry
+        return _take(eval_groups, np.flatnonzero(~shapely.is_empty(geometry)))
+
+    def _img_selection(self, segments, partitions, imgs, classifications):
+        # aggregation_alg2.sql: classified images with the closest partition of a fitting road type
+        img_idx, cl_idx = _join_index([imgs["img_id"]], [classifications["img_id"]])
+        imgs = {
+            **_take(imgs, img_idx),
+            **{c: v[cl_idx] for c, v in classifications.items() if c != "img_id"},
+        }
+        img_idx, segment_idx = _join_index([imgs["segment_id"]], [segments["segment_id"]])
+        imgs = _take(imgs, img_idx)
+        imgs["group_num"] = self._group_num(segments["segment_number"])[segment_idx]
+
+        # one row per image and partition of its subsegment
+        n_parts = np.array([len(p) for p in imgs["part_ids"]], dtype=np.int64)
+        row = np.repeat(np.arange(len(n_parts)), n_parts)
+        part_id = _concat_arrays(imgs["part_ids"], np.int64)
+        part_dist = _concat_arrays(imgs["part_dists"], np.float64)
+        row_idx, part_idx = _join_index(
+            [imgs["segment_id"][row], part_id],
+            [partitions["segment_id"], partitions["part_id"]],
+        )
+        row, part_id, part_dist = row[row_idx], part_id[row_idx], part_dist[row_idx]
+        part_road_type = partitions["road_type"][part_idx]
+
+        # the road type of the image has to match if there are other partitions or ways close by
+        max_part_id = np.zeros(len(n_parts), dtype=np.int64)
+        np.maximum.at(max_part_id, row, part_id)
+        requ_road_type = (max_part_id > 1) | (imgs["num_closeby_ways"] > 1)
+        road_type_pred = imgs["road_type_pred"][row]
+        fits = (~requ_road_type[row] | (road_type_pred == part_road_type)) & ~(
+            _is_null(road_type_pred) | (road_type_pred == "other")
+        )
+        row, part_id, part_dist = row[fits], part_id[fits], part_dist[fits]
+
+        # closest fitting partition
+        order = np.lexsort((part_dist, row))
+        row, part_id = row[order], part_id[order]
+        closest = _run_starts(row)
+        selection = _take(imgs, row[closest])
+        selection["part_id"] = part_id[closest]
+        return selection
+
+
+    def _group_predictions(self, eval_groups, votes, selection):
+        # aggregation_alg2.sql (join of votes and eval groups) and aggregation_alg3.sql
+        vote_keys = ["way_id", "group_num", "part_id"]
+        group_idx, vote_idx = _join_index(
+            [eval_groups[c] for c in ["id", "group_num", "part_id"]],
+            [votes[c] for c in vote_keys],
+        )
+        predictions = _take(eval_groups, group_idx)
+        for column, values in votes.items():
+            if column not in vote_keys:
+                predictions[column] = values[vote_idx]
+        group_keys = [predictions[c] for c in ["id", "group_num", "part_id"]]
+
+        # number of subsegments with selected images per group
+        _, first = _group_index(*[selection[c] for c in vote_keys + ["segment_id"]])
+        rated = [selection[c][first] for c in vote_keys]
+        rated_groups, rated_first = _group_index(*rated)
+        pred_idx, rated_idx = _join_index(group_keys, [k[rated_first] for k in rated])
+        n_rated = np.zeros(len(group_idx), dtype=np.int64)
+        n_rated[pred_idx] = np.bincount(rated_groups)[rated_idx]
+        predictions["n_rated_segments"] = n_rated
+
+        way_length = shapely.length(predictions["geometry"])
+        n_segments = np.ceil(way_length / N_SEGMENTS_LENGTH).astype(np.int64)
+        svc = predictions["segment_vote_count"]
+        predictions["way_length"] = way_length
+        predictions["n_segments"] = n_segments
+        predictions["conf_score"] = predictions["avg_rt_share"] * (svc / n_segments)
+
+        # no prediction for less than 2/3 of the subsegments rated, a type in less than 50%
+        # of the rated subsegments, or less than 3 images
+        keep = ~(
+            (n_rated < n_segments * (2.0 / 3.0))
+            | (svc / n_rated < 0.5)
+            | (predictions["n_imgs"] < 3)
+        )
+        predictions = _take(predictions, np.flatnonzero(keep))
+
+        # highest confidence score per group and partition (ties are kept)
+        groups, first = _group_index(
+            *[predictions[c] for c in ["id", "group_num", "part_id"]]
+        )
+        max_conf = _group_reduce(np.maximum, predictions["conf_score"], groups, len(first))
+        predictions = _take(
+            predictions, np.flatnonzero(predictions["conf_score"] == max_conf[groups])
+        )
+
+        # average quality of the selected images of the predicted type
+        quality_keys = vote_keys + ["type_pred"]
+        quality_groups, quality_first = _group_index(
+            *[selection[c] for c in quality_keys]
+        )
+        has_quality = ~np.isnan(selection["quality_pred"])
+        n_quality = np.bincount(
+            quality_groups[has_quality], minlength=len(quality_first)
+        )
+        sum_quality = np.bincount(
+            quality_groups[has_quality],
+            selection["quality_pred"][has_quality],
+            minlength=len(quality_first),
+        )
+        pred_idx, quality_idx = _join_index(
+            [predictions[c] for c in ["id", "group_num", "part_id", "type_pred"]],
+            [selection[c][quality_first] for c in quality_keys],
+        )
+        quali_pred = np.full(len(predictions["id"]), np.nan)
+        with np.errstate(invalid="ignore"):
+            quali_pred[pred_idx] = sum_quality[quality_idx] / n_quality[quality_idx]
+        predictions["quali_pred"] = quali_pred
+
+        # placeholders for groups without prediction
+        n_predictions = len(predictions["id"])
+        groups, _ = _group_index(
+            *[
+                np.concatenate([predictions[c], eval_groups[c]])
+                for c in ["id", "group_num", "part_id"]
+            ]
+        )
+        missing = np.flatnonzero(
+            ~np.isin(groups[n_predictions:], groups[:n_predictions])
+        )
+        grouping_ids = self._id_columns + ["id", "part_id", "group_num"]
+        result = _concat(
+            [
+                {c: predictions[c] for c in grouping_ids + ["road_type", "geometry"]},
+                {
+                    c: eval_groups[c][missing]
+                    for c in grouping_ids + ["road_type", "geometry"]
+                },
+            ]
+        )
+        for column in GROUP_PREDICTION_COLUMNS:
+            if column not in result:
+                result[column] = _pad(predictions[column], len(missing))
+        is_prediction = np.arange(len(result["id"])) < n_predictions
+
+        # one prediction per group: most subsegment votes, then most images per subsegment
+        groups, _ = _group_index(*[result[c] for c in grouping_ids])
+        order = np.lexsort(
+            (
+                -result["avg_img_counts"].astype(np.float64),
+                -result["segment_vote_count"].astype(np.float64),
+                groups,
+            )
+        )
+        best = order[_run_starts(groups[order])]
+
+        group_predictions = {}
+        for column in grouping_ids + GROUP_PREDICTION_COLUMNS:
+            values = result[column][best]
+            if column in GROUP_PREDICTION_COLUMNS and column not in ["road_type", "geometry"]:
+                valid = is_prediction[best]
+                if column == "quali_pred":
+                    valid &= ~np.isnan(values)
+                values = _nullable(values, valid)
+                if column in ["min_date", "max_date"]:
+                    values = _object_array(
+                        [
+                            None if v is None else datetime.fromtimestamp(v, timezone.utc)
+                            for v in values
+                        ]
+                    )
+            group_predictions[column] = values
+        return group_predictions
+
+
+def _group_votes(selection):
+    # aggregation_alg2.sql: majority vote of images per subsegment, then of subsegments per group
+    segment_parts, _ = _group_index(selection["segment_id"], selection["part_id"])
+    img_counts = np.bincount(segment_parts)[segment_parts]
+
+    voted = np.flatnonzero(~_is_null(selection["type_pred"]))
+    keys = ["way_id", "group_num", "segment_id", "part_id", "type_pred"]
+    votes, first = _group_index(*[selection[c][voted] for c in keys])
+    n_votes = len(first)
+    segment_votes = {c: selection[c][voted][first] for c in keys}
+    segment_votes["vote_count"] = np.bincount(votes, minlength=n_votes)
+    # captured_at in milliseconds, dates in seconds
+    seconds = selection["captured_at"][voted].astype(np.int64) // 1000
+    segment_votes["min_date"] = _group_reduce(np.minimum, seconds, votes, n_votes)
+    segment_votes["max_date"] = _group_reduce(np.maximum, seconds, votes, n_votes)
+    segment_votes["img_counts"] = img_counts[voted][first]
+    segment_votes["rt_share"] = segment_votes["vote_count"] / segment_votes["img_counts"]
+
+    # most frequent types per subsegment and partition (ties are kept)
+    segments, first = _group_index(*[segment_votes[c] for c in keys[:-1]])
+    max_votes = _group_reduce(
+        np.maximum, segment_votes["vote_count"], segments, len(first)
+    )
+    top = _take(
+        segment_votes, np.flatnonzero(segment_votes["vote_count"] == max_votes[segments])
+    )
+
+    group_keys = ["way_id", "group_num", "part_id", "type_pred"]
+    groups, first = _group_index(*[top[c] for c in group_keys])
+    n_groups = len(first)
+    group_votes = {c: top[c][first] for c in group_keys}
+    segment_vote_count = np.bincount(groups, minlength=n_groups)
+    n_imgs = np.bincount(groups, top["img_counts"], minlength=n_groups).astype(np.int64)
+    group_votes["segment_vote_count"] = segment_vote_count
+    group_votes["avg_img_counts"] = n_imgs / np.maximum(segment_vote_count, 1)
+    group_votes["n_imgs"] = n_imgs
+    group_votes["avg_rt_share"] = np.bincount(
+        groups, top["rt_share"], minlength=n_groups
+    ) / np.maximum(segment_vote_count, 1)
+    group_votes["min_date"] = _group_reduce(np.minimum, top["min_date"], groups, n_groups)
+    group_votes["max_date"] = _group_reduce(np.maximum, top["max_date"], groups, n_groups)
+    return group_votes
+
+
+def _interpolate(xy, dist, at, first, last):
+    # points at distance `at` (cumulative over all lines) along lines with vertices first..last
+    j = np.clip(np.searchsorted(dist, at, "right") - 1, first, last - 1)
+    step = dist[j + 1] - dist[j]
+    t = np.divide(at - dist[j], step, out=np.zeros_like(at), where=step > 0)
+    t = np.clip(t, 0, 1)
+    return xy[j] + t[:, None] * (xy[j + 1] - xy[j])
+
+
+def _take(table, idx):
+    return {column: values[idx] for column, values in table.items()}
+
+
+def _concat(tables):
+    return {
+        column: np.concatenate([table[column] for table in tables])
+        for column in tables[0]
+    }
+
+
+def _pad(values, n):
+    # append n (invalid) values of the same dtype
+    return np.concatenate([values, np.zeros(n, dtype=values.dtype)])
+
+
+def _concat_arrays(arrays, dtype):
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate([np.asarray(a, dtype=dtype) for a in arrays])
+
+
+def _object_array(items):
+    # one element per item, also if the items are sequences of equal length
+    array = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        array[i] = item
+    return array
+
+
+def _nullable(values, valid):
+    nullable = np.full(len(values), None, dtype=object)
+    nullable[valid] = values[valid].tolist()
+    return nullable
+
+
+def _is_null(values):
+    if values.dtype.kind == "f":
+        return np.isnan(values)
+    if values.dtype.kind != "O":
+        return np.zeros(len(values), dtype=bool)
+    return np.fromiter(
+        (v is None for v in values.tolist()), dtype=bool, count=len(values)
+    )
+
+
+def _codes(values):
+    # integer codes of the values of a column: equal values (and None) get equal codes
+    if values.dtype.kind != "O":
+        return np.unique(values, return_inverse=True)[1].reshape(-1)
+    index = {}
+    return np.fromiter(
+        (index.setdefault(v, len(index)) for v in values.tolist()),
+        dtype=np.int64,
+        count=len(values),
+    )
+
+
+def _run_starts(sorted_keys):
+    starts = np.ones(len(sorted_keys), dtype=bool)
+    starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return starts
+
+
+def _group_index(*columns):
+    """Group the rows of a table by the values of key columns.
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): group number (0 ... n_groups - 1) of every row
+        and the index of the first row of every group
+    """
+    if len(columns[0]) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    keys = np.stack([_codes(column) for column in columns], axis=1)
+    _, first, groups = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return groups.reshape(-1), first
+
+
+def _join_index(left, right):
+    """Row indices of the inner equi-join of two tables on key columns.
+
+    Args:
+        left (list(np.ndarray)): key columns of the left table
+        right (list(np.ndarray)): key columns of the right table, in the same order
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): indices of the joined rows in the left and in the right table
+    """
+    n_left = len(left[0])
+    keys, _ = _group_index(*[np.concatenate([l, r]) for l, r in zip(left, right)])
+    left_keys, right_keys = keys[:n_left], keys[n_left:]
+    order = np.argsort(right_keys, kind="stable")
+    starts = np.searchsorted(right_keys[order], left_keys, "left")
+    counts = np.searchsorted(right_keys[order], left_keys, "right") - starts
+    left_idx = np.repeat(np.arange(n_left), counts)
+    rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return left_idx, order[np.repeat(starts, counts) + rank]
+
+
+def _group_reduce(ufunc, values, groups, n_groups):
+    # reduce values per group (numbered 0 ... n_groups - 1 without gaps) with a ufunc, e.g. np.minimum
+    if n_groups == 0:
+        return values[:0]
+    order = np.argsort(groups, kind="stable")
+    starts = np.searchsorted(groups[order], np.arange(n_groups))
+    return ufunc.reduceat(values[order], starts)
+
+
+def columns_from_rows(rows, dtypes):
+    """Convert rows of a database query into columns.
+
+    Args:
+        rows (list): query result rows
+        dtypes (dict): column name -> numpy dtype, in order of the row values. "geometry" decodes
+            WKB (e.g., `ST_AsBinary(geom)`) into Shapely geometries, "array" keeps database arrays as np.ndarray.
+
+    Returns:
+        dict: column name -> np.ndarray
+    """
+    values = list(zip(*rows)) if len(rows) > 0 else [()] * len(dtypes)
+    columns = {}
+    for (column, dtype), column_values in zip(dtypes.items(), values):
+        if dtype == "geometry":
+            columns[column] = shapely.from_wkb([bytes(v) for v in column_values])
+        elif dtype == "array":
+            columns[column] = _object_array([np.asarray(v) for v in column_values])
+        else:
+            columns[column] = np.array(column_values, dtype=dtype)
+    return columns
+
+
+def rows_from_columns(columns, names, srid):
+    """Convert columns into rows for SurfaceDatabase.add_rows_to_table.
+
+    Geometries are encoded as hex EWKB with the given SRID, arrays as database array literals.
+
+    Args:
+        columns (dict): column name -> np.ndarray
+        names (list): names of the columns, in order of the row values
+        srid (int): SRID of the geometries
+
+    Returns:
+        list(tuple): rows
+    """
+    values = []
+    for name in names:
+        column = columns[name]
+        if column.dtype == object and len(column) > 0 and isinstance(
+            column[0], shapely.Geometry
+        ):
+            column = shapely.to_wkb(
+                shapely.set_srid(column, srid), hex=True, include_srid=True
+            ).tolist()
+        elif column.dtype == object and len(column) > 0 and isinstance(
+            column[0], np.ndarray
+        ):
+            column = ["{" + ",".join(map(str, v.tolist())) + "}" for v in column]
+        else:
+            column = column.tolist()
+        values.append(column)
+    return list(zip(*values))
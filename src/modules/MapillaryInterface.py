@@ -1,126 +1,314 @@
+import asyncio
 import concurrent.futures
 import io
 import logging
 import os
 import sys
+import threading
 import time
 from itertools import repeat
 from pathlib import Path
 
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectTimeout
 from tqdm import tqdm
-from vt2geojson.tools import vt_bytes_to_geojson
+
+try:
+    import httpx
+except ImportError:  # optional dependency for http2 and async downloads
+    httpx = None
 
 # local modules
 src_dir = Path(os.path.abspath(__file__)).parent.parent
 sys.path.append(str(src_dir))
 import constants as const
+from modules.VectorTile import decode_point_layer
 
 
 class MapillaryInterface:
     """Interface for Mapillary API to query image metadata and download images."""
 
-    def __init__(self, mapillary_token, parallel=True, parallel_batch_size=10):
+    def __init__(
+        self,
+        mapillary_token,
+        parallel=True,
+        parallel_batch_size=10,
+        download_mode="threads",
+        max_in_flight=None,
+        http2=False,
+        graph_batch_size=const.MAPILLARY_GRAPH_BATCH_SIZE,
+        image_cache=None,
+        offline=False,
+        tile_cache=None,
+        tile_url=const.MAPILLARY_TILE_URL,
+        graph_url=const.MAPILLARY_GRAPH_URL,
+        retry_backoff=1.0,
+    ):
         """Initializes a MapillaryInterface object.
                     Zoom level is defined in constants.py.
+                    All requests share one long-lived, connection-pooled HTTP client (keep-alive).
 
 
         Args:
             mapillary_token (str): Mapillary API token
             parallel (bool, optional): Download images in parallel. Defaults to False.
             parallel_batch_size (int, optional): Number of images to download in parallel. Defaults to 10.
+            download_mode (str, optional): "threads" (thread pool) or "async" (asyncio, requires httpx). Defaults to "threads".
+            max_in_flight (int, optional): Maximum number of concurrent requests in async mode, across all calls. Defaults to parallel_batch_size.
+            http2 (bool, optional): Use HTTP/2 (requires httpx with http2 extra). Defaults to False.
+            graph_batch_size (int, optional): Number of image ids per Graph API request to resolve image urls. Defaults to MAPILLARY_GRAPH_BATCH_SIZE.
+            image_cache (ImageCache, optional): Local image cache that is consulted before downloading. Defaults to None.
+            offline (bool, optional): Only serve images from image_cache, never download. Defaults to False.
+            tile_cache (TileCache, optional): Local cache of vector tiles for image metadata. Defaults to None.
+            tile_url (str, optional): url template of the vector tiles (coverage, z, x, y), e.g., of a local
+                stand-in server. Defaults to MAPILLARY_TILE_URL.
+            graph_url (str, optional): url template of the Graph API (path). Defaults to MAPILLARY_GRAPH_URL.
+            retry_backoff (float, optional): seconds to wait before the first retry of a request that was throttled
+                (429) or failed with a server error (MAPILLARY_RETRY_STATUSES), doubled with each further retry.
+                A Retry-After header of the response takes precedence. Defaults to 1.
         """
         self.token = mapillary_token
         self.parallel = parallel
         self.parallel_batch_size = parallel_batch_size
+        if download_mode not in const.DOWNLOAD_MODES:
+            raise ValueError(
+                f"Invalid download_mode {download_mode}, options: {const.DOWNLOAD_MODES}"
+            )
+        if (download_mode == "async" or http2) and httpx is None:
+            raise ImportError(
+                "httpx is required for async downloads and http2: pip install 'httpx[http2]'"
+            )
+        self.download_mode = download_mode
+        self.max_in_flight = max_in_flight or parallel_batch_size or 10
+        self.http2 = http2
+        self.graph_batch_size = graph_batch_size
+        if offline and image_cache is None:
+            raise ValueError("offline mode requires an image_cache")
+        self.image_cache = image_cache
+        self.offline = offline
+        self.tile_cache = tile_cache
+        self.tile_url = tile_url
+        self.graph_url = graph_url
+        self.retry_backoff = retry_backoff
+
+        pool_size = max(self.max_in_flight, parallel_batch_size or 1)
+        if http2:
+            self.client = httpx.Client(
+                http2=True,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=pool_size),
+            )
+        else:
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.client.mount("https://", adapter)
+            self.client.mount("http://", adapter)
+
+        self._executor = None
+        self._loop = None
+        self._loop_thread = None
+        self._async_client = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+        self._http_stats = {"requests": 0, "bytes": 0, "retries": 0}
+        self._stats_lock = threading.Lock()
+
+    def close(self):
+        """Close the HTTP clients and stop background workers."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(
+                self._async_client.aclose(), self._loop
+            ).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+            self._loop = None
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def http_stats(self):
+        """Number of HTTP requests sent (including failed ones), bytes received (response bodies) and
+        retries of throttled or failed requests.
+
+        Returns:
+            dict: requests, bytes and retries
+        """
+        with self._stats_lock:
+            return dict(self._http_stats)
+
+    def _record_request(self, response=None):
+        with self._stats_lock:
+            self._http_stats["requests"] += 1
+            if response is not None:
+                self._http_stats["bytes"] += len(response.content)
+
+    def _retry_wait(self, response, retries):
+        """Seconds to wait before retrying a throttled or failed request, or None if it is not to be retried."""
+        if response.status_code not in const.MAPILLARY_RETRY_STATUSES:
+            return None
+        with self._stats_lock:
+            self._http_stats["retries"] += 1
+        retry_after = response.headers.get("Retry-After")
+        try:
+            wait_time = float(retry_after)
+        except (TypeError, ValueError):
+            wait_time = self.retry_backoff * 2 ** (retries - 1)
+        logging.info(
+            f"Request failed with status {response.status_code}. Retrying in {wait_time} seconds..."
+        )
+        return wait_time
 
     def query_mapillary(
-        self, request_url, request_params, request_timeout=10, max_retries=10
+        self,
+        request_url,
+        request_params,
+        request_timeout=10,
+        max_retries=10,
+        request_headers=None,
     ):
         retries = 0
         while retries < max_retries:
             try:
-                response = requests.get(
+                response = self.client.get(
                     request_url,
                     params=request_params,
                     timeout=request_timeout,
+                    headers=request_headers,
                 )
-                if response.status_code != 200:
+                self._record_request(response)
+                wait_time = (
+                    self._retry_wait(response, retries + 1)
+                    if retries + 1 < max_retries
+                    else None
+                )
+                if wait_time is not None:
+                    retries += 1
+                    time.sleep(wait_time)
+                    continue
+                # 304: not modified (conditional request)
+                if response.status_code not in (200, 304):
                     logging.info(response.status_code)
-                    logging.info(response.reason)
+                    logging.info(_reason(response))
                     # logging.info(f"image_id: {img_id}")
                     return None
                 else:
                     return response
-            except ConnectTimeout:
+            except _CONNECT_TIMEOUTS:
+                self._record_request()
                 retries += 1
                 wait_time = (2 ** (retries - 1)) * 60
                 logging.info(
                     f"Connection timed out. Retrying in {wait_time/60} minutes..."
                 )
                 time.sleep(wait_time)
-            except requests.exceptions.RequestException as e:
+            except _REQUEST_ERRORS as e:
+                self._record_request()
                 logging.warning(f"Request failed: {e}")
                 return None
         return None
 
-    def metadata_in_tile(self, tile):
-        """Get metadata for all images within a tile from mapillary (based on https://graph.mapillary.com/:image_id endpoint)
+    def tile_content(self, tile):
+        """Get the vector tile of the image layer from the tile cache or Mapillary.
+
         Args:
             tile(mercantile.Tile): mercantile tile
 
         Returns:
-            tuple(list, list(list))): Metadata of all images within tile, including coordinates, as tuple: first element is list with column names ("header"). Second element is a list of list, each list representing one image.
+            bytes: vector tile content (protobuf), or None if not available
         """
-        header = [
-            "img_id",
-            "sequence_id",
-            "captured_at",
-            "compass_angle",
-            "is_pano",
-            "creator_id",
-            "lon",
-            "lat",
-        ]
+        request_url = self.tile_url.format(
+            const.TILE_COVERAGE, int(tile.z), int(tile.x), int(tile.y)
+        )
+        request_params = {"access_token": self.token}
+        if self.tile_cache is None:
+            response = self.query_mapillary(request_url, request_params)
+            return None if response is None else response.content
 
-        output = list()
+        cached = self.tile_cache.get(const.TILE_COVERAGE, tile)
+        if cached is not None and self.tile_cache.is_fresh(cached):
+            self.tile_cache.record("hit")
+            return cached.content
+
+        headers = (
+            {"If-None-Match": cached.etag}
+            if (cached is not None and cached.etag is not None)
+            else None
+        )
         response = self.query_mapillary(
-            const.MAPILLARY_TILE_URL.format(
-                const.TILE_COVERAGE, int(tile.z), int(tile.x), int(tile.y)
-            ),
-            {"access_token": self.token},
+            request_url, request_params, request_headers=headers
         )
         if response is None:
+            # serve the outdated tile rather than none
+            return None if cached is None else cached.content
+        if response.status_code == 304:
+            self.tile_cache.record("revalidated")
+            self.tile_cache.touch(const.TILE_COVERAGE, tile, cached.etag)
+            return cached.content
+
+        self.tile_cache.record("miss")
+        self.tile_cache.put(
+            const.TILE_COVERAGE, tile, response.content, response.headers.get("ETag")
+        )
+        return response.content
+
+    def metadata_columns_in_tile(self, tile):
+        """Get metadata for all images within a tile from mapillary as typed columns,
+        decoded directly from the vector tile.
+
+        Args:
+            tile(mercantile.Tile): mercantile tile
+
+        Returns:
+            dict: column name -> np.ndarray with columns img_id (int64), sequence_id (str), captured_at (int64),
+            compass_angle (float64), is_pano (bool), creator_id (int64), lon and lat (float64).
+            None if the tile is not available.
+        """
+        content = self.tile_content(tile)
+        if content is None:
+            return None
+        try:
+            columns = decode_point_layer(
+                content,
+                int(tile.x),
+                int(tile.y),
+                int(tile.z),
+                const.TILE_LAYER,
+                const.TILE_IMG_PROPERTIES,
+            )
+        except Exception as e:
+            logging.warning(f"Invalid vector tile {tile} with error:\n{e}")
+            return None
+        columns["img_id"] = columns.pop("id")
+        return columns
+
+    def metadata_in_tile(self, tile):
+        """Get metadata for all images within a tile from mapillary (based on https://graph.mapillary.com/:image_id endpoint)
+        Args:
+            tile(mercantile.Tile): mercantile tile
+
+        Returns:
+            tuple(list, list(list))): Metadata of all images within tile, including coordinates, as tuple: first element is list with column names ("header"). Second element is a list of list, each list representing one image.
+        """
+        header = const.IMG_METADATA_HEADER
+        columns = self.metadata_columns_in_tile(tile)
+        if columns is None:
             return (header, None)
-        else:
-            try:
-                data = vt_bytes_to_geojson(
-                    response.content, tile.x, tile.y, tile.z, layer=const.TILE_LAYER
-                )
-                # a feature is a point/image
-                for feature in data["features"]:
-                    output.append(
-                        [
-                            feature["properties"]["id"],
-                            feature["properties"]["sequence_id"],
-                            feature["properties"]["captured_at"],
-                            feature["properties"]["compass_angle"],
-                            feature["properties"]["is_pano"],
-                            feature["properties"]["creator_id"],
-                            feature["geometry"]["coordinates"][0],
-                            feature["geometry"]["coordinates"][1],
-                        ]
-                    )
-                return (header, output)
-            except Exception as e:
-                logging.warning(f"Invalid response for header {header} with error:\n{e}")
-                return (header, None)
+        output = [list(row) for row in zip(*[columns[h].tolist() for h in header])]
+        return (header, output)
 
     def query_img(self, img_id, img_size):
         response = self.query_mapillary(
-            const.MAPILLARY_GRAPH_URL.format(int(img_id)),
+            self.graph_url.format(int(img_id)),
             {
                 "fields": img_size,
                 "access_token": self.token,
@@ -139,41 +327,289 @@ class MapillaryInterface:
                 logging.warning(f"Invalid response for image {img_id} with error:\n{e}")
         return None
 
-    def query_imgs(self, img_ids, img_size):
+    def download_img(self, img_url):
+        """Download an image from its (thumbnail) url
+
+        Args:
+            img_url (str): url of the image, as resolved via the Graph API
+
+        Returns:
+            PIL.Image: image, or None if the download failed
+        """
+        return _open_img(self._download_img_content(img_url), img_url)
+
+    def _download_img_content(self, img_url):
+        if img_url is None:
+            return None
+        response = self.query_mapillary(img_url, {})
+        if response is not None:
+            return response.content
+        return None
+
+    def _query_img_url_batch(self, img_ids, img_size):
+        response = self.query_mapillary(
+            self.graph_url.format("images"),
+            self._img_url_params(img_ids, img_size),
+        )
+        return self._parse_img_urls(response, img_ids, img_size)
+
+    def _img_url_params(self, img_ids, img_size):
+        return {
+            "image_ids": ",".join(str(int(img_id)) for img_id in img_ids),
+            "fields": f"id,{img_size}",
+            "access_token": self.token,
+        }
+
+    def _parse_img_urls(self, response, img_ids, img_size):
+        img_urls = {}
+        if response is not None:
+            try:
+                for item in response.json()["data"]:
+                    if img_size in item:
+                        img_urls[str(item["id"])] = item[img_size]
+            except Exception as e:
+                logging.warning(
+                    f"Invalid response for image url batch of {len(img_ids)} images with error:\n{e}"
+                )
+        n_missing = len(img_ids) - len(img_urls)
+        if n_missing > 0:
+            logging.info(f"no image size {img_size} for {n_missing} images")
+        return img_urls
+
+    def _img_id_batches(self, img_ids):
+        return [
+            img_ids[i : i + self.graph_batch_size]
+            for i in range(0, len(img_ids), self.graph_batch_size)
+        ]
+
+    def query_img_urls(self, img_ids, img_size):
+        """Resolve image urls for given Mapillary img ids with batched Graph API requests
+        (`graph_batch_size` ids per request instead of one request per image).
+
+        Args:
+            img_ids (list): img ids to query urls for
+            img_size (str): Size of image (e.g. thumb_1024_url, thumb_2048_url, thumb_original_url)
+
+        Returns:
+            dict: img_id (as str) -> img_url. Images without url for the given size are omitted.
+        """
+        batches = self._img_id_batches(img_ids)
+        if self.parallel and self.download_mode == "async":
+            results = self._run_async(self._query_img_urls_async(batches, img_size))
+        elif self.parallel and len(batches) > 1:
+            results = self._get_executor().map(
+                self._query_img_url_batch, batches, repeat(img_size)
+            )
+        else:
+            results = [self._query_img_url_batch(batch, img_size) for batch in batches]
+
+        img_urls = {}
+        for result in results:
+            img_urls.update(result)
+        return img_urls
+
+    def _download_imgs(self, img_urls):
+        """Download image contents (bytes) of the given urls"""
+        if self.parallel and self.download_mode == "async":
+            return self._run_async(self._download_imgs_async(img_urls))
+
+        elif self.parallel:
+            # only download parallel_batch_size at a time (otherwise we get connectionErrors with Mapillary).
+            # The thread pool is long-lived and not bound to slices, so a slow request only blocks its own worker.
+            return list(self._get_executor().map(self._download_img_content, img_urls))
+
+        else:
+            return [self._download_img_content(img_url) for img_url in tqdm(img_urls)]
+
+    def _fetch_imgs(self, img_ids, img_size, known_urls):
+        urls = {str(img_id): known_urls.get(str(img_id)) for img_id in img_ids}
+        missing = [img_id for img_id in img_ids if urls[str(img_id)] is None]
+        if len(missing) > 0:
+            urls.update(self.query_img_urls(missing, img_size))
+
+        imgs = self._download_imgs([urls.get(str(img_id)) for img_id in img_ids])
+
+        # known urls may be outdated: resolve again and retry
+        retry = [
+            i
+            for i, img_id in enumerate(img_ids)
+            if imgs[i] is None and known_urls.get(str(img_id)) is not None
+        ]
+        if len(retry) > 0:
+            retry_urls = self.query_img_urls([img_ids[i] for i in retry], img_size)
+            known_urls.update(retry_urls)
+            retry_imgs = self._download_imgs(
+                [retry_urls.get(str(img_ids[i])) for i in retry]
+            )
+            for i, img in zip(retry, retry_imgs):
+                imgs[i] = img
+        return imgs
+
+    def query_imgs(self, img_ids, img_size, return_ids=False, img_urls=None, decode=True):
         """Query img content urls for given Mapillary img ids
 
         Args:
             img_ids (list): img ids to query urls for
             img_size (str): Size of image to download (e.g. thumb_1024_url, thumb_2048_url, thumb_original_url)
+            return_ids (bool, optional): additionally return the ids of the successfully downloaded images. Defaults to False.
+            img_urls (dict, optional): already known img_id (as str) -> img_url, e.g. persisted in the database.
+                Urls are only resolved for the remaining images; urls resolved again after a failed download are
+                updated in the dict. Defaults to None.
+            decode (bool, optional): return PIL images; otherwise the encoded image contents (bytes), e.g., for
+                preprocessing in worker processes. Invalid contents are skipped in both cases. Defaults to True.
 
         Returns:
-            list: img_urls
+            list: img_urls (if return_ids: tuple of img_ids and imgs)
         """
-        imgs = []
+        contents = [None] * len(img_ids)
+        if self.image_cache is not None:
+            contents = [self.image_cache.get(img_id, img_size) for img_id in img_ids]
 
-        if self.parallel:
-            # only download batch_size at a time (otherwise we get connectionErrors with Mapillary)
-            if (self.parallel_batch_size is None) or (
-                self.parallel_batch_size > len(img_ids)
-            ):
-                parallel_batch_size = len(img_ids)
-            else:
-                parallel_batch_size = self.parallel_batch_size
-
-            for i in range(0, len(img_ids), parallel_batch_size):
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    j = min(i + parallel_batch_size, len(img_ids))
-
-                    batch_imgs = list(
-                        executor.map(self.query_img, img_ids[i:j], repeat(img_size))
-                    )
-                    imgs.extend(batch_imgs)
+        to_download = [i for i, content in enumerate(contents) if content is None]
+        if len(to_download) > 0 and not self.offline:
+            fetched = self._fetch_imgs(
+                [img_ids[i] for i in to_download], img_size, {} if img_urls is None else img_urls
+            )
+            for i, content in zip(to_download, fetched):
+                contents[i] = content
 
-        else:
-            for i in tqdm(range(0, len(img_ids))):
-                img_id = img_ids[i]
-                img = self.query_img(img_id, img_size)
-                imgs.append(img)
+        to_cache = set(to_download) if self.image_cache is not None else set()
+        imgs = []
+        for i, (img_id, content) in enumerate(zip(img_ids, contents)):
+            img = _open_img(content, img_id)
+            if img is not None and i in to_cache:
+                self.image_cache.put(img_id, img_size, content)
+            imgs.append(img if decode or img is None else content)
+
+        if return_ids:
+            downloaded = [
+                (img_id, img) for img_id, img in zip(img_ids, imgs) if img is not None
+            ]
+            return [img_id for img_id, _ in downloaded], [img for _, img in downloaded]
 
         imgs = [item for item in imgs if item is not None]
         return imgs
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.parallel_batch_size or None,
+                    thread_name_prefix="mapillary-download",
+                )
+            return self._executor
+
+    def _run_async(self, coroutine):
+        """Run a coroutine on the event loop of this interface (started on first use) and wait for the result."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name="mapillary-async",
+                    daemon=True,
+                )
+                self._loop_thread.start()
+                asyncio.run_coroutine_threadsafe(
+                    self._init_async_client(), self._loop
+                ).result()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _init_async_client(self):
+        self._async_client = httpx.AsyncClient(
+            http2=self.http2,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.max_in_flight),
+        )
+        # global limit of requests in flight, shared by all concurrent query_imgs calls
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def _query_mapillary_async(
+        self, request_url, request_params, request_timeout=10, max_retries=10
+    ):
+        retries = 0
+        while retries < max_retries:
+            try:
+                async with self._semaphore:
+                    response = await self._async_client.get(
+                        request_url, params=request_params, timeout=request_timeout
+                    )
+                self._record_request(response)
+                wait_time = (
+                    self._retry_wait(response, retries + 1)
+                    if retries + 1 < max_retries
+                    else None
+                )
+                if wait_time is not None:
+                    retries += 1
+                    await asyncio.sleep(wait_time)
+                    continue
+                if response.status_code != 200:
+                    logging.info(response.status_code)
+                    logging.info(_reason(response))
+                    return None
+                else:
+                    return response
+            except httpx.ConnectTimeout:
+                self._record_request()
+                retries += 1
+                wait_time = (2 ** (retries - 1)) * 60
+                logging.info(
+                    f"Connection timed out. Retrying in {wait_time/60} minutes..."
+                )
+                await asyncio.sleep(wait_time)
+            except httpx.HTTPError as e:
+                self._record_request()
+                logging.warning(f"Request failed: {e}")
+                return None
+        return None
+
+    async def _download_img_async(self, img_url):
+        if img_url is None:
+            return None
+        response = await self._query_mapillary_async(img_url, {})
+        if response is not None:
+            return response.content
+        return None
+
+    async def _download_imgs_async(self, img_urls):
+        return await asyncio.gather(
+            *[self._download_img_async(img_url) for img_url in img_urls]
+        )
+
+    async def _query_img_url_batch_async(self, img_ids, img_size):
+        response = await self._query_mapillary_async(
+            self.graph_url.format("images"),
+            self._img_url_params(img_ids, img_size),
+        )
+        return self._parse_img_urls(response, img_ids, img_size)
+
+    async def _query_img_urls_async(self, batches, img_size):
+        return await asyncio.gather(
+            *[self._query_img_url_batch_async(batch, img_size) for batch in batches]
+        )
+
+
+def _open_img(content, name):
+    if content is None:
+        return None
+    try:
+        return Image.open(io.BytesIO(content))
+    except Exception as e:
+        logging.warning(f"Invalid image content for {name} with error:\n{e}")
+        return None
+
+
+def _reason(response):
+    # requests: reason, httpx: reason_phrase
+    return getattr(response, "reason", None) or getattr(response, "reason_phrase", "")
+
+
+_CONNECT_TIMEOUTS = (
+    (ConnectTimeout,) if httpx is None else (ConnectTimeout, httpx.ConnectTimeout)
+)
+_REQUEST_ERRORS = (
+    (requests.exceptions.RequestException,)
+    if httpx is None
+    else (requests.exceptions.RequestException, httpx.HTTPError)
+)
@@ -1,11 +1,16 @@
+import concurrent.futures
+import io
+import logging
 import os
 import sys
+import threading
 # from torch.utils.data import Subset
 from functools import partial
 from pathlib import Path
 
 import torch
 from huggingface_hub import hf_hub_download
+from PIL import Image
 from torch import Tensor, nn
 from torchvision import models, transforms
 
@@ -14,10 +19,88 @@ src_dir = Path(os.path.abspath(__file__)).parent.parent
 sys.path.append(str(src_dir))
 
 import constants as const
+from modules import Preprocessing as pp
+from modules.InferenceBackend import (
+    build_backend,
+    check_parity,
+    is_consistent,
+    reduce_precision,
+)
+
+
+class ModelRegistry:
+    """Process-wide store of loaded models.
+
+    Each model file is resolved (and downloaded, if required) and loaded only once per device.
+    The model is then kept resident in eval mode, so that subsequent batches and further areas
+    of interest in the same process reuse it instead of reading the checkpoint again.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.load_count = 0
+        self.hit_count = 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def get(self, key, loader):
+        """Get a model from the registry, loading it with `loader` if it is not resident yet.
+
+        Args:
+            key (tuple): unique key of the model, e.g. (model path, device)
+            loader (callable): function without arguments that returns the loaded model entry
+
+        Returns:
+            object: the registry entry as returned by `loader`
+        """
+        # concurrent requests for the same key wait for a single load
+        with self._key_lock(key):
+            with self._lock:
+                if key in self._models:
+                    self.hit_count += 1
+                    return self._models[key]
+            entry = loader()
+            with self._lock:
+                self._models[key] = entry
+                self.load_count += 1
+            return entry
+
+    def is_resident(self, key):
+        with self._lock:
+            return key in self._models
+
+    def stats(self):
+        """Load and hit counters of the registry.
+
+        Returns:
+            dict: number of loads, cache hits and resident models
+        """
+        with self._lock:
+            return {
+                "loads": self.load_count,
+                "hits": self.hit_count,
+                "resident": len(self._models),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._models = {}
+            self.load_count = 0
+            self.hit_count = 0
+
+
+# shared by all ModelInterface instances of a process (e.g., multiple areas of interest)
+model_registry = ModelRegistry()
 
 
 class ModelInterface:
-    def __init__(self, config):
+    def __init__(self, config, registry=None):
         # TODO: doc string
         self.device = torch.device(
             f"cuda:{config.get('gpu_kernel')}" if torch.cuda.is_available() else "cpu"
@@ -34,29 +117,56 @@ class ModelInterface:
         self.models = config.get("models")
         self.batch_size = config.get("batch_size")
         self.hf_model_repo = config.get("hf_model_repo")
+        self.registry = registry if registry is not None else model_registry
+        self.inference_backend = config.get("inference_backend", "eager")
+        if self.inference_backend not in const.INFERENCE_BACKENDS:
+            raise ValueError(
+                f"Invalid inference_backend {self.inference_backend}, options: {const.INFERENCE_BACKENDS}"
+            )
+        self.inference_precision = config.get("inference_precision", "fp32")
+        if self.inference_precision not in const.INFERENCE_PRECISIONS:
+            raise ValueError(
+                f"Invalid inference_precision {self.inference_precision}, options: {const.INFERENCE_PRECISIONS}"
+            )
+        if self.inference_precision.startswith("int8") and self.device.type != "cpu":
+            raise ValueError(
+                f"inference_precision {self.inference_precision} is only supported on CPU"
+            )
+        self.preprocessing_engine = config.get("preprocessing_engine", "transforms")
+        if self.preprocessing_engine not in const.PREPROCESSING_ENGINES:
+            raise ValueError(
+                f"Invalid preprocessing_engine {self.preprocessing_engine}, options: {const.PREPROCESSING_ENGINES}"
+            )
+        self.preprocessing_workers = config.get("preprocessing_workers", 0)
+        self.batch_buffers = config.get("batch_buffers", 0)
+        if (
+            self.preprocessing_engine == "decode_once"
+            or self.preprocessing_workers > 0
+            or self.batch_buffers > 0
+        ) and (
+            self.transform_surface.get("resize") is None
+            or self.transform_road_type.get("resize") is None
+        ):
+            raise ValueError(
+                "preprocessing_engine decode_once, preprocessing_workers and batch_buffers require a resize of both transforms"
+            )
+        self._buffer_pools = {}
+        self._buffer_pools_lock = threading.Lock()
+        self.calibration_imgs = config.get("calibration_imgs")
+        if self.inference_precision == "int8_static" and self.calibration_imgs is None:
+            raise ValueError(
+                "inference_precision int8_static requires a folder of calibration_imgs"
+            )
+
+    crop_region = staticmethod(pp.crop_region)
 
     @staticmethod
     def custom_crop(img, crop_style=None):
-        im_width, im_height = img.size
-        if crop_style == const.CROP_LOWER_MIDDLE_THIRD:
-            top = im_height / 3 * 2
-            left = im_width / 3
-            height = im_height - top
-            width = im_width / 3
-        elif crop_style == const.CROP_LOWER_MIDDLE_HALF:
-            top = im_height / 2
-            left = im_width / 4
-            height = im_height / 2
-            width = im_width / 2
-        elif crop_style == const.CROP_LOWER_HALF:
-            top = im_height / 2
-            left = 0
-            height = im_height / 2
-            width = im_width
-        else:  # None, or not valid
+        region = ModelInterface.crop_region(*img.size, crop_style)
+        if region is None:
             return img
 
-        cropped_img = transforms.functional.crop(img, top, left, height, width)
+        cropped_img = transforms.functional.crop(img, *region)
         return cropped_img
 
     def transform(
@@ -104,6 +214,76 @@ class ModelInterface:
         img_data = torch.stack([transform(img) for img in img_data_raw])
         return img_data
 
+    def decode_once_preprocessing(self, img_data_raw, transforms_, out=None, draft=True):
+        """Transform raw images for several models at once, decoding each image only once (see
+        Preprocessing.decode_crops). The uint8 crops are collected in one array per transform (a reusable buffer
+        with `batch_buffers`), which is converted and normalized as a whole.
+
+        Args:
+            img_data_raw (list(PIL.Image or bytes)): images of the batch
+            transforms_ (list(dict)): transforms with keys resize (required), crop and normalize
+            out (list(Tensor), optional): float buffers (N, 3, H, W) per transform to write into. Defaults to None.
+            draft (bool, optional): decode JPEGs at a reduced DCT scale, if large enough. Without, the tensors equal
+                those of the torchvision transforms. Defaults to True.
+
+        Returns:
+            list(Tensor): input batch per transform
+        """
+        crops = [transform.get("crop") for transform in transforms_]
+        sizes = [pp.resize_size(transform["resize"]) for transform in transforms_]
+        draft = pp.draft_size(crops, sizes) if draft else None
+        pool = None
+        if self.batch_buffers > 0:
+            pool = self._buffer_pool(
+                [(self.batch_size, height, width, 3) for height, width in sizes],
+                n_buffers=1,
+                dtype=torch.uint8,
+            )
+            crop_buffers = pool.acquire(len(img_data_raw))
+        else:
+            crop_buffers = [
+                torch.empty((len(img_data_raw), height, width, 3), dtype=torch.uint8)
+                for height, width in sizes
+            ]
+        try:
+            batches = [buffer.numpy() for buffer in crop_buffers]
+            for i, img in enumerate(img_data_raw):
+                pp.decode_crops(img, crops, sizes, draft, batches, i)
+            return [
+                pp.to_tensor(batch, transform.get("normalize"), None if out is None else out[k])
+                for k, (batch, transform) in enumerate(zip(batches, transforms_))
+            ]
+        finally:
+            if pool is not None:
+                pool.release(crop_buffers)
+
+    def _buffer_pool(self, shapes, n_buffers, dtype=torch.float32):
+        """Reusable batch buffers of the given shapes (see Preprocessing.BufferPool), created on first use."""
+        key = (tuple(shapes), dtype)
+        with self._buffer_pools_lock:
+            if key not in self._buffer_pools:
+                self._buffer_pools[key] = pp.BufferPool(n_buffers, shapes, dtype)
+            return self._buffer_pools[key]
+
+    def _input_buffer_pool(self):
+        shapes = [
+            (self.batch_size, 3, *pp.resize_size(transform["resize"]))
+            for transform in [self.transform_road_type, self.transform_surface]
+        ]
+        return self._buffer_pool(shapes, self.batch_buffers)
+
+    def release_batch(self, road_data, surface_data):
+        """Return the input buffers of a batch (see `batch_preprocessing`) for reuse by subsequent batches."""
+        if self.batch_buffers > 0:
+            self._input_buffer_pool().release([road_data, surface_data])
+
+    def buffer_stats(self):
+        """Statistics of the reusable batch buffers (see Preprocessing.BufferPool.stats)."""
+        with self._buffer_pools_lock:
+            pools = list(self._buffer_pools.values())
+        stats = [pool.stats() for pool in pools]
+        return {key: sum(s[key] for s in stats) for key in ["buffers", "misses", "bytes"]}
+
     def load_model(self, model):
         model_path = Path(self.model_root) / model
         # load model data from hugging face if not locally available
@@ -127,6 +307,142 @@ class ModelInterface:
 
         return model, class_to_idx, is_regression
 
+    def _model_key(self, model):
+        return (
+            str(Path(self.model_root) / model),
+            str(self.device),
+            self.inference_backend,
+            self.inference_precision,
+        )
+
+    def _model_transform(self, model):
+        return (
+            self.transform_road_type
+            if model == self.models.get("road_type")
+            else self.transform_surface
+        )
+
+    def _example_input(self, model, batch_size=2):
+        """Random input batch of a model, shaped by its transform."""
+        resize = self._model_transform(model).get("resize") or const.INFERENCE_EXAMPLE_SIZE
+        if isinstance(resize, int):
+            resize = (resize, resize)
+        return torch.rand(batch_size, 3, *resize, device=self.device)
+
+    def _calibration_batches(self, model):
+        """Batches of the calibration images (at most QUANTIZATION_CALIBRATION_IMGS), transformed for a model."""
+        img_files = sorted(
+            file
+            for file in Path(self.calibration_imgs).iterdir()
+            if file.suffix.lower() in [".jpg", ".jpeg", ".png"]
+        )[: const.QUANTIZATION_CALIBRATION_IMGS]
+        if len(img_files) == 0:
+            raise ValueError(f"No calibration images found in {self.calibration_imgs}")
+        transform = self._model_transform(model)
+        batches = []
+        for i in range(0, len(img_files), self.batch_size):
+            imgs = [Image.open(file).convert("RGB") for file in img_files[i : i + self.batch_size]]
+            batches.append(self.preprocessing(imgs, transform))
+        return batches
+
+    def _apply_precision(self, model, model_file):
+        """Convert an eager model to the configured inference precision."""
+        if self.inference_precision == "fp32":
+            return model
+        return reduce_precision(
+            self.inference_precision,
+            model,
+            self._example_input(model_file),
+            calibration_batches=(
+                self._calibration_batches(model_file)
+                if self.inference_precision == "int8_static"
+                else None
+            ),
+        )
+
+    def _apply_backend(self, model, model_file):
+        """Run an eager model with the configured inference backend. Falls back to the eager model if the
+        backend does not match its predictions on a random batch."""
+        if self.inference_backend == "eager":
+            return model
+        example = self._example_input(model_file)
+        model_path = Path(self.model_root) / model_file
+        backend_model = build_backend(
+            self.inference_backend,
+            model,
+            example,
+            # an export per precision, e.g., surface_type_v1.int8_static.onnx
+            onnx_path=model_path.with_suffix(f".{self.inference_precision}.onnx"),
+            checkpoint_path=model_path,
+        )
+        check = check_parity(model, backend_model, example)
+        if not is_consistent(check):
+            logging.warning(
+                f"Inference backend {self.inference_backend} deviates from eager model {model_file} "
+                f"(class agreement {check['class_agreement']:.2f}, max. difference {check['max_value_diff']:.2e}), "
+                "using eager model."
+            )
+            return model
+        return backend_model
+
+    def _load_resident_model(self, model):
+        model_file = model
+        model, class_to_idx, is_regression = self.load_model(model_file)
+        model.to(self.device)
+        model.eval()
+        model = self._apply_precision(model, model_file)
+        model = self._apply_backend(model, model_file)
+        return model, class_to_idx, is_regression
+
+    def get_model(self, model):
+        """Get a model from the model registry. The model is only loaded on first access.
+
+        Args:
+            model (str): model file, relative to `model_root`
+
+        Returns:
+            tuple: model (on device, in eval mode), class_to_idx, is_regression
+        """
+        return self.registry.get(
+            self._model_key(model), partial(self._load_resident_model, model)
+        )
+
+    def model_files(self):
+        """All model files referenced in the `models` configuration."""
+        files = []
+        for value in self.models.values():
+            if isinstance(value, dict):
+                files.extend(value.values())
+            elif value is not None:
+                files.append(value)
+        return files
+
+    def preload_models(self, max_workers=None):
+        """Resolve, download and load all configured models in background threads.
+        Returns immediately; `get_model` blocks until the respective model is loaded.
+
+        Args:
+            max_workers (int, optional): number of loader threads. Defaults to one per model.
+
+        Returns:
+            list(concurrent.futures.Future): one future per model file
+        """
+        model_files = [
+            model
+            for model in self.model_files()
+            if not self.registry.is_resident(self._model_key(model))
+        ]
+        if len(model_files) == 0:
+            return []
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(model_files)
+        )
+        futures = [executor.submit(self.get_model, model) for model in model_files]
+        for future in futures:
+            future.add_done_callback(_log_preload_error)
+        executor.shutdown(wait=False)
+        return futures
+
     def predict(self, model, data):
         model.to(self.device)
         model.eval()
@@ -139,17 +455,89 @@ class ModelInterface:
 
         return batch_classes, batch_values
 
-    def batch_classifications(self, img_data_raw):
+    def batch_preprocessing(self, img_data_raw):
+        """Transform raw images into the input tensors of the road type and surface models.
+        Encoded images are preprocessed by the worker processes, if `preprocessing_workers` is set.
+        With `batch_buffers`, the tensors are views of reusable buffers, which are to be returned with
+        `release_batch` once the batch is classified.
+
+        Args:
+            img_data_raw (list(PIL.Image or bytes)): images of the batch
+
+        Returns:
+            tuple(Tensor, Tensor): road type model input, surface model input
+        """
+        transforms_ = [self.transform_road_type, self.transform_surface]
+        out = None
+        if self.batch_buffers > 0:
+            out = self._input_buffer_pool().acquire(len(img_data_raw))
+        try:
+            if self.preprocessing_workers > 0 and all(
+                isinstance(img, bytes) for img in img_data_raw
+            ):
+                road_data, surface_data = pp.get_pool(
+                    self.preprocessing_workers
+                ).preprocess(img_data_raw, transforms_, out=out)
+                return road_data, surface_data
+            if self.preprocessing_engine == "decode_once" or out is not None:
+                # with buffers, the transforms engine is run as decode_once at full scale: uint8 crops,
+                # converted and normalized batch-wise in the buffers, with the same tensors as the transforms
+                road_data, surface_data = self.decode_once_preprocessing(
+                    img_data_raw,
+                    transforms_,
+                    out=out,
+                    draft=self.preprocessing_engine == "decode_once",
+                )
+                return road_data, surface_data
+        except Exception:
+            if out is not None:
+                self.release_batch(*out)
+            raise
+
+        img_data_raw = [
+            Image.open(io.BytesIO(img)) if isinstance(img, bytes) else img
+            for img in img_data_raw
+        ]
+        road_data = self.preprocessing(img_data_raw, self.transform_road_type)
+        surface_data = self.preprocessing(img_data_raw, self.transform_surface)
+        return road_data, surface_data
+
+    def _sub_batches(self, data, indices):
+        """Rows `indices` of a batch. With `batch_buffers`, contiguous rows are a view and others are copied
+        chunk-wise (QUALITY_SUB_BATCH_SIZE rows) into a reusable buffer; otherwise they are copied at once."""
+        if self.batch_buffers == 0:
+            yield data[indices]
+            return
+        if indices == list(range(indices[0], indices[-1] + 1)):
+            yield data[indices[0] : indices[-1] + 1]
+            return
+        pool = self._buffer_pool(
+            [(const.QUALITY_SUB_BATCH_SIZE, *data.shape[1:])], n_buffers=1
+        )
+        index = torch.tensor(indices)
+        for start in range(0, len(indices), const.QUALITY_SUB_BATCH_SIZE):
+            chunk = index[start : start + const.QUALITY_SUB_BATCH_SIZE]
+            sub_data = pool.acquire(len(chunk))
+            try:
+                torch.index_select(data, 0, chunk, out=sub_data[0])
+                yield sub_data[0]
+            finally:
+                pool.release(sub_data)
+
+    def batch_inference(self, road_data, surface_data):
+        """Classify preprocessed image batches (see `batch_preprocessing`).
+
+        Returns:
+            list(list): per image: road type, road type probability, surface type, surface type probability, quality value
+        """
         # road type
-        model, _, _ = self.load_model(model=self.models.get("road_type"))
-        data = self.preprocessing(img_data_raw, self.transform_road_type)
-        road_pred_classes, road_pred_values = self.predict(model, data)
+        model, _, _ = self.get_model(self.models.get("road_type"))
+        road_pred_classes, road_pred_values = self.predict(model, road_data)
         road_pred_values = [round(value, 5) for value in road_pred_values]
 
         # surface type
-        model, _, _ = self.load_model(model=self.models.get("surface_type"))
-        data = self.preprocessing(img_data_raw, self.transform_surface)
-        surface_pred_classes, surface_pred_values = self.predict(model, data)
+        model, _, _ = self.get_model(self.models.get("surface_type"))
+        surface_pred_classes, surface_pred_values = self.predict(model, surface_data)
         surface_pred_values = [round(value, 5) for value in surface_pred_values]
 
         # surface quality
@@ -161,21 +549,22 @@ class ModelInterface:
                 surface_indices[surface_type] = []
             surface_indices[surface_type].append(i)
 
-        quality_pred_values = [None] * len(img_data_raw)
+        quality_pred_values = [None] * len(surface_data)
         for surface_type, indices in surface_indices.items():
             sub_model = sub_models.get(surface_type)
             if sub_model is not None:
-                model, _, _ = self.load_model(model=sub_model)
-                sub_data = data[indices]
-                _, pred_values = self.predict(model, sub_data)
-                pred_values = [round(value, 5) for value in pred_values]
+                model, _, _ = self.get_model(sub_model)
+                pred_values = []
+                for sub_data in self._sub_batches(surface_data, indices):
+                    _, values = self.predict(model, sub_data)
+                    pred_values += [round(value, 5) for value in values]
 
                 for i, idx in enumerate(indices):
                     quality_pred_values[idx] = pred_values[i]
 
         # final results combination
         final_results = []
-        for i in range(len(img_data_raw)):
+        for i in range(len(surface_data)):
             road = road_pred_classes[i]
             road_prob = road_pred_values[i]
             surface = surface_pred_classes[i]
@@ -188,6 +577,18 @@ class ModelInterface:
 
         return final_results
 
+    def batch_classifications(self, img_data_raw):
+        road_data, surface_data = self.batch_preprocessing(img_data_raw)
+        try:
+            return self.batch_inference(road_data, surface_data)
+        finally:
+            self.release_batch(road_data, surface_data)
+
+
+def _log_preload_error(future):
+    if future.exception() is not None:
+        logging.warning(f"Preloading model failed with error:\n{future.exception()}")
+
 
 class CustomEfficientNetV2SLinear(nn.Module):
     def __init__(self, num_classes, class_to_idx={}, avg_pool=1):
@@ -0,0 +1,308 @@
+"""Decoding, cropping and resizing of images into uint8 batch arrays, and their conversion into normalized model
+input tensors. PreprocessingPool runs the decoding in worker processes, which write into shared memory;
+BufferPool provides reusable preallocated batch buffers.
+"""
+
+import atexit
+import concurrent.futures
+import io
+import math
+import multiprocessing
+import os
+import sys
+import threading
+from multiprocessing import shared_memory
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+# local modules
+src_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(src_dir))
+import constants as const
+
+
+def crop_region(im_width, im_height, crop_style=None):
+    """Region of a crop style within an image.
+
+    Returns:
+        tuple or None: top, left, height, width (None for no crop)
+    """
+    if crop_style == const.CROP_LOWER_MIDDLE_THIRD:
+        top = im_height / 3 * 2
+        left = im_width / 3
+        height = im_height - top
+        width = im_width / 3
+    elif crop_style == const.CROP_LOWER_MIDDLE_HALF:
+        top = im_height / 2
+        left = im_width / 4
+        height = im_height / 2
+        width = im_width / 2
+    elif crop_style == const.CROP_LOWER_HALF:
+        top = im_height / 2
+        left = 0
+        height = im_height / 2
+        width = im_width
+    else:  # None, or not valid
+        return None
+    return top, left, height, width
+
+
+def resize_size(resize):
+    """Target size (height, width) of a transform's resize."""
+    return (resize, resize) if isinstance(resize, int) else tuple(resize)
+
+
+def draft_size(crops, sizes):
+    """Smallest image size (width, height) from which all crops can be resized to their sizes without upscaling."""
+    width, height = 0, 0
+    for crop, (target_height, target_width) in zip(crops, sizes):
+        _, _, crop_height, crop_width = crop_region(1, 1, crop) or (0, 0, 1, 1)
+        width = max(width, math.ceil(target_width / crop_width))
+        height = max(height, math.ceil(target_height / crop_height))
+    return width, height
+
+
+def decode_crops(img, crops, sizes, draft, outputs, i):
+    """Decode an image once and write its resized crops into row i of the uint8 batch arrays.
+
+    With a draft size, JPEG images not loaded yet are decoded at the smallest DCT scale (PIL draft mode: 1/2, 1/4
+    or 1/8) that still covers it.
+
+    Args:
+        img (PIL.Image or bytes): image, or its encoded content
+        crops (list(str)): crop style per output
+        sizes (list(tuple)): size (height, width) per output
+        draft (tuple or None): minimum decoded size (width, height), see draft_size. None decodes at full size.
+        outputs (list(np.ndarray)): uint8 batch arrays of shape (N, height, width, 3)
+        i (int): row of the image in the outputs
+    """
+    if isinstance(img, (bytes, bytearray)):
+        img = Image.open(io.BytesIO(img))
+    if draft is not None and img.format == "JPEG" and getattr(img, "im", None) is None:
+        img.draft("RGB", draft)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    for crop, (height, width), output in zip(crops, sizes, outputs):
+        region = crop_region(*img.size, crop)
+        cropped = img
+        if region is not None:
+            top, left, crop_height, crop_width = region
+            # as torchvision's crop of PIL images
+            cropped = img.crop((left, top, left + crop_width, top + crop_height))
+        output[i] = np.asarray(cropped.resize((width, height), Image.BILINEAR))
+
+
+def to_tensor(batch, normalize=None, out=None):
+    """Convert a uint8 batch array (N, H, W, 3) into a float tensor (N, 3, H, W) in [0, 1], normalized batch-wise
+    with normalize = (mean, sd) per channel, if given. With `out`, the tensor is written into this buffer."""
+    if out is None:
+        data = torch.from_numpy(batch).permute(0, 3, 1, 2).contiguous().float()
+    else:
+        data = out.copy_(torch.from_numpy(batch).permute(0, 3, 1, 2))
+    data.div_(255)
+    if normalize is not None:
+        mean, sd = (torch.tensor(values).view(1, 3, 1, 1) for values in normalize)
+        data.sub_(mean).div_(sd)
+    return data
+
+
+class BufferPool:
+    """A fixed number of reusable, preallocated buffers. Each buffer is a list of tensors of the given shapes,
+    whose first dimension is the batch capacity. `acquire` hands out views of the first n rows of a free buffer,
+    `release` returns it. If all buffers are in use or n exceeds the capacity, a temporary buffer is allocated
+    instead (counted in `misses`), i.e., callers never wait for a buffer."""
+
+    def __init__(self, n_buffers, shapes, dtype=torch.float32):
+        """Initializes a BufferPool. Buffers are allocated on first use.
+
+        Args:
+            n_buffers (int): number of reusable buffers
+            shapes (list(tuple)): shape of each tensor of a buffer, batch capacity first
+            dtype (torch.dtype, optional): Defaults to torch.float32.
+        """
+        self.n_buffers = n_buffers
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.dtype = dtype
+        self._buffers = []
+        self._free = []
+        self._lock = threading.Lock()
+        self.misses = 0
+
+    def acquire(self, n):
+        """Views of the first n rows of a free buffer (or a temporary buffer).
+
+        Returns:
+            list(Tensor): one tensor per shape
+        """
+        buffer = None
+        with self._lock:
+            if n <= self.shapes[0][0]:
+                if len(self._free) > 0:
+                    buffer = self._buffers[self._free.pop()]
+                elif len(self._buffers) < self.n_buffers:
+                    buffer = [torch.empty(shape, dtype=self.dtype) for shape in self.shapes]
+                    self._buffers.append(buffer)
+            if buffer is None:
+                self.misses += 1
+        if buffer is None:
+            return [torch.empty((n, *shape[1:]), dtype=self.dtype) for shape in self.shapes]
+        return [tensor[:n] for tensor in buffer]
+
+    def release(self, views):
+        """Return a buffer, given the views handed out by `acquire`. Temporary buffers are ignored."""
+        data_ptr = views[0].data_ptr()
+        with self._lock:
+            for i, buffer in enumerate(self._buffers):
+                if buffer[0].data_ptr() == data_ptr and i not in self._free:
+                    self._free.append(i)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "buffers": len(self._buffers),
+                "free": len(self._free) + self.n_buffers - len(self._buffers),
+                "misses": self.misses,
+                "bytes": sum(t.nbytes for buffer in self._buffers for t in buffer),
+            }
+
+
+class PreprocessingPool:
+    """Worker processes that decode, crop and resize encoded images (see decode_crops). Each worker writes into
+    its rows of uint8 batch arrays in shared memory; only the encoded images are sent to the workers, no decoded
+    images or tensors are pickled."""
+
+    def __init__(self, workers):
+        """Initializes a PreprocessingPool.
+
+        Args:
+            workers (int): number of worker processes
+        """
+        self.workers = workers
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # uint8 batch arrays in shared memory, reused by subsequent batches of the same or smaller size
+        self._shms = []
+        self._lock = threading.Lock()
+
+    def _shared_memory(self, shapes):
+        sizes = [max(math.prod(shape), 1) for shape in shapes]
+        if len(self._shms) != len(sizes) or any(
+            shm.size < size for shm, size in zip(self._shms, sizes)
+        ):
+            self._free_shared_memory()
+            self._shms = [
+                shared_memory.SharedMemory(create=True, size=size) for size in sizes
+            ]
+        return self._shms
+
+    def _free_shared_memory(self):
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def preprocess(self, contents, transforms_, out=None):
+        """Transform encoded images for several models at once.
+
+        Args:
+            contents (list(bytes)): encoded images of the batch
+            transforms_ (list(dict)): transforms with keys resize (required), crop and normalize
+            out (list(Tensor), optional): float buffers (N, 3, H, W) per transform to write into. Defaults to None.
+
+        Returns:
+            list(Tensor): input batch per transform
+        """
+        crops = [transform.get("crop") for transform in transforms_]
+        sizes = [resize_size(transform["resize"]) for transform in transforms_]
+        shapes = [(len(contents), height, width, 3) for height, width in sizes]
+        # concurrent batches take turns, the workers are busy with one batch anyway
+        with self._lock:
+            return self._preprocess(contents, transforms_, crops, sizes, shapes, out)
+
+    def _preprocess(self, contents, transforms_, crops, sizes, shapes, out):
+        shms = self._shared_memory(shapes)
+        outputs = None
+        try:
+            # a few chunks per worker balance differing decoding times
+            chunk_size = max(math.ceil(len(contents) / (self.workers * 2)), 1)
+            futures = [
+                self._executor.submit(
+                    _decode_chunk,
+                    contents[start : start + chunk_size],
+                    start,
+                    [shm.name for shm in shms],
+                    shapes,
+                    crops,
+                    sizes,
+                    draft_size(crops, sizes),
+                )
+                for start in range(0, len(contents), chunk_size)
+            ]
+            for future in futures:
+                future.result()
+            outputs = [
+                np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                for shape, shm in zip(shapes, shms)
+            ]
+            return [
+                to_tensor(output, transform.get("normalize"), None if out is None else out[k])
+                for k, (output, transform) in enumerate(zip(outputs, transforms_))
+            ]
+        finally:
+            # the arrays must be released before the shared memory is closed
+            outputs = None
+
+    def close(self):
+        self._executor.shutdown()
+        with self._lock:
+            self._free_shared_memory()
+
+
+# shared memory attached by a worker process: name -> SharedMemory
+_attached = {}
+
+
+def _attach(shm_names):
+    # workers share the resource tracker of the creating process, which unlinks the shared memory
+    for name in list(_attached):
+        if name not in shm_names:
+            _attached.pop(name).close()
+    for name in shm_names:
+        if name not in _attached:
+            _attached[name] = shared_memory.SharedMemory(name=name)
+    return [_attached[name] for name in shm_names]
+
+
+def _decode_chunk(contents, start, shm_names, shapes, crops, sizes, draft):
+    # entry point of a worker process
+    outputs = [
+        np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        for shape, shm in zip(shapes, _attach(shm_names))
+    ]
+    for i, content in enumerate(contents):
+        decode_crops(content, crops, sizes, draft, outputs, start + i)
+
+
+# shared by all ModelInterface instances of a process (e.g., multiple areas of interest)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(workers):
+    """Process-wide PreprocessingPool with the given number of workers, started on first use."""
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = PreprocessingPool(workers)
+        return _pools[workers]
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import uuid
+from contextlib import nullcontext
+from pathlib import Path
+
+# local modules
+src_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(src_dir))
+import constants as const
+
+# when a stage runs: if its fingerprint is outdated, always, only if its output tables are missing, or never
+STAGE_POLICIES = ["stale", "always", "missing", "never"]
+
+
+class PipelineStage:
+    """A step of a StageGraph with the tables it creates."""
+
+    def __init__(
+        self,
+        name,
+        func,
+        params=None,
+        upstream=(),
+        outputs=(),
+        scripts=(),
+        policy="stale",
+        complete=None,
+        digest=None,
+    ):
+        """Initializes a PipelineStage.
+
+        Args:
+            name (str): name of the stage
+            func (callable): runs the stage, without arguments. Its return value is kept in StageGraph.results.
+            params (dict, optional): parameters of the stage (JSON serializable). Defaults to None.
+            upstream (list, optional): names of the stages whose outputs are inputs of this stage. Defaults to ().
+            outputs (list, optional): tables created by the stage. Defaults to ().
+            scripts (list, optional): SQL scripts run by the stage, changes of the scripts invalidate the stage.
+                Defaults to ().
+            policy (str, optional): one of STAGE_POLICIES. Defaults to "stale".
+            complete (callable, optional): returns False if the outputs are incomplete (e.g., after an interrupted
+                run), i.e., the stage has to run again despite an unchanged fingerprint. Defaults to None.
+            digest (callable, optional): state of the outputs (JSON serializable) after the stage ran. Downstream
+                stages are only invalidated if the digest changed. Without digest, the outputs of a stage are
+                assumed to be determined by its fingerprint, unless it runs with policy "always". Defaults to None.
+        """
+        if policy not in STAGE_POLICIES:
+            raise ValueError(f"Invalid policy {policy}, options: {STAGE_POLICIES}")
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.upstream = list(upstream)
+        self.outputs = list(outputs)
+        self.scripts = list(scripts)
+        self.policy = policy
+        self.complete = complete
+        self.digest = digest
+
+
+class StageGraph:
+    """Directed acyclic graph of pipeline stages that are skipped if they are up to date.
+
+    Each completed stage records in `{name}_pipeline_stages` a fingerprint of its parameters, SQL scripts and
+    the outputs of its upstream stages, together with a fingerprint of its own outputs. A stage is up to date
+    if its fingerprint is unchanged, its output tables exist and its outputs are complete. The record of a stage
+    is removed before it runs, thus a stage interrupted by a crash runs again in the next run. Stages that
+    process items incrementally (e.g., the classification, which skips classified images) thereby resume
+    from the last completed batch.
+    """
+
+    def __init__(self, db, name, force=(), instrumentation=None):
+        """Initializes a StageGraph.
+
+        Args:
+            db (SurfaceDatabase): database
+            name (str): name of the area of interest
+            force (list, optional): names of stages to run regardless of their fingerprint. Defaults to ().
+            instrumentation (Instrumentation, optional): records the stages that run. Defaults to None.
+        """
+        self.db = db
+        self.instrumentation = instrumentation
+        self.name = name
+        self.table = f"{name}_pipeline_stages"
+        self.force = set(force)
+        self.stages = {}
+        self.results = {}
+        self.ran = set()
+        self._records = None
+
+    def add(self, stage):
+        """Add a stage. Stages are run in the order they are added, thus upstream stages have to be added first.
+
+        Args:
+            stage (PipelineStage): the stage
+
+        Returns:
+            PipelineStage: the stage
+        """
+        unknown = [name for name in stage.upstream if name not in self.stages]
+        if unknown:
+            raise ValueError(f"Unknown upstream stages {unknown} of stage {stage.name}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def _load_records(self):
+        self.db.execute_sql_query(const.SQL_CREATE_PIPELINE_STAGES_TABLE, {"name": self.name})
+        rows = self.db.execute_sql_query(
+            f"SELECT stage, fingerprint, output FROM {self.table};",
+            is_file=False,
+            get_response=True,
+        )
+        return {stage: (fingerprint, output) for stage, fingerprint, output in rows}
+
+    def _delete_record(self, stage_name):
+        self._records.pop(stage_name, None)
+        self.db.execute_sql_query(
+            f"DELETE FROM {self.table} WHERE stage = '{stage_name}';", is_file=False
+        )
+
+    def _add_record(self, stage_name, fingerprint, output):
+        self._records[stage_name] = (fingerprint, output)
+        self.db.add_rows_to_table(
+            self.table, ["stage", "fingerprint", "output"], [(stage_name, fingerprint, output)]
+        )
+
+    def output(self, stage_name):
+        """Fingerprint of the outputs of a stage, as recorded by its last completed run."""
+        return self._records.get(stage_name, (None, None))[1]
+
+    def fingerprint(self, stage):
+        """Fingerprint of the parameters, SQL scripts and upstream outputs of a stage."""
+        scripts = {}
+        for script in stage.scripts:
+            with open(script, "rb") as file:
+                scripts[Path(script).name] = hashlib.sha256(file.read()).hexdigest()
+        return _hash(
+            {
+                "params": stage.params,
+                "scripts": scripts,
+                "upstream": {name: self.output(name) for name in stage.upstream},
+            }
+        )
+
+    def is_up_to_date(self, stage, fingerprint):
+        return (
+            self._records.get(stage.name, (None, None))[0] == fingerprint
+            and all(self.db.table_exists(table) for table in stage.outputs)
+            and (stage.complete is None or stage.complete())
+        )
+
+    def _should_run(self, stage, fingerprint):
+        if stage.name in self.force or stage.policy == "always":
+            return True
+        if stage.policy == "never":
+            return False
+        if stage.policy == "missing":
+            return not all(self.db.table_exists(table) for table in stage.outputs)
+        return not self.is_up_to_date(stage, fingerprint)
+
+    def run(self):
+        """Run all stages that are not up to date, in the order they were added.
+
+        Returns:
+            dict: stage name -> return value of the stages that ran
+        """
+        self._records = self._load_records()
+        for stage in self.stages.values():
+            fingerprint = self.fingerprint(stage)
+            if not self._should_run(stage, fingerprint):
+                logging.info(f"Stage {stage.name} is up to date, skip.")
+                if self.instrumentation is not None:
+                    self.instrumentation.skipped(stage.name)
+                continue
+
+            logging.info(f"Run stage {stage.name}.")
+            self._delete_record(stage.name)
+            with (
+                self.instrumentation.stage(stage.name, stage.outputs)
+                if self.instrumentation is not None
+                else nullcontext()
+            ):
+                self.results[stage.name] = stage.func()
+            self.ran.add(stage.name)
+            if stage.digest is not None:
+                output = _hash({"fingerprint": fingerprint, "digest": stage.digest()})
+            elif stage.policy == "always":
+                # outputs depend on external data, e.g., new images or a recreated road network
+                output = uuid.uuid4().hex
+            else:
+                output = fingerprint
+            self._add_record(stage.name, fingerprint, output)
+        return self.results
+
+
+def _hash(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+
+_DONE = object()
+
+
+class Stage:
+    """A processing step of a StagedPipeline."""
+
+    def __init__(self, name, func, depth=2, workers=1):
+        """Initializes a Stage.
+
+        Args:
+            name (str): name of the stage, used for logging and statistics
+            func (callable): function applied to every item. If it returns None, the item is dropped.
+            depth (int, optional): maximum number of items waiting in the input queue of this stage. Defaults to 2.
+            workers (int, optional): number of threads running this stage. Defaults to 1.
+        """
+        self.name = name
+        self.func = func
+        self.depth = depth
+        self.workers = workers
+        self.processed = 0
+        self._lock = threading.Lock()
+
+    def count_processed(self):
+        # workers of the stage count concurrently
+        with self._lock:
+            self.processed += 1
+
+
+class StagedPipeline:
+    """Producer/consumer pipeline: each stage runs in its own thread(s) and stages are
+    connected by bounded queues. Thus, e.g., downloading the next batch overlaps with
+    inference of the current batch, and throughput approaches that of the slowest stage.
+    Bounded queues limit how many items (and thereby how much memory) are in flight.
+    """
+
+    def __init__(self, stages):
+        """Initializes a StagedPipeline.
+
+        Args:
+            stages (list(Stage)): stages in processing order. The output of a stage is the input of the next one.
+        """
+        self.stages = stages
+        self._error = None
+        self._stop = threading.Event()
+
+    def _put(self, q, item):
+        # do not block forever if a downstream stage failed
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_stage(self, stage, in_queue, out_queue, finished):
+        try:
+            while True:
+                item = self._get(in_queue)
+                if item is _DONE:
+                    # let sibling workers of this stage terminate as well
+                    self._put(in_queue, _DONE)
+                    break
+                result = stage.func(item)
+                stage.count_processed()
+                if result is not None and out_queue is not None:
+                    self._put(out_queue, result)
+        except Exception as e:
+            logging.error(f"Pipeline stage '{stage.name}' failed with error:\n{e}")
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+        finally:
+            # the last worker of a stage signals the end of input to the next stage
+            if finished.release_and_is_last() and out_queue is not None:
+                self._put(out_queue, _DONE)
+
+    def run(self, items):
+        """Feed items through all stages and wait until every stage has processed all items.
+
+        Args:
+            items (iterable): input items of the first stage
+
+        Raises:
+            Exception: the first exception raised by any stage
+        """
+        queues = [queue.Queue(maxsize=max(stage.depth, 1)) for stage in self.stages]
+        threads = []
+        for i, stage in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            finished = _Countdown(stage.workers)
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_stage,
+                    args=(stage, queues[i], out_queue, finished),
+                    name=f"pipeline-{stage.name}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            if not self._put(queues[0], item):
+                break
+        self._put(queues[0], _DONE)
+
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def stats(self):
+        """Number of processed items per stage."""
+        return {stage.name: stage.processed for stage in self.stages}
+
+
+class _Countdown:
+    def __init__(self, n):
+        self._n = n
+        self._lock = threading.Lock()
+
+    def release_and_is_last(self):
+        with self._lock:
+            self._n -= 1
+            return self._n == 0
@@ -1,15 +1,27 @@
 import fnmatch
 import logging
 import os
+import re
 import subprocess
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
 
+import numpy as np
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 from psycopg2.extras import DictCursor, execute_batch
+from psycopg2.pool import ThreadedConnectionPool
 from pydriosm.downloader import GeofabrikDownloader
 
+# statements that EXPLAIN ANALYZE can execute (others, e.g., CREATE INDEX or ALTER TABLE, are executed as they are)
+_EXPLAINABLE = re.compile(
+    r"^(select|insert|update|delete|with|create\s+((temp|temporary|unlogged)\s+)?table\s+\S+\s+as)\b",
+    re.IGNORECASE,
+)
+
 # from pydriosm.ios import PostgresOSM
 
 
@@ -27,6 +39,7 @@ class SurfaceDatabase:
         osm_region=None,
         road_network_path=None,
         sql_custom_way_prep=None,
+        dbpool_size=8,
     ):
         """Initializes the database class
 
@@ -40,6 +53,7 @@ class SurfaceDatabase:
             osm_region (str, optional): path to the pbf file for the OSM road network. If provided, road_network_path is ignored. Defaults to None.
             road_network_path (str, optional): Alternative road network to OSM. If osm_region is None, required. Defaults to None.
             sql_custom_way_prep (str, optional): SQL query to prepare the way table if a custom road network is provided. Defaults to None.
+            dbpool_size (int, optional): maximum number of pooled database connections. Threads wait for a free connection if all are in use. Defaults to 8.
         """
         self.dbname = dbname
         self.dbuser = dbuser
@@ -50,9 +64,30 @@ class SurfaceDatabase:
         self.osm_region = osm_region
         self.road_network_path = road_network_path
         self.sql_custom_way_prep = sql_custom_way_prep
+        self.dbpool_size = dbpool_size
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._pool_slots = threading.BoundedSemaphore(dbpool_size)
+        self._local = threading.local()
+        # modules.Instrumentation.Instrumentation recording the executed queries, if any
+        self.instrumentation = None
 
         self.setup_database()
 
+    def close(self):
+        """Close all pooled database connections."""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def _database_exists(self):
         query = f"SELECT 1 FROM pg_database WHERE datname = '{self.dbname}'"
         res = self.execute_sql_query(
@@ -99,6 +134,7 @@ class SurfaceDatabase:
             except Exception as e:
 
                 # drop incorrectly initialized database
+                self.close()
                 self.execute_sql_query(
                     f'DROP DATABASE "{self.dbname}"',
                     is_file=False,
@@ -162,6 +198,74 @@ class SurfaceDatabase:
             logging.info(f"Remove downloaded pbf file {pbf_file}.")
             os.remove(pbf_file)
 
+    def _get_pool(self):
+        # created on first use, as the database may not exist before setup
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(
+                    1,
+                    self.dbpool_size,
+                    dbname=self.dbname,
+                    user=self.dbuser,
+                    host=self.dbhost,
+                    port=self.dbport,
+                    password=self.dbpassword,
+                )
+            return self._pool
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool and return it afterwards. Uncommitted changes are rolled back
+        on return. Within a `transaction()` scope, the connection of the transaction is used.
+
+        Yields:
+            psycopg2.connection: a database connection
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        self._pool_slots.acquire()
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+        except Exception:
+            self._pool_slots.release()
+            raise
+        try:
+            yield conn
+        finally:
+            discard = bool(conn.closed)
+            if not discard:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            pool.putconn(conn, close=discard)
+            self._pool_slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """Scope of a database transaction: committed if the block completes, rolled back otherwise.
+        Statements of the same thread within the scope (e.g., `execute_sql_query`) join the transaction.
+
+        Yields:
+            psycopg2.connection: the connection of the transaction
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:  # nested scope
+            yield conn
+            return
+
+        with self.connection() as conn:
+            self._local.conn = conn
+            try:
+                yield conn
+                conn.commit()
+            finally:
+                self._local.conn = None
+
     def _create_dbconnection(self, postgres_default=False):
         """Create a connection to the database
 
@@ -196,35 +300,74 @@ class SurfaceDatabase:
             get_response (bool, optional): If the response is to be fetched. Defaults to False.
             set_isolation_level (bool, optional): If the isolation level is to be set. Defaults to False.
         """
-        # create table with sample data points
-        conn = self._create_dbconnection(postgres_default)
-        if set_isolation_level:
-            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-
+        label = Path(query).name if is_file else " ".join(query.split())[:80]
         if is_file:
             with open(query, "r") as file:
                 query = file.read()
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute(sql.SQL(query.format(**params)))
-            if get_response:
-                res = cursor.fetchall()
-            conn.commit()
-
-        conn.close()
-        if get_response:
+        query = query.format(**params)
+        explain = (
+            self.instrumentation is not None
+            and self.instrumentation.explain_analyze
+            and is_file
+            and not get_response
+        )
+        query = sql.SQL(query) if not explain else query
+
+        if postgres_default or set_isolation_level:
+            # e.g. CREATE DATABASE: not pooled, as it runs on another database or outside of a transaction
+            conn = self._create_dbconnection(postgres_default)
+            if set_isolation_level:
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            try:
+                with conn.cursor(cursor_factory=DictCursor) as cursor:
+                    cursor.execute(query)
+                    res = cursor.fetchall() if get_response else None
+                    conn.commit()
+            finally:
+                conn.close()
             return res
 
-    def execute_many_sql_query(self, query, value_list, params={}, is_file=True):
-        conn = self._create_dbconnection()
+        start = time.perf_counter()
+        plans = None
+        res = None
+        with self.transaction() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cursor:
+                if explain:
+                    plans = self._execute_explained(cursor, query)
+                else:
+                    cursor.execute(query)
+                    if get_response:
+                        res = cursor.fetchall()
+        if self.instrumentation is not None:
+            self.instrumentation.record_query(
+                label, time.perf_counter() - start, plans
+            )
+        return res
+
+    @staticmethod
+    def _execute_explained(cursor, query):
+        """Execute the statements of a SQL script one by one, with EXPLAIN (ANALYZE, BUFFERS) if possible.
+
+        Returns:
+            list(str): query plans of the explained statements
+        """
+        plans = []
+        for statement in split_sql_statements(query):
+            if _EXPLAINABLE.match(statement) is None:
+                cursor.execute(sql.SQL(statement))
+                continue
+            cursor.execute(sql.SQL(f"EXPLAIN (ANALYZE, BUFFERS) {statement}"))
+            plans.append("\n".join(row[0] for row in cursor.fetchall()))
+        return plans
 
+    def execute_many_sql_query(self, query, value_list, params={}, is_file=True):
         if is_file:
             with open(query, "r") as file:
                 query = file.read()
 
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            execute_batch(cursor, sql.SQL(query.format(**params)), value_list)
-            conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cursor:
+                execute_batch(cursor, sql.SQL(query.format(**params)), value_list)
 
     def table_exists(self, table_name):
         query = f"SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_schema = 'public' AND table_name = '{table_name}');"
@@ -233,6 +376,11 @@ class SurfaceDatabase:
         )
         return res[0][0]
 
+    def column_exists(self, table_name, column_name):
+        query = f"SELECT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = 'public' AND table_name = '{table_name}' AND column_name = '{column_name}');"
+        res = self.execute_sql_query(query, is_file=False, get_response=True)
+        return res[0][0]
+
     def table_to_shapefile(self, table_name, output_file):
         """Write a database geodata table to a shapefile
 
@@ -247,23 +395,46 @@ class SurfaceDatabase:
         )
 
     def img_ids_from_dbtable(self, db_table):
-        conn = self._create_dbconnection()
-
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            img_ids = cursor.execute(sql.SQL(f"SELECT img_id FROM {db_table}"))
-            img_ids = cursor.fetchall()
-            img_ids = [img_id[0] for img_id in img_ids]
-        conn.close()
+        with self.connection() as conn:
+            with conn.cursor(cursor_factory=DictCursor) as cursor:
+                cursor.execute(sql.SQL(f"SELECT img_id FROM {db_table}"))
+                img_ids = [img_id[0] for img_id in cursor.fetchall()]
         return img_ids
 
-    def add_rows_to_table(self, table_name, header, rows):
+    def add_rows_to_table(self, table_name, header, rows, method="copy"):
+        """Add rows to a database table
+
+        Args:
+            table_name (str): name of the table
+            header (list): column names, in order of the row values
+            rows (iterable): rows (lists or tuples) to add
+            method (str, optional): "copy" (bulk load with COPY FROM STDIN) or "insert" (batched INSERT statements). Defaults to "copy".
+        """
         # TODO: validate that header matches with table
+        if method == "copy":
+            self.copy_rows_to_table(table_name, header, rows)
+            return
         columns = ", ".join(header)
         placeholders = ", ".join(["%s"] * len(header))
         flattened_rows = [tuple(row) for row in rows]
         query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders});"
         self.execute_many_sql_query(query, flattened_rows, is_file=False)
 
+    def copy_rows_to_table(self, table_name, header, rows):
+        """Bulk load rows into a database table with COPY FROM STDIN (text format).
+        Rows are serialized on demand while being sent, thus a generator can be streamed
+        into the table without materializing all rows in memory.
+
+        Args:
+            table_name (str): name of the table
+            header (list): column names, in order of the row values
+            rows (iterable): rows (lists or tuples) to load, may be a generator
+        """
+        query = f"COPY {table_name} ({', '.join(header)}) FROM STDIN"
+        with self.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(query, _CopyStream(rows))
+
     def remove_temp_tables(self, aoi_name):
         self.execute_sql_query(
             f"""DROP TABLE IF EXISTS {aoi_name}_eval_groups,
@@ -274,3 +445,65 @@ class SurfaceDatabase:
                 """,
             is_file=False,
         )
+
+
+def split_sql_statements(query):
+    """Split a SQL script into its single statements (comments are removed).
+
+    Args:
+        query (str): SQL script
+
+    Returns:
+        list(str): SQL statements
+    """
+    query = re.sub(r"--[^\n]*", "", query)
+    return [statement.strip() for statement in query.split(";") if statement.strip()]
+
+
+def _copy_text_value(value):
+    """Serialize a value to the text format of COPY
+
+    Args:
+        value: python or numpy value
+
+    Returns:
+        str: escaped text representation, NULL as \\N
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bool, np.bool_)):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class _CopyStream:
+    """File-like object that serializes rows to COPY text format lines when read by psycopg2."""
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ""
+        self.n_rows = 0
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            line = "\t".join(_copy_text_value(value) for value in row) + "\n"
+            chunks.append(line)
+            length += len(line)
+            self.n_rows += 1
+        data = "".join(chunks)
+        if size < 0 or len(data) <= size:
+            self._buffer = ""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
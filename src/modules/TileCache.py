@@ -0,0 +1,108 @@
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+# local modules
+src_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(src_dir))
+from modules.ImageCache import atomic_write
+
+
+class CachedTile:
+    """Content of a cached vector tile with its revalidation metadata."""
+
+    def __init__(self, content, etag, fetched_at):
+        self.content = content
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+
+class TileCache:
+    """Local on-disk cache of Mapillary vector tiles.
+
+    Tiles younger than `ttl` seconds are used without any request. Older tiles are
+    revalidated with their ETag (If-None-Match), i.e., only downloaded again if changed.
+    """
+
+    def __init__(self, cache_dir, ttl=86400):
+        """Initializes a TileCache.
+
+        Args:
+            cache_dir (str): folder to store cached tiles in
+            ttl (int, optional): time in seconds a cached tile is used without revalidation. Defaults to 86400 (one day).
+        """
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, coverage, tile):
+        return self.cache_dir / coverage / str(tile.z) / str(tile.x) / f"{tile.y}.pbf"
+
+    def get(self, coverage, tile):
+        """Get a cached tile
+
+        Args:
+            coverage (str): Mapillary tile coverage, e.g. mly1_public
+            tile (mercantile.Tile): tile
+
+        Returns:
+            CachedTile: the cached tile or None, if the tile is not cached
+        """
+        path = self._path(coverage, tile)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            with open(path.with_suffix(".json"), "r") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return CachedTile(content, meta.get("etag"), meta.get("fetched_at", 0))
+
+    def is_fresh(self, cached_tile):
+        return (time.time() - cached_tile.fetched_at) < self.ttl
+
+    def put(self, coverage, tile, content, etag=None):
+        """Add a tile to the cache (replaces an existing entry).
+
+        Args:
+            coverage (str): Mapillary tile coverage, e.g. mly1_public
+            tile (mercantile.Tile): tile
+            content (bytes): tile content
+            etag (str, optional): ETag of the response. Defaults to None.
+        """
+        path = self._path(coverage, tile)
+        atomic_write(path, content)
+        self._write_meta(path, etag)
+
+    def touch(self, coverage, tile, etag=None):
+        """Mark a cached tile as revalidated (e.g., after a 304 Not Modified response)."""
+        self._write_meta(self._path(coverage, tile), etag)
+
+    def _write_meta(self, path, etag):
+        meta = {"etag": etag, "fetched_at": time.time()}
+        atomic_write(path.with_suffix(".json"), json.dumps(meta).encode())
+
+    def record(self, outcome):
+        """Count a cache outcome: "hit", "revalidated" or "miss"."""
+        with self._lock:
+            if outcome == "hit":
+                self.hits += 1
+            elif outcome == "revalidated":
+                self.revalidated += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+            }
@@ -0,0 +1,255 @@
+"""Decoder for point layers of Mapbox vector tiles (MVT), as served by Mapillary.
+
+The tile protobuf is decoded straight into typed, columnar NumPy arrays (one array per
+feature property plus lon/lat), without creating intermediate dicts per feature.
+Packed fields (tags and geometries) of all features are decoded at once in vectorized form.
+"""
+
+import math
+import struct
+
+import numpy as np
+
+# protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+# field numbers of the vector tile specification (https://github.com/mapbox/vector-tile-spec)
+_TILE_LAYERS = 3
+_LAYER_NAME = 1
+_LAYER_FEATURES = 2
+_LAYER_KEYS = 3
+_LAYER_VALUES = 4
+_LAYER_EXTENT = 5
+_FEATURE_TAGS = 2
+_FEATURE_GEOMETRY = 4
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf, start, end):
+    """Iterate over (field number, value) of a protobuf message. The value of a length delimited
+    field is its (start, end) range in buf, of a fixed size field its raw bytes."""
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _read_varint(buf, pos)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == _FIXED64:
+            value = buf[pos : pos + 8]
+            pos += 8
+        elif wire_type == _FIXED32:
+            value = buf[pos : pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field, value
+
+
+def _skip(buf, pos, wire_type):
+    """Read a field that is not length delimited. Returns its value and the next position."""
+    if wire_type == _VARINT:
+        return _read_varint(buf, pos)
+    if wire_type == _FIXED64:
+        return buf[pos : pos + 8], pos + 8
+    if wire_type == _FIXED32:
+        return buf[pos : pos + 4], pos + 4
+    raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _decode_value(buf, start, end):
+    # a Value message holds exactly one of its fields
+    key = buf[start]
+    field, wire_type = key >> 3, key & 7
+    if wire_type == _LENGTH_DELIMITED:  # string
+        length, pos = _read_varint(buf, start + 1)
+        return buf[pos : pos + length].decode("utf-8")
+    value, _ = _skip(buf, start + 1, wire_type)
+    if field == 2:  # float
+        return struct.unpack("<f", value)[0]
+    if field == 3:  # double
+        return struct.unpack("<d", value)[0]
+    if field == 4:  # int64
+        return value - (1 << 64) if value >= (1 << 63) else value
+    if field == 5:  # uint64
+        return value
+    if field == 6:  # sint64
+        return _zigzag(value)
+    if field == 7:  # bool
+        return bool(value)
+    return None
+
+
+def _packed_varints(buf, ranges):
+    """Decode the packed varint fields at the given (start, end) ranges of buf in one vectorized pass.
+
+    Returns:
+        tuple(np.ndarray, np.ndarray): all decoded values (uint64) and the number of values per range
+    """
+    if len(ranges) == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    data = np.frombuffer(buf, dtype=np.uint8)
+    ranges = np.asarray(ranges, dtype=np.int64)
+    lengths = ranges[:, 1] - ranges[:, 0]
+    # gather the bytes of all ranges
+    offsets = np.repeat(ranges[:, 0] - np.cumsum(np.r_[0, lengths[:-1]]), lengths)
+    packed = data[np.arange(lengths.sum()) + offsets]
+
+    # a varint ends with the first byte < 0x80
+    is_last = packed < 0x80
+    ends = np.flatnonzero(is_last)
+    starts = np.r_[0, ends[:-1] + 1]
+    position = np.arange(len(packed)) - np.repeat(starts, ends - starts + 1)
+    contributions = (packed & 0x7F).astype(np.uint64) << (7 * position).astype(
+        np.uint64
+    )
+    values = np.add.reduceat(contributions, starts) if len(starts) > 0 else starts
+    # number of varints per range = number of terminating bytes in the range
+    terminators = np.r_[0, np.cumsum(is_last)]
+    range_ends = np.cumsum(lengths)
+    counts = terminators[range_ends] - terminators[range_ends - lengths]
+    return values.astype(np.uint64), counts
+
+
+def _zigzag_array(values):
+    values = values.astype(np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+
+def decode_point_layer(content, x, y, z, layer, properties):
+    """Decode a point layer of a vector tile into columnar arrays.
+
+    Args:
+        content (bytes): vector tile (protobuf)
+        x (int): tile x coordinate
+        y (int): tile y coordinate
+        z (int): tile zoom level
+        layer (str): name of the layer to decode
+        properties (dict): property name -> numpy dtype of the columns to decode.
+            Missing property values are set to 0 / False / "" (or NaN for float columns).
+
+    Returns:
+        dict: property name -> np.ndarray, plus float64 arrays "lon" and "lat" (EPSG:4326) of the
+        first point of each feature. Empty arrays if the layer is not contained in the tile.
+    """
+    buf = bytes(content)
+    layer_range = None
+    for field, value in _fields(buf, 0, len(buf)):
+        if field == _TILE_LAYERS:
+            for layer_field, layer_value in _fields(buf, *value):
+                if layer_field == _LAYER_NAME:
+                    name = buf[layer_value[0] : layer_value[1]].decode("utf-8")
+                    if name == layer:
+                        layer_range = value
+                    break
+
+    keys = []
+    values = []
+    tag_ranges = []
+    geometry_ranges = []
+    extent = 4096
+    if layer_range is not None:
+        # hot loop over all features of the layer: varints are read inline
+        pos, end = layer_range
+        while pos < end:
+            key = buf[pos]
+            pos += 1
+            if key >= 0x80:
+                key, pos = _read_varint(buf, pos - 1)
+            field, wire_type = key >> 3, key & 7
+            if wire_type != _LENGTH_DELIMITED:
+                value, pos = _skip(buf, pos, wire_type)
+                if field == _LAYER_EXTENT:
+                    extent = value
+                continue
+            length = buf[pos]
+            pos += 1
+            if length >= 0x80:
+                length, pos = _read_varint(buf, pos - 1)
+            field_end = pos + length
+            if field == _LAYER_FEATURES:
+                tags = (0, 0)
+                geometry = (0, 0)
+                feature_pos = pos
+                while feature_pos < field_end:
+                    feature_key = buf[feature_pos]
+                    feature_pos += 1
+                    if feature_key & 7 == _LENGTH_DELIMITED:
+                        feature_length, feature_pos = _read_varint(buf, feature_pos)
+                        feature_range = (feature_pos, feature_pos + feature_length)
+                        feature_pos += feature_length
+                        if feature_key >> 3 == _FEATURE_TAGS:
+                            tags = feature_range
+                        elif feature_key >> 3 == _FEATURE_GEOMETRY:
+                            geometry = feature_range
+                    else:
+                        _, feature_pos = _skip(buf, feature_pos, feature_key & 7)
+                tag_ranges.append(tags)
+                geometry_ranges.append(geometry)
+            elif field == _LAYER_VALUES:
+                values.append(_decode_value(buf, pos, field_end))
+            elif field == _LAYER_KEYS:
+                keys.append(buf[pos:field_end].decode("utf-8"))
+            pos = field_end
+
+    n = len(tag_ranges)
+    columns = {}
+
+    # tags: alternating key and value indices
+    tags, tag_counts = _packed_varints(buf, tag_ranges)
+    feature_of_tag = np.repeat(np.arange(n), tag_counts // 2)
+    key_idx = tags[0::2].astype(np.int64)
+    value_idx = tags[1::2].astype(np.int64)
+    value_table = np.empty(len(values) + 1, dtype=object)
+    value_table[:-1] = values
+    for prop, dtype in properties.items():
+        # index -1 refers to the missing value in the last position of value_table
+        column_idx = np.full(n, -1, dtype=np.int64)
+        if prop in keys:
+            is_prop = key_idx == keys.index(prop)
+            column_idx[feature_of_tag[is_prop]] = value_idx[is_prop]
+        dtype = np.dtype(dtype)
+        value_table[-1] = _missing_value(dtype)
+        columns[prop] = value_table[column_idx].astype(dtype)
+
+    # geometry: MoveTo command integer followed by zigzag encoded x, y of the first point
+    geometry, geometry_counts = _packed_varints(buf, geometry_ranges)
+    first = np.cumsum(np.r_[0, geometry_counts[:-1]])
+    px = _zigzag_array(geometry[first + 1]) if n > 0 else np.zeros(0)
+    py = _zigzag_array(geometry[first + 2]) if n > 0 else np.zeros(0)
+    size = extent * 2**z
+    columns["lon"] = (px + extent * x) * 360.0 / size - 180
+    y2 = 180 - (py + extent * y) * 360.0 / size
+    columns["lat"] = 360.0 / math.pi * np.arctan(np.exp(y2 * math.pi / 180)) - 90
+    return columns
+
+
+def _missing_value(dtype):
+    if dtype.kind == "f":
+        return np.nan
+    if dtype.kind == "b":
+        return False
+    if dtype.kind in ("U", "O"):
+        return ""
+    return 0
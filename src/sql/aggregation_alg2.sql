@@ -54,19 +54,16 @@ WITH ImgMetadataClassification AS (
 	WHERE (img.requ_road_type is false or 
 		   img.road_type_pred=p.road_type) and img.road_type_pred != 'other';
 
+-- partition distances are computed once during matching (match_imgs_to_segments.sql)
 WITH RankedImages AS (
     SELECT
         img.*,
         ROW_NUMBER() OVER (
             PARTITION BY img.img_id
-            ORDER BY ST_Distance(img.geom, p.geom) ASC
+            ORDER BY img.part_dists[array_position(img.part_ids, img.part_id)] ASC
         ) AS row_num
     FROM
         {name}_img_selection AS img
-    JOIN
-        {name}_partitions AS p
-    ON
-        img.segment_id = p.segment_id and img.part_id = p.part_id
 )
 DELETE FROM {name}_img_selection img
 where (img.img_id || '_' || img.part_id) in
@@ -0,0 +1,27 @@
+-- set-based variant of aggregation_alg1.sql: the group number of a segment is computed inline,
+-- instead of updating every row of {name}_segmented_ways
+drop table if exists {name}_eval_groups ;
+drop table if exists {name}_group_predictions ;
+
+---- new table: eval_groups with joined geometry
+CREATE TABLE {name}_eval_groups AS
+WITH GroupedSegments AS (
+    SELECT
+        {grouping_ids},
+        road_type,
+        ST_LineMerge(ST_Union(geom)) AS geometry
+    FROM (
+	    select {additional_ways_id_column}ways.id, {group_num} as group_num, ways.segment_number,
+        part.part_id, part.road_type, part.geom
+	    from {name}_segmented_ways ways
+	    join {name}_partitions part
+	    on ways.segment_id=part.segment_id
+	    order by (ways.id, part.part_id, ways.segment_number)
+    ) as partitions
+    GROUP BY {grouping_ids}, road_type
+)
+SELECT *
+FROM GroupedSegments
+WHERE ST_SRID(geometry) != 0;
+
+CREATE INDEX {name}_eval_groups_idx ON {name}_eval_groups ({grouping_ids});
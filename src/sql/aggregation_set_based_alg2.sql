@@ -0,0 +1,146 @@
+-- set-based variant of aggregation_alg2.sql: joins instead of correlated subqueries, and the
+-- image selection is created in one statement instead of inserting and deleting duplicates
+ALTER TABLE {name}_img_metadata
+ADD column if not exists group_num INT,
+add column if not exists requ_road_type bool default true;
+
+create index if not exists {name}_partitions_segment_idx on {name}_partitions (segment_id);
+
+-- group number and: is the image close to a segment with partitions OR close to more than one road?
+-- (join based on segment - not partition! we want to seperate road types later)
+UPDATE {name}_img_metadata img
+SET group_num = seg.group_num,
+    requ_road_type = COALESCE((seg.part_nums > 1) or (img.num_closeby_ways > 1), FALSE)
+FROM (
+    SELECT ways.segment_id, {group_num} AS group_num, MAX(part.part_id) AS part_nums
+    FROM {name}_segmented_ways ways
+    JOIN {name}_partitions part
+    ON ways.segment_id = part.segment_id
+    GROUP BY ways.segment_id, ways.segment_number
+) AS seg
+WHERE img.segment_id = seg.segment_id;
+
+-- only keep relevant imgs: per image, the closest partition (road type) that fits the road type prediction
+drop table if exists {name}_img_selection;
+
+WITH ImgMetadataClassification AS (
+    SELECT img.*,
+        res.road_type_pred,
+        res.road_type_prob,
+        res.type_pred,
+        res.type_class_prob,
+        res.quality_pred
+    FROM {name}_img_metadata img
+    INNER JOIN {name}_img_classifications res
+    ON img.img_id = res.img_id
+)
+	SELECT img.*,
+	    p.part_id
+    INTO TABLE {name}_img_selection
+	FROM ImgMetadataClassification img
+	CROSS JOIN LATERAL (
+        SELECT part.part_id
+        FROM {name}_partitions part
+        WHERE part.segment_id = img.segment_id
+            and (img.requ_road_type is false or img.road_type_pred = part.road_type)
+        ORDER BY img.part_dists[array_position(img.part_ids, part.part_id)] ASC
+        LIMIT 1
+    ) AS p
+	WHERE img.road_type_pred != 'other';
+
+create index {name}_img_selection_idx on {name}_img_selection (way_id, group_num, part_id);
+
+-- first group by segment_id, then by group_num
+with VoteCounts AS( -- count votes per segment (by segment_id and road_type)
+select
+	img.way_id as id,
+    img.segment_id,
+    img.part_id,
+    COUNT(*) as img_counts
+from {name}_img_selection img
+    GROUP BY
+        img.way_id, img.segment_id, img.part_id
+--  order by way_id asc
+), SegmentSurfaceVotes AS ( -- votes per group by majority vote of segments per road_type
+    SELECT
+        img.way_id as id,
+        img.group_num,
+        img.segment_id,
+        img.part_id,
+        img.type_pred,
+        to_timestamp(MIN(img.captured_at) / 1000) as min_date,
+        to_timestamp(MAX(img.captured_at) / 1000) as max_date,
+        COUNT(*) AS vote_count,
+        AVG(img.type_class_prob) AS avg_class_prob
+    FROM
+        {name}_img_selection img
+    WHERE img.type_pred IS NOT NULL -- and img.type_class_prob > 0.8
+    GROUP BY
+        img.way_id, img.group_num, img.segment_id, img.part_id, img.type_pred
+), SegmentSurfaceVotes2 as ( -- join total number of images per segment (and road type) to compute confidence score
+	select SSV.*,
+	VC.img_counts,
+	CAST(SSV.vote_count as float) / CAST(VC.img_counts as float) as rt_share
+	from SegmentSurfaceVotes SSV
+    join VoteCounts VC
+    on VC.segment_id = SSV.segment_id and VC.part_id = SSV.part_id
+), RankedVotes as ( 
+SELECT
+		SV.*,
+        RANK() OVER (PARTITION BY SV.id, SV.group_num, SV.segment_id, 
+                                  SV.part_id ORDER BY SV.vote_count DESC) as rank
+        FROM
+        SegmentSurfaceVotes2 SV
+),
+TopRankedVotes AS (        
+    SELECT
+        RV.*
+    from 
+    	RankedVotes RV
+    WHERE  RV.rank = 1
+), GroupSurfaceVotes AS (
+--)
+    SELECT
+        TRV.id,
+        TRV.group_num,
+        TRV.type_pred,
+        TRV.part_id,
+        SUM(TRV.vote_count) as vote_count, -- how many votes for this surface type?
+        AVG(TRV.img_counts) as avg_img_counts, -- how many imgs per subsegment on average for this road type?
+        SUM(TRV.img_counts) as n_imgs, -- sum of all images for this road type
+        AVG(TRV.rt_share) as avg_rt_share,
+        MIN(TRV.min_date) as min_date,
+        MAX(TRV.max_date) as max_date,
+        COUNT(*) AS segment_vote_count
+        --AVG(TRV.type_class_prob) AS avg_class_prob -- todo: weighted avg?
+    FROM
+        TopRankedVotes TRV
+    WHERE TRV.type_pred IS NOT NULL -- and TRV.type_class_prob > 0.8
+    GROUP BY
+        TRV.id, TRV.group_num, TRV.part_id, TRV.type_pred
+), GroupRankedVotes as ( 
+--)
+    SELECT
+		GV.*,
+        RANK() OVER (PARTITION BY GV.id, GV.group_num, GV.part_id ORDER BY GV.segment_vote_count DESC) as rank
+    FROM
+        GroupSurfaceVotes GV
+)
+    SELECT
+        {additional_id_column}
+        GRV.*,
+		ways.road_type,
+        ways.geometry
+    INTO TABLE {name}_group_predictions
+    FROM
+        {name}_eval_groups ways
+    JOIN
+        GroupRankedVotes GRV
+    ON
+        ways.id = GRV.id and ways.group_num = GRV.group_num and  ways.part_id = GRV.part_id;
+        -- now we filter by partition (i.e., road type): only keep those where target road_type matches the prediction (or where there is no target)
+
+--  (this assumes we have a full graph of all roads, inkl. sidewalks etc)
+-- is there any other road close by (xx meters)?
+-- if yes: only consider target type
+-- if no: consider all except the excluded ones
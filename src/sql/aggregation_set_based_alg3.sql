@@ -0,0 +1,94 @@
+-- set-based variant of aggregation_alg3.sql: scores, filters, quality and placeholders of all groups are
+-- computed in one CREATE TABLE AS statement with joins and anti-joins over (id, group_num, part_id),
+-- instead of repeated UPDATEs and DELETEs with NOT IN over concatenated keys
+drop table if exists {name}_group_predictions_new;
+
+CREATE TABLE {name}_group_predictions_new AS
+WITH SegmentCounts AS (
+    select
+        img.way_id,
+        img.group_num,
+        img.part_id,
+        COUNT(DISTINCT img.segment_id)::int as n_rated_segments
+    from {name}_img_selection img
+    GROUP BY
+        img.way_id, img.group_num, img.part_id
+), Scored AS (
+    SELECT
+        ways.*,
+        SC.n_rated_segments,
+        ceil(ST_Length(ways.geometry)/20)::int as n_segments,
+        ST_Length(ways.geometry) as way_length,
+        ways.avg_rt_share * (cast(ways.segment_vote_count as float) / ceil(ST_Length(ways.geometry)/20)) as conf_score
+    FROM {name}_group_predictions ways
+    JOIN SegmentCounts SC
+    ON ways.id = SC.way_id and ways.group_num = SC.group_num and ways.part_id = SC.part_id
+), Filtered AS (
+    -- remove predictions where there is no prediction for at least 2/3 of the subsegments
+    -- or less than 50% of subsegments are of predicted type
+    -- or if there is less than 3 images for the road in total
+    SELECT
+        S.*,
+        RANK() OVER (PARTITION BY S.id, S.group_num, S.part_id ORDER BY S.conf_score DESC) AS conf_rank
+    FROM Scored S
+    WHERE ((S.n_rated_segments < (S.n_segments*(2.0/3.0)))
+        or (cast(S.segment_vote_count as float) / cast(S.n_rated_segments as float) < 0.5)
+        or S.n_imgs < 3) IS NOT TRUE
+), QualityAvg AS (
+    SELECT way_id, group_num, part_id, AVG(img.quality_pred) AS quali_pred, type_pred
+    FROM {name}_img_selection img
+    GROUP BY way_id, group_num, part_id, type_pred
+), Predictions AS (
+    -- drop lower confidence score, add quality info
+    SELECT F.*, QA.quali_pred
+    FROM Filtered F
+    LEFT JOIN QualityAvg QA
+    ON F.id = QA.way_id
+        and F.part_id = QA.part_id
+        and F.type_pred = QA.type_pred
+        and F.group_num = QA.group_num
+    WHERE F.conf_rank = 1
+), AllGroups AS (
+    SELECT {grouping_ids}, type_pred,
+        segment_vote_count, avg_rt_share, conf_score,
+        quali_pred,
+        road_type,
+        n_segments, n_rated_segments, avg_img_counts, n_imgs, way_length,
+        min_date, max_date, geometry
+    FROM Predictions
+    UNION ALL
+    -- add groups with no value as placeholders
+    SELECT {grouping_ids}, NULL,
+        NULL, NULL, NULL,
+        NULL,
+        road_type,
+        NULL, NULL, NULL, NULL, NULL,
+        NULL, NULL, geometry
+    FROM {name}_eval_groups gr
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM Predictions P
+        WHERE P.id = gr.id and P.part_id = gr.part_id and P.group_num = gr.group_num
+    )
+), RankedRows AS (
+    -- only keep one prediction for each way (if multiple road types are specified as target, i.e., via partition id
+    -- then keep one prediction per partition)
+    -- keep the one with most segment vote counts // then with most average image counts
+    SELECT *,
+        row_number() OVER (
+            PARTITION BY {grouping_ids}
+            ORDER BY segment_vote_count DESC, avg_img_counts DESC
+        ) AS row_num
+    FROM AllGroups
+)
+SELECT {grouping_ids}, type_pred,
+    segment_vote_count, avg_rt_share, conf_score,
+    quali_pred,
+    road_type,
+    n_segments, n_rated_segments, avg_img_counts, n_imgs, way_length,
+    min_date, max_date, st_transform(geometry, 4326) as geometry
+FROM RankedRows
+WHERE row_num = 1;
+
+DROP TABLE {name}_group_predictions;
+ALTER TABLE {name}_group_predictions_new RENAME TO {name}_group_predictions;
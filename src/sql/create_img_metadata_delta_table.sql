@@ -0,0 +1,22 @@
+-- new or changed images of an incremental metadata refresh and the tile high-water marks of the refresh
+drop table if exists {name}_img_metadata_delta ;
+
+CREATE TABLE {name}_img_metadata_delta (
+    img_id VARCHAR,
+    sequence_id VARCHAR,
+    captured_at bigint,
+    compass_angle double precision,
+    is_pano bool,
+    creator_id VARCHAR,
+    lon double precision,
+    lat double precision
+);
+
+drop table if exists {name}_tile_watermarks_delta ;
+
+CREATE TABLE {name}_tile_watermarks_delta (
+    x int,
+    y int,
+    z int,
+    captured_at bigint
+);
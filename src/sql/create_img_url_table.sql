@@ -0,0 +1,7 @@
+-- kept across runs: img_metadata is rebuilt by every (re-)harvest and matching
+CREATE TABLE IF NOT EXISTS {name}_img_urls (
+    img_id VARCHAR,
+    img_size VARCHAR,
+    img_url VARCHAR,
+    PRIMARY KEY (img_id, img_size)
+);
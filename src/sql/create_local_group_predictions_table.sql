@@ -0,0 +1,25 @@
+-- empty table of group predictions of the local processing engine (LocalEngine), column types as in aggregation_alg3.sql
+drop table if exists {name}_local_group_predictions;
+
+CREATE TABLE {name}_local_group_predictions AS
+SELECT
+    {additional_id_column}
+    id,
+    0 AS part_id,
+    0 AS group_num,
+    ''::varchar AS type_pred,
+    0::bigint AS segment_vote_count,
+    0::float AS avg_rt_share,
+    0::float AS conf_score,
+    0::float AS quali_pred,
+    road_type,
+    0 AS n_segments,
+    0 AS n_rated_segments,
+    0::numeric AS avg_img_counts,
+    0::numeric AS n_imgs,
+    0::float AS way_length,
+    now() AS min_date,
+    now() AS max_date,
+    geom AS geometry
+FROM {name}_segmented_ways
+LIMIT 0;
@@ -0,0 +1,17 @@
+-- empty table of images matched by the local processing engine (LocalEngine), columns as in match_imgs_to_segments.sql
+drop table if exists {name}_img_matches;
+
+CREATE TABLE {name}_img_matches AS
+SELECT
+    ''::varchar AS img_id,
+    ''::varchar AS sequence_id,
+    0::bigint AS captured_at,
+    id AS way_id,
+    segment_id,
+    geom,
+    0::float AS dist,
+    0 AS num_closeby_ways,
+    ARRAY[]::int[] AS part_ids,
+    ARRAY[]::float[] AS part_dists
+FROM {name}_segmented_ways
+LIMIT 0;
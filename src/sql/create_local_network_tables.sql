@@ -0,0 +1,21 @@
+-- empty subsegment and partition tables, filled by the local processing engine (LocalEngine)
+drop table if exists {name}_segmented_ways;
+drop table if exists {name}_partitions;
+
+CREATE TABLE {name}_segmented_ways AS
+SELECT
+    0 AS segment_number,
+    {additional_id_column}
+    ''::text AS segment_id,
+    id,
+    road_type,
+    geom::geometry AS geom
+FROM {name}_way_selection
+LIMIT 0;
+
+CREATE TABLE {name}_partitions (
+    segment_id text,
+    road_type varchar,
+    geom geometry,
+    part_id int
+);
@@ -0,0 +1,7 @@
+-- completed stages of the pipeline with the fingerprints of their inputs and outputs (modules.StageGraph)
+CREATE TABLE IF NOT EXISTS {name}_pipeline_stages (
+    stage VARCHAR PRIMARY KEY,
+    fingerprint VARCHAR,
+    output VARCHAR,
+    completed_at timestamptz DEFAULT now()
+);
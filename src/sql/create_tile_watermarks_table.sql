@@ -0,0 +1,10 @@
+-- most recent capture time of the images in each tile, as of the last metadata harvest
+drop table if exists {name}_tile_watermarks ;
+
+CREATE TABLE {name}_tile_watermarks (
+    x int,
+    y int,
+    z int,
+    captured_at bigint,
+    PRIMARY KEY (x, y, z)
+);
@@ -0,0 +1,8 @@
+drop table if exists {name}_dirty_group_predictions,
+                     {name}_dirty_img_selection,
+                     {name}_dirty_eval_groups,
+                     {name}_dirty_img_classifications,
+                     {name}_dirty_img_metadata,
+                     {name}_dirty_partitions,
+                     {name}_dirty_segmented_ways,
+                     {name}_dirty_ways;
@@ -0,0 +1,4 @@
+-- images matched to context ways of a shard are classified by the shard owning the way
+DELETE FROM {name}_img_metadata img
+USING {name}_way_selection ws
+WHERE img.way_id = ws.id AND NOT ws.owned;
@@ -0,0 +1,2 @@
+CREATE INDEX {name}_segmented_ways_idx ON {name}_segmented_ways USING GIST(geom);
+CREATE INDEX {name}_partitions_segment_idx ON {name}_partitions (segment_id);
@@ -0,0 +1,89 @@
+-- match only new or changed images ({name}_img_metadata_delta) to subsegments
+-- and merge them into the (already matched) {name}_img_metadata table
+CREATE TEMP TABLE temp_delta AS
+SELECT DISTINCT ON (img_id)
+  img_id,
+  sequence_id,
+  captured_at,
+  st_transform(ST_SetSRID(ST_MakePoint(lon, lat), 4326), {crs}) AS geom
+FROM
+  {name}_img_metadata_delta
+ORDER BY img_id, captured_at DESC;
+
+-- unchanged images keep their existing match
+DELETE FROM temp_delta AS d
+USING {name}_img_metadata AS m
+WHERE d.img_id = m.img_id
+  AND d.sequence_id IS NOT DISTINCT FROM m.sequence_id
+  AND d.captured_at = m.captured_at
+  AND ST_DWithin(d.geom, m.geom, 0.01);
+
+CREATE INDEX temp_delta_idx ON temp_delta USING GIST(geom);
+
+CREATE INDEX IF NOT EXISTS {name}_partitions_segment_idx ON {name}_partitions (segment_id);
+
+-- single-pass matching, see match_imgs_to_segments.sql
+CREATE TEMP TABLE temp_delta_matched AS (
+  SELECT
+    p.img_id,
+    p.sequence_id,
+    p.captured_at,
+    nearby.way_id,
+    nearby.segment_id,
+    p.geom,
+    nearby.dist,
+    nearby.num_closeby_ways,
+    parts.part_ids,
+    parts.part_dists
+  FROM
+    temp_delta AS p
+    CROSS JOIN LATERAL (
+      SELECT
+        (array_agg(seg.way_id ORDER BY seg.dist))[1] AS way_id,
+        (array_agg(seg.segment_id ORDER BY seg.dist))[1] AS segment_id,
+        MIN(seg.dist) AS dist,
+        COUNT(DISTINCT seg.way_id)::int AS num_closeby_ways
+      FROM (
+        SELECT
+          l.id AS way_id,
+          l.segment_id,
+          ST_Distance(l.geom, p.geom) AS dist
+        FROM
+          {name}_segmented_ways AS l
+        WHERE
+          ST_DWithin(l.geom, p.geom, {dist_from_road})
+      ) AS seg
+    ) AS nearby
+    CROSS JOIN LATERAL (
+      SELECT
+        array_agg(part.part_id ORDER BY part.part_id) AS part_ids,
+        array_agg(ST_Distance(part.geom, p.geom) ORDER BY part.part_id) AS part_dists
+      FROM
+        {name}_partitions AS part
+      WHERE
+        part.segment_id = nearby.segment_id
+    ) AS parts
+  WHERE nearby.way_id IS NOT NULL
+);
+
+-- upsert: changed images replace their previous version, new images are added
+DELETE FROM {name}_img_metadata AS m
+USING temp_delta AS d
+WHERE m.img_id = d.img_id;
+
+INSERT INTO {name}_img_metadata (img_id, sequence_id, captured_at, way_id, segment_id, geom, dist, num_closeby_ways, part_ids, part_dists)
+SELECT img_id, sequence_id, captured_at, way_id, segment_id, geom, dist, num_closeby_ways, part_ids, part_dists
+FROM temp_delta_matched;
+
+-- advance the high-water marks only together with the merge of the images
+INSERT INTO {name}_tile_watermarks (x, y, z, captured_at)
+SELECT x, y, z, max(captured_at)
+FROM {name}_tile_watermarks_delta
+GROUP BY x, y, z
+ON CONFLICT (x, y, z) DO UPDATE
+SET captured_at = GREATEST({name}_tile_watermarks.captured_at, EXCLUDED.captured_at);
+
+DROP TABLE temp_delta_matched;
+DROP TABLE temp_delta;
+DROP TABLE {name}_img_metadata_delta;
+DROP TABLE {name}_tile_watermarks_delta;
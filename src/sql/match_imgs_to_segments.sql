@@ -8,54 +8,52 @@ FROM
   {name}_img_metadata;
  
 CREATE INDEX temp_transformed_idx ON temp_transformed USING GIST(geom);
+CREATE INDEX IF NOT EXISTS {name}_partitions_segment_idx ON {name}_partitions (segment_id);
 
-
+-- one indexed neighbourhood search per image: all segments within x meters, with their distance computed once.
+-- nearest segment, its distance and the number of close-by roads are derived from the same search.
 CREATE TABLE temp_table AS (
   SELECT
-  *
-  FROM (
-    SELECT
-      img_id,
-      p.sequence_id,
-      p.captured_at,
-      seg.way_id,
-      seg.segment_id,
-      p.geom,
-      ST_Distance(seg.geom, p.geom) AS dist
-    FROM
-      temp_transformed AS p
-      CROSS JOIN LATERAL (
+    p.img_id,
+    p.sequence_id,
+    p.captured_at,
+    nearby.way_id,
+    nearby.segment_id,
+    p.geom,
+    nearby.dist,
+    nearby.num_closeby_ways,
+    parts.part_ids,
+    parts.part_dists
+  FROM
+    temp_transformed AS p
+    CROSS JOIN LATERAL (
+      SELECT
+        (array_agg(seg.way_id ORDER BY seg.dist))[1] AS way_id,
+        (array_agg(seg.segment_id ORDER BY seg.dist))[1] AS segment_id,
+        MIN(seg.dist) AS dist,
+        COUNT(DISTINCT seg.way_id)::int AS num_closeby_ways -- img within close proximity of how many roads?
+      FROM (
         SELECT
-          l.geom,
           l.id AS way_id,
-          l.segment_id
+          l.segment_id,
+          ST_Distance(l.geom, p.geom) AS dist
         FROM
           {name}_segmented_ways AS l
-        ORDER BY
-          l.geom <-> p.geom -- order by distance
-        LIMIT 1
+        WHERE
+          ST_DWithin(l.geom, p.geom, {dist_from_road}) -- only consider a road a match if within x meters
       ) AS seg
-  ) AS subquery
-  WHERE dist <= {dist_from_road} -- only consider a road a match if within x meters
-);
--- img within close proximity of how many roads?
-ALTER TABLE temp_table ADD COLUMN num_closeby_ways INT;
-
--- TODO: compute distance between points and roads only once
-CREATE TEMP TABLE CloseByRoads AS
-  SELECT img.img_id, COUNT(*) AS num_closeby_ways
-  FROM temp_table AS img
-  JOIN {name}_way_selection AS ws
-  ON ST_DWithin(img.geom, ws.geom, {dist_from_road})
-  GROUP BY img.img_id;
-
-CREATE INDEX CloseByRoads_idx ON CloseByRoads (img_id);
-
-UPDATE temp_table
-SET num_closeby_ways = (
-  SELECT num_closeby_ways
-  FROM CloseByRoads
-  WHERE temp_table.img_id = CloseByRoads.img_id
+    ) AS nearby
+    -- distances to the partitions (road types) of the matched segment, reused by the aggregation
+    CROSS JOIN LATERAL (
+      SELECT
+        array_agg(part.part_id ORDER BY part.part_id) AS part_ids,
+        array_agg(ST_Distance(part.geom, p.geom) ORDER BY part.part_id) AS part_dists
+      FROM
+        {name}_partitions AS part
+      WHERE
+        part.segment_id = nearby.segment_id
+    ) AS parts
+  WHERE nearby.way_id IS NOT NULL
 );
 
 DROP TABLE  {name}_img_metadata;
@@ -63,4 +61,4 @@ ALTER TABLE temp_table RENAME TO  {name}_img_metadata;
 
 DROP TABLE  temp_transformed;
 
-CREATE INDEX {name}_img_metadata_idx ON {name}_img_metadata USING GIST(geom);
\ No newline at end of file
+CREATE INDEX {name}_img_metadata_idx ON {name}_img_metadata USING GIST(geom);
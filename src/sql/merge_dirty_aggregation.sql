@@ -0,0 +1,14 @@
+-- replace the aggregation results of dirty ways by the results of the dirty aggregation run ({name}_dirty_*)
+DELETE FROM {name}_group_predictions gp
+USING {name}_dirty_ways d
+WHERE gp.id = d.id;
+
+INSERT INTO {name}_group_predictions
+SELECT * FROM {name}_dirty_group_predictions;
+
+DELETE FROM {name}_img_selection img
+USING {name}_dirty_ways d
+WHERE img.way_id = d.id;
+
+INSERT INTO {name}_img_selection
+SELECT * FROM {name}_dirty_img_selection;
@@ -0,0 +1,3 @@
+INSERT INTO {name}_img_urls (img_id, img_size, img_url)
+VALUES (%s, %s, %s)
+ON CONFLICT (img_id, img_size) DO UPDATE SET img_url = EXCLUDED.img_url;
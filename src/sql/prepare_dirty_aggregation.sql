@@ -0,0 +1,57 @@
+-- dirty set: ways with new, changed or removed image classifications (or matches) since the last aggregation
+drop table if exists {name}_dirty_ways;
+
+CREATE TABLE {name}_dirty_ways AS
+WITH CurrentImgs AS (
+    SELECT
+        img.img_id,
+        img.way_id,
+        img.segment_id,
+        img.captured_at,
+        img.dist,
+        img.num_closeby_ways,
+        res.road_type_pred,
+        res.road_type_prob,
+        res.type_pred,
+        res.type_class_prob,
+        res.quality_pred
+    FROM {name}_img_metadata img
+    JOIN {name}_img_classifications res
+    ON img.img_id = res.img_id
+), ChangedImgs AS (
+    (SELECT * FROM CurrentImgs EXCEPT SELECT * FROM {name}_aggregated_imgs)
+    UNION ALL
+    (SELECT * FROM {name}_aggregated_imgs EXCEPT SELECT * FROM CurrentImgs)
+)
+SELECT DISTINCT way_id AS id
+FROM ChangedImgs;
+
+-- restrict the input tables of the aggregation to the dirty ways
+-- (all aggregation steps are computed per way, thus the results of dirty ways equal those of a full aggregation)
+drop table if exists {name}_dirty_segmented_ways;
+CREATE TABLE {name}_dirty_segmented_ways AS
+SELECT seg.*
+FROM {name}_segmented_ways seg
+JOIN {name}_dirty_ways d
+ON seg.id = d.id;
+
+drop table if exists {name}_dirty_partitions;
+CREATE TABLE {name}_dirty_partitions AS
+SELECT part.*
+FROM {name}_partitions part
+JOIN {name}_dirty_segmented_ways seg
+ON part.segment_id = seg.segment_id;
+
+drop table if exists {name}_dirty_img_metadata;
+CREATE TABLE {name}_dirty_img_metadata AS
+SELECT img.*
+FROM {name}_img_metadata img
+JOIN {name}_dirty_ways d
+ON img.way_id = d.id;
+
+drop table if exists {name}_dirty_img_classifications;
+CREATE TABLE {name}_dirty_img_classifications AS
+SELECT res.*
+FROM {name}_img_classifications res
+JOIN {name}_dirty_img_metadata img
+ON res.img_id = img.img_id;
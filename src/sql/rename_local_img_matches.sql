@@ -0,0 +1,4 @@
+DROP TABLE {name}_img_metadata;
+ALTER TABLE {name}_img_matches RENAME TO {name}_img_metadata;
+
+CREATE INDEX {name}_img_metadata_idx ON {name}_img_metadata USING GIST(geom);
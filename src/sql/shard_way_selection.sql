@@ -0,0 +1,26 @@
+-- ways of a shard: owned ways start within the shard cell (half-open, in EPSG:4326, thus every way is owned
+-- by exactly one shard), context ways are all other ways close enough to owned ways to compete for their images
+drop table if exists {name}_way_selection;
+
+CREATE TABLE {name}_way_selection AS
+WITH Ways AS (
+    SELECT
+        ws.*,
+        ST_Transform(ST_StartPoint(ST_GeometryN(ws.geom, 1)), 4326) AS start_point
+    FROM {parent}_way_selection ws
+), OwnedArea AS (
+    SELECT ST_SetSRID(ST_Expand(ST_Extent(geom)::geometry, 2 * {dist_from_road}), {crs}) AS geom
+    FROM Ways
+    WHERE ST_X(start_point) >= {cell0} AND ST_X(start_point) < {cell2}
+    AND ST_Y(start_point) >= {cell1} AND ST_Y(start_point) < {cell3}
+)
+SELECT
+    Ways.*,
+    (ST_X(start_point) >= {cell0} AND ST_X(start_point) < {cell2}
+    AND ST_Y(start_point) >= {cell1} AND ST_Y(start_point) < {cell3}) AS owned
+FROM Ways, OwnedArea
+WHERE Ways.geom && OwnedArea.geom;
+
+alter table {name}_way_selection drop column start_point;
+
+CREATE INDEX {name}_way_selection_idx ON {name}_way_selection USING GIST(geom);
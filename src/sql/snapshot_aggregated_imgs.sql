@@ -0,0 +1,19 @@
+-- classified images (and their matches) as of the last aggregation, to find ways with changed input
+drop table if exists {name}_aggregated_imgs;
+
+CREATE TABLE {name}_aggregated_imgs AS
+SELECT
+    img.img_id,
+    img.way_id,
+    img.segment_id,
+    img.captured_at,
+    img.dist,
+    img.num_closeby_ways,
+    res.road_type_pred,
+    res.road_type_prob,
+    res.type_pred,
+    res.type_class_prob,
+    res.quality_pred
+FROM {name}_img_metadata img
+JOIN {name}_img_classifications res
+ON img.img_id = res.img_id;
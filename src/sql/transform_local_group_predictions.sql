@@ -0,0 +1,13 @@
+drop table if exists {name}_group_predictions;
+
+CREATE TABLE {name}_group_predictions AS
+SELECT
+    {grouping_ids}, type_pred,
+    segment_vote_count, avg_rt_share, conf_score,
+    quali_pred,
+    road_type,
+    n_segments, n_rated_segments, avg_img_counts, n_imgs, way_length,
+    min_date, max_date, st_transform(geometry, 4326) AS geometry
+FROM {name}_local_group_predictions;
+
+drop table {name}_local_group_predictions;
@@ -0,0 +1,232 @@
+"""Validation of reduced inference precisions (`inference_precision`) on a folder of labelled images.
+
+All images of the folder are classified with the fp32 models and with each given precision (bf16, int8_dynamic,
+int8_static). Per precision, the report compares the predictions with fp32: the share of images with equal road
+type and surface type, and the mean and maximum absolute difference of the quality values. If the folder contains
+a `labels.csv` (columns `image`, `road_type`, `surface_type`, `surface_quality`; empty values are skipped), the
+road type and surface type accuracy and the quality mean absolute error are reported as well, with their deltas to
+fp32. `surface_quality` labels are quality values or class names of the quality models (e.g. `good`).
+
+A precision passes if the class agreement is at least `--min_agreement` and the mean quality difference is at most
+`--max_quality_diff`; the script exits with status 1 if a precision fails, so it can guard opting in to a
+precision in the config. int8_static requires `--calibration_imgs`, a folder other than the validation images,
+as calibrating on the images it is scored on would inflate its agreement and accuracy.
+
+Usage:
+    python src/validate_precision.py --imgs data/validation --precisions bf16 int8_dynamic int8_static \\
+        --calibration_imgs data/calibration --report precision_report.json
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+## local modules
+import constants as const
+from modules import Models as md
+
+root_path = Path(os.path.abspath(__file__)).parent.parent
+
+IMG_SUFFIXES = [".jpg", ".jpeg", ".png"]
+
+
+def get_config(configfile):
+    """Global config, overwritten by the config file, if any (credentials are not needed)."""
+    with open(root_path / "configs" / "00_global_config.json", "r") as config_file:
+        cg = json.load(config_file)
+    if configfile is not None:
+        with open(root_path / "configs" / f"{configfile}.json", "r") as config_file:
+            cg = {**cg, **json.load(config_file)}
+    return cg
+
+
+def read_labels(folder):
+    """Labels of the images from `labels.csv` in the folder: {image file: {label: value}}."""
+    labels_path = Path(folder) / "labels.csv"
+    if not labels_path.exists():
+        return {}
+    with open(labels_path, "r", newline="") as file:
+        return {
+            row["image"]: {key: value for key, value in row.items() if key != "image" and value}
+            for row in csv.DictReader(file)
+        }
+
+
+def classify(cg, precision, img_files, calibration_imgs):
+    """Classify the images with the models in the given precision.
+
+    Returns:
+        tuple: predictions per image (see ModelInterface.batch_inference), seconds, model interface
+    """
+    model_interface = md.ModelInterface(
+        {
+            **cg,
+            "transform_surface": dict(cg["transform_surface"]),
+            "transform_road_type": dict(cg["transform_road_type"]),
+            "inference_precision": precision,
+            "calibration_imgs": calibration_imgs,
+        },
+        registry=md.ModelRegistry(),
+    )
+    for model in model_interface.model_files():
+        model_interface.get_model(model)
+
+    start = time.perf_counter()
+    predictions = []
+    for i in range(0, len(img_files), model_interface.batch_size):
+        imgs = [
+            Image.open(file).convert("RGB")
+            for file in img_files[i : i + model_interface.batch_size]
+        ]
+        predictions += model_interface.batch_classifications(imgs)
+    return predictions, time.perf_counter() - start, model_interface
+
+
+def quality_value(label, class_to_idx):
+    try:
+        return float(label)
+    except ValueError:
+        return class_to_idx.get(label)
+
+
+def compare(reference, predictions):
+    """Agreement of predictions with the fp32 predictions."""
+    quality_diffs = [
+        abs(r[4] - p[4])
+        for r, p in zip(reference, predictions)
+        if r[4] is not None and p[4] is not None
+    ]
+    return {
+        "road_type_agreement": statistics.mean(r[0] == p[0] for r, p in zip(reference, predictions)),
+        "surface_type_agreement": statistics.mean(r[2] == p[2] for r, p in zip(reference, predictions)),
+        "quality_mean_diff": statistics.mean(quality_diffs) if quality_diffs else 0.0,
+        "quality_max_diff": max(quality_diffs, default=0.0),
+    }
+
+
+def evaluate(predictions, img_files, labels, quality_classes):
+    """Accuracy of road and surface type and mean absolute error of the quality values w.r.t. the labels."""
+    scores = {"road_type_accuracy": [], "surface_type_accuracy": [], "quality_mae": []}
+    for file, (road, _, surface, _, quality) in zip(img_files, predictions):
+        label = labels.get(file.name, {})
+        if "road_type" in label:
+            scores["road_type_accuracy"].append(road == label["road_type"])
+        if "surface_type" in label:
+            scores["surface_type_accuracy"].append(surface == label["surface_type"])
+        if "surface_quality" in label and quality is not None:
+            value = quality_value(label["surface_quality"], quality_classes)
+            if value is not None:
+                scores["quality_mae"].append(abs(quality - value))
+    return {key: statistics.mean(values) for key, values in scores.items() if values}
+
+
+def quality_class_to_idx(model_interface):
+    """Class names of the quality models and their values."""
+    class_to_idx = {}
+    for model in model_interface.models["surface_quality"].values():
+        _, classes, _ = model_interface.get_model(model)
+        class_to_idx.update(classes)
+    return class_to_idx
+
+
+def validate(args):
+    cg = get_config(args.configfile)
+    img_files = sorted(
+        file for file in Path(args.imgs).iterdir() if file.suffix.lower() in IMG_SUFFIXES
+    )
+    if len(img_files) == 0:
+        raise ValueError(f"No images found in {args.imgs}")
+    labels = read_labels(args.imgs)
+    calibration_imgs = args.calibration_imgs
+    if "int8_static" in args.precisions:
+        # calibrating on the validation images would inflate the agreement and accuracy of int8_static
+        if calibration_imgs is None:
+            raise ValueError("int8_static requires --calibration_imgs, a folder other than --imgs")
+        if Path(calibration_imgs).resolve() == Path(args.imgs).resolve():
+            raise ValueError("--calibration_imgs must not be the folder of the validation images")
+
+    reference, seconds, model_interface = classify(cg, "fp32", img_files, calibration_imgs)
+    quality_classes = quality_class_to_idx(model_interface)
+    reference_scores = evaluate(reference, img_files, labels, quality_classes)
+    report = [
+        {"precision": "fp32", "imgs_per_second": len(img_files) / seconds, **reference_scores}
+    ]
+    for precision in args.precisions:
+        predictions, seconds, _ = classify(cg, precision, img_files, calibration_imgs)
+        agreement = compare(reference, predictions)
+        scores = evaluate(predictions, img_files, labels, quality_classes)
+        report.append(
+            {
+                "precision": precision,
+                "imgs_per_second": len(img_files) / seconds,
+                **agreement,
+                **scores,
+                **{
+                    f"{key}_delta": value - reference_scores[key]
+                    for key, value in scores.items()
+                    if key in reference_scores
+                },
+                "ok": min(agreement["road_type_agreement"], agreement["surface_type_agreement"])
+                >= args.min_agreement
+                and agreement["quality_mean_diff"] <= args.max_quality_diff,
+            }
+        )
+    return report
+
+
+def log_report(report):
+    lines = [
+        f"{'precision':<14} {'imgs/s':>8} {'road agr.':>10} {'surf. agr.':>10} {'q. diff':>8} "
+        f"{'road acc.':>10} {'surf. acc.':>10} {'q. MAE':>8} {'ok':>5}"
+    ]
+    for row in report:
+        lines.append(
+            f"{row['precision']:<14} {row['imgs_per_second']:>8.1f} "
+            f"{row.get('road_type_agreement', 1):>10.1%} {row.get('surface_type_agreement', 1):>10.1%} "
+            f"{row.get('quality_mean_diff', 0):>8.3f} {row.get('road_type_accuracy', float('nan')):>10.1%} "
+            f"{row.get('surface_type_accuracy', float('nan')):>10.1%} {row.get('quality_mae', float('nan')):>8.3f} "
+            f"{str(row.get('ok', True)):>5}"
+        )
+    logging.info("Inference precisions:\n" + "\n".join(lines))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="surfaceAI-validate-precision")
+    parser.add_argument(
+        "-c", "--configfile", help="Name of the configuration file in the configs folder (models, transforms, batch_size). Default: the global config."
+    )
+    parser.add_argument(
+        "--imgs", required=True, help="Folder of validation images, optionally with labels.csv."
+    )
+    parser.add_argument(
+        "--precisions", nargs="+", choices=[p for p in const.INFERENCE_PRECISIONS if p != "fp32"], default=["bf16", "int8_dynamic", "int8_static"], help="Precisions compared with fp32."
+    )
+    parser.add_argument(
+        "--calibration_imgs", help="Folder of calibration images of int8_static (required for it), disjoint from the validation images."
+    )
+    parser.add_argument(
+        "--min_agreement", type=float, default=0.99, help="Minimum share of equal road and surface types."
+    )
+    parser.add_argument(
+        "--max_quality_diff", type=float, default=0.05, help="Maximum mean absolute difference of quality values."
+    )
+    parser.add_argument("--report", help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = validate(args)
+    log_report(report)
+    if args.report is not None:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+    if not all(row.get("ok", True) for row in report):
+        sys.exit(1)
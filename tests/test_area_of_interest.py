@@ -1,8 +1,10 @@
 import os
+import re
 import sys
 from pathlib import Path
 from unittest.mock import MagicMock, call
 
+import mercantile
 import numpy as np
 import pytest
 
@@ -83,11 +85,22 @@ def test_get_and_write_img_metadata(aoi, mocker):
         "lon",
         "lat",
     ]
+    columns = {
+        "img_id": np.array([1, 2, 3, 4], dtype=np.int64),
+        "sequence_id": np.array(["101", "101", "101", "102"], dtype=object),
+        "captured_at": np.array([1234, 1235, 1236, 1237], dtype=np.int64),
+        "compass_angle": np.array([90.0, 90.0, 90.0, 90.0]),
+        "is_pano": np.array([False, False, False, True]),
+        "creator_id": np.array([1, 1, 1, 1], dtype=np.int64),
+        # image 3 is outside of the bounding box, image 4 is panoramic
+        "lon": np.array([10.01, 10.011, 10.03, 10.012]),
+        "lat": np.array([15.01, 15.011, 15.011, 15.012]),
+    }
     output = [
-        ["001", "101", "1234", "90", "False", "00001", "10.01", "15.01"],
-        ["002", "101", "1235", "90", "False", "00001", "10.011", "15.011"],
+        (1, "101", 1234, 90.0, False, 1, 10.01, 15.01),
+        (2, "101", 1235, 90.0, False, 1, 10.011, 15.011),
     ]
-    mock_mi.metadata_in_tile = MagicMock(return_value=(header, output))
+    mock_mi.metadata_columns_in_tile = MagicMock(return_value=columns)
 
     mock_db = MagicMock()
     mock_db.execute_sql_query = MagicMock()
@@ -95,10 +108,10 @@ def test_get_and_write_img_metadata(aoi, mocker):
 
     aoi.get_and_write_img_metadata(mock_mi, mock_db)
 
-    mock_mi.metadata_in_tile.assert_called()
+    mock_mi.metadata_columns_in_tile.assert_called()
     assert mock_db.add_rows_to_table.call_args[0][0] == "test_aoi_img_metadata"
     assert mock_db.add_rows_to_table.call_args[0][1] == header
-    assert np.all(np.array(output) == mock_db.add_rows_to_table.call_args[0][2])
+    assert mock_db.add_rows_to_table.call_args[0][2] == output
     mock_db.add_rows_to_table.assert_called()
     mock_db.execute_sql_query.assert_has_calls(
         [
@@ -108,9 +121,65 @@ def test_get_and_write_img_metadata(aoi, mocker):
     )
 
 
+def test_get_and_write_img_metadata_incremental(aoi):
+    aoi.incremental_metadata = True
+    tiles = list(
+        mercantile.tiles(aoi.minLon, aoi.minLat, aoi.maxLon, aoi.maxLat, const.ZOOM)
+    )
+    mock_mi = MagicMock()
+    mock_mi.metadata_columns_in_tile = MagicMock(
+        return_value={
+            "img_id": np.array([1, 2, 3], dtype=np.int64),
+            "sequence_id": np.array(["101", "101", "102"], dtype=object),
+            "captured_at": np.array([1234, 1235, 1236], dtype=np.int64),
+            "compass_angle": np.array([90.0, 90.0, 90.0]),
+            "is_pano": np.array([False, False, True]),
+            "creator_id": np.array([1, 1, 1], dtype=np.int64),
+            "lon": np.array([10.01, 10.011, 10.012]),
+            "lat": np.array([15.01, 15.011, 15.012]),
+        }
+    )
+    mock_db = MagicMock()
+    # images up to 1234 have been harvested before
+    mock_db.execute_sql_query = MagicMock(
+        return_value=[(*tile, 1234) for tile in tiles]
+    )
+
+    assert aoi.get_and_write_img_metadata(mock_mi, mock_db) == "delta"
+
+    mock_db.execute_sql_query.assert_any_call(
+        const.SQL_CREATE_IMG_METADATA_DELTA_TABLE, aoi.query_params
+    )
+    assert (
+        call(const.SQL_CREATE_IMG_METADATA_TABLE, aoi.query_params)
+        not in mock_db.execute_sql_query.call_args_list
+    )
+    metadata_calls = [
+        c
+        for c in mock_db.add_rows_to_table.call_args_list
+        if c[0][0] == "test_aoi_img_metadata_delta"
+    ]
+    assert [c[0][2] for c in metadata_calls] == [
+        [(2, "101", 1235, 90.0, False, 1, 10.011, 15.011)]
+    ] * len(tiles)
+    table, header, watermarks = mock_db.add_rows_to_table.call_args[0]
+    assert table == "test_aoi_tile_watermarks_delta"
+    assert header == ["x", "y", "z", "captured_at"]
+    assert sorted(watermarks) == sorted((*tile, 1236) for tile in tiles)
+
+
+def test_get_and_write_img_metadata_empty_tile(aoi):
+    mock_mi = MagicMock()
+    mock_mi.metadata_columns_in_tile = MagicMock(return_value=None)
+    mock_db = MagicMock()
+
+    aoi.get_and_write_img_metadata(mock_mi, mock_db)
+    mock_db.add_rows_to_table.assert_not_called()
+
+
 def test_classify_images(aoi):
     mock_mi = MagicMock()
-    mock_mi.query_imgs = MagicMock()
+    mock_mi.query_imgs = MagicMock(return_value=(["001", "002"], ["img1", "img2"]))
     mock_db = MagicMock()
     mock_db.img_ids_from_dbtable = MagicMock(return_value=["001", "002"])
     mock_db.table_exists = MagicMock(return_value=False)
@@ -134,10 +203,18 @@ def test_classify_images(aoi):
         ],
     ]
     value_list = [[img_id] + mo for img_id, mo in zip(["001", "002"], md_output)]
-    mock_md.batch_classifications = MagicMock(return_value=md_output)
+    mock_md.batch_preprocessing = MagicMock(return_value=("road_data", "surface_data"))
+    mock_md.batch_inference = MagicMock(return_value=md_output)
 
     aoi.classify_images(mock_mi, mock_db, mock_md)
     mock_db.img_ids_from_dbtable.assert_called_once()
+    mock_mi.query_imgs.assert_called_once_with(
+        ["001", "002"], "thumb_2048_url", return_ids=True, img_urls=None, decode=False
+    )
+    mock_md.batch_preprocessing.assert_called_once_with(["img1", "img2"])
+    mock_md.batch_inference.assert_called_once_with("road_data", "surface_data")
+    mock_md.release_batch.assert_called_once_with("road_data", "surface_data")
+    assert len(aoi.batch_memory) == 1
     assert mock_db.add_rows_to_table.call_args[0][0] == "test_aoi_img_classifications"
     assert mock_db.add_rows_to_table.call_args[0][1] == [
         "img_id",
@@ -149,9 +226,363 @@ def test_classify_images(aoi):
     ]
     assert np.all(np.array(value_list) == mock_db.add_rows_to_table.call_args[0][2])
     mock_db.add_rows_to_table.assert_called_once()
-    mock_db.execute_sql_query.assert_has_calls(
-        [
-            call(const.SQL_PREP_MODEL_RESULT, aoi.query_params),
-            call(const.SQL_RENAME_ROAD_TYPE_PRED, aoi.query_params),
+    mock_db.execute_sql_query.assert_called_once_with(
+        const.SQL_PREP_MODEL_RESULT, aoi.query_params
+    )
+
+
+def test_classify_images_skips_failed_downloads(aoi):
+    mock_mi = MagicMock()
+    # image 002 could not be downloaded
+    mock_mi.query_imgs = MagicMock(return_value=(["001", "003"], ["img1", "img3"]))
+    mock_db = MagicMock()
+    mock_db.img_ids_from_dbtable = MagicMock(return_value=["001", "002", "003"])
+    mock_db.table_exists = MagicMock(return_value=False)
+    mock_md = MagicMock(batch_size=48)
+    mock_md.batch_inference = MagicMock(
+        return_value=[["road", 0.9, "asphalt", 0.9, 1.0], ["path", 0.8, "sett", 0.7, 3.0]]
+    )
+
+    aoi.classify_images(mock_mi, mock_db, mock_md)
+    value_list = mock_db.add_rows_to_table.call_args[0][2]
+    assert [row[0] for row in value_list] == ["001", "003"]
+    assert value_list[1][1] == "path"
+
+
+class FakeUrlDatabase:
+    """Database holding `{name}_img_urls`, which applies the DROP TABLE statements of executed SQL files."""
+
+    def __init__(self):
+        self.tables = {}
+
+    def execute_sql_query(self, query, params={}, is_file=True, get_response=False):
+        if is_file:
+            with open(query, "r") as file:
+                query = file.read().format(**params)
+            for tables in re.findall(r"DROP TABLE\s+(?:IF EXISTS\s+)?([\w\s,]+?)\s*;", query, re.I):
+                for table in tables.split(","):
+                    self.tables.pop(table.strip(), None)
+            if "CREATE TABLE IF NOT EXISTS test_aoi_img_urls" in query:
+                self.tables.setdefault("test_aoi_img_urls", {})
+            return None
+        size = re.search(r"img_size = '(\w+)'", query).group(1)
+        return [
+            [img_id, url]
+            for (img_id, img_size), url in self.tables["test_aoi_img_urls"].items()
+            if img_size == size
         ]
+
+    def execute_many_sql_query(self, query, value_list, params={}, is_file=True):
+        assert query == const.SQL_PERSIST_IMG_URLS
+        for img_id, img_size, url in value_list:
+            self.tables["test_aoi_img_urls"][(img_id, img_size)] = url
+
+
+def test_resolve_img_urls(aoi):
+    mock_mi = MagicMock()
+    mock_mi.query_img_urls = MagicMock(return_value={"002": "https://IMG_URL/002"})
+    mock_db = MagicMock()
+    # url of image 001 is already persisted
+    mock_db.execute_sql_query = MagicMock(
+        side_effect=[None, [["001", "https://IMG_URL/001"]]]
+    )
+
+    img_urls = aoi.resolve_img_urls(mock_mi, mock_db, ["001", "002"])
+
+    assert img_urls == {"001": "https://IMG_URL/001", "002": "https://IMG_URL/002"}
+    mock_mi.query_img_urls.assert_called_once_with(["002"], "thumb_2048_url")
+    mock_db.execute_sql_query.assert_any_call(
+        const.SQL_CREATE_IMG_URL_TABLE, aoi.query_params
+    )
+    mock_db.execute_many_sql_query.assert_called_once_with(
+        const.SQL_PERSIST_IMG_URLS,
+        [("002", "thumb_2048_url", "https://IMG_URL/002")],
+        aoi.query_params,
+    )
+
+
+def test_resolve_img_urls_survive_rematch(aoi):
+    db = FakeUrlDatabase()
+    mock_mi = MagicMock()
+    mock_mi.query_img_urls = MagicMock(
+        return_value={"001": "https://IMG_URL/001", "002": "https://IMG_URL/002"}
+    )
+    aoi.resolve_img_urls(mock_mi, db, ["001", "002"])
+
+    # image metadata harvested and matched again
+    for sql_file in [
+        const.SQL_CREATE_IMG_METADATA_TABLE,
+        const.SQL_MATCH_IMG_ROADS,
+        const.SQL_RENAME_LOCAL_IMG_MATCHES,
+    ]:
+        db.execute_sql_query(sql_file, aoi.query_params)
+
+    mock_mi.query_img_urls = MagicMock(return_value={"003": "https://IMG_URL/003"})
+    img_urls = aoi.resolve_img_urls(mock_mi, db, ["001", "002", "003"])
+
+    mock_mi.query_img_urls.assert_called_once_with(["003"], "thumb_2048_url")
+    assert img_urls == {
+        "001": "https://IMG_URL/001",
+        "002": "https://IMG_URL/002",
+        "003": "https://IMG_URL/003",
+    }
+
+
+def test_classify_images_persists_reresolved_urls(aoi):
+    aoi.persist_img_urls = True
+
+    def query_imgs(img_ids, img_size, return_ids, img_urls, decode):
+        # the persisted url of image 001 was outdated and resolved again
+        img_urls["001"] = "https://IMG_URL/001_new"
+        return img_ids, [b"img1", b"img2"]
+
+    mock_mi = MagicMock()
+    mock_mi.query_img_urls = MagicMock(return_value={})
+    mock_mi.query_imgs = MagicMock(side_effect=query_imgs)
+    mock_db = MagicMock()
+    mock_db.img_ids_from_dbtable = MagicMock(return_value=["001", "002"])
+    mock_db.table_exists = MagicMock(return_value=False)
+    mock_db.execute_sql_query = MagicMock(
+        side_effect=lambda query, *args, **kwargs: (
+            [["001", "https://IMG_URL/001"], ["002", "https://IMG_URL/002"]]
+            if not isinstance(query, Path)
+            else None
+        )
+    )
+    mock_md = MagicMock(batch_size=48)
+    mock_md.batch_inference = MagicMock(
+        return_value=[["road", 0.9, "asphalt", 0.9, 1.0], ["path", 0.8, "sett", 0.7, 3.0]]
+    )
+
+    aoi.classify_images(mock_mi, mock_db, mock_md)
+
+    mock_mi.query_img_urls.assert_not_called()
+    mock_db.execute_many_sql_query.assert_called_once_with(
+        const.SQL_PERSIST_IMG_URLS,
+        [("001", "thumb_2048_url", "https://IMG_URL/001_new")],
+        aoi.query_params,
+    )
+
+
+def test_aggregate_on_roads(aoi):
+    mock_db = MagicMock()
+
+    aoi.aggregate_on_roads(mock_db)
+
+    assert mock_db.execute_sql_query.call_args_list == [
+        call(str(const.SQL_AGGREGATE_ON_ROADS).format(alg), aoi.query_params)
+        for alg in [1, 2, 3]
+    ]
+
+
+def test_aggregate_on_roads_incremental(aoi):
+    aoi.incremental_aggregation = True
+    mock_db = MagicMock()
+    mock_db.table_exists = MagicMock(return_value=True)
+    mock_db.execute_sql_query = MagicMock(return_value=[[2]])
+
+    aoi.aggregate_on_roads(mock_db)
+
+    dirty_params = {**aoi.query_params, "name": "test_aoi_dirty"}
+    assert [c for c in mock_db.execute_sql_query.call_args_list if not c[1]] == [
+        call(const.SQL_PREPARE_DIRTY_AGGREGATION, aoi.query_params),
+        *[
+            call(str(const.SQL_AGGREGATE_ON_ROADS).format(alg), dirty_params)
+            for alg in [1, 2, 3]
+        ],
+        call(const.SQL_MERGE_DIRTY_AGGREGATION, aoi.query_params),
+        call(const.SQL_DROP_DIRTY_AGGREGATION, aoi.query_params),
+        call(const.SQL_SNAPSHOT_AGGREGATED_IMGS, aoi.query_params),
+    ]
+
+
+def test_aggregate_on_roads_without_dirty_ways(aoi):
+    aoi.incremental_aggregation = True
+    mock_db = MagicMock()
+    mock_db.table_exists = MagicMock(return_value=True)
+    mock_db.execute_sql_query = MagicMock(return_value=[[0]])
+
+    aoi.aggregate_on_roads(mock_db)
+
+    executed = [c[0][0] for c in mock_db.execute_sql_query.call_args_list]
+    assert const.SQL_MERGE_DIRTY_AGGREGATION not in executed
+    assert str(const.SQL_AGGREGATE_ON_ROADS).format(1) not in executed
+    assert const.SQL_DROP_DIRTY_AGGREGATION in executed
+
+
+def test_aggregate_on_roads_full_after_new_roads(aoi):
+    aoi.incremental_aggregation = True
+    mock_db = MagicMock()
+    mock_db.table_exists = MagicMock(return_value=True)
+
+    aoi.aggregate_on_roads(mock_db, full=True)
+
+    assert mock_db.execute_sql_query.call_args_list == [
+        *[
+            call(str(const.SQL_AGGREGATE_ON_ROADS).format(alg), aoi.query_params)
+            for alg in [1, 2, 3]
+        ],
+        call(const.SQL_SNAPSHOT_AGGREGATED_IMGS, aoi.query_params),
+    ]
+
+
+def test_aggregate_on_roads_set_based(aoi):
+    aoi.aggregation_engine = "set_based"
+    mock_db = MagicMock()
+
+    aoi.aggregate_on_roads(mock_db)
+
+    assert mock_db.execute_sql_query.call_args_list == [
+        call(str(const.SQL_AGGREGATE_ON_ROADS_SET_BASED).format(alg), aoi.query_params)
+        for alg in [1, 2, 3]
+    ]
+
+
+def test_invalid_aggregation_engine():
+    with pytest.raises(ValueError):
+        AreaOfInterest(dict(name="test_aoi", aggregation_engine="unknown"))
+
+
+def test_invalid_processing_engine():
+    with pytest.raises(ValueError):
+        AreaOfInterest(dict(name="test_aoi", processing_engine="unknown"))
+    # incremental runs rely on the SQL scripts
+    with pytest.raises(ValueError):
+        AreaOfInterest(
+            dict(name="test_aoi", processing_engine="local", incremental_metadata=True)
+        )
+
+
+def test_aggregate_on_roads_local(aoi, mocker):
+    pytest.importorskip("shapely")
+    from test_local_engine import aggregation_input
+
+    aoi.processing_engine = "local"
+    segments, partitions, imgs, classifications = aggregation_input(aoi.local_engine())
+    aoi._local_network = (segments, partitions)
+    mocker.patch.object(aoi, "_read_columns", side_effect=[imgs, classifications])
+    mock_db = MagicMock()
+
+    aoi.aggregate_on_roads(mock_db)
+
+    assert mock_db.execute_sql_query.call_args_list == [
+        call(const.SQL_CREATE_LOCAL_GROUP_PREDICTIONS_TABLE, aoi.query_params),
+        call(const.SQL_TRANSFORM_LOCAL_GROUP_PREDICTIONS, aoi.query_params),
+    ]
+    table, header, rows = mock_db.add_rows_to_table.call_args[0]
+    assert table == "test_aoi_local_group_predictions"
+    assert header[:4] == ["id", "part_id", "group_num", "type_pred"]
+    assert sorted(row[:4] for row in rows) == [(1, 1, 0, "asphalt"), (2, 1, 0, None)]
+
+
+def test_shard_cells(aoi):
+    aoi.maxLon, aoi.maxLat = 10.2, 15.2
+    aoi.shard_tiles = 4
+    tiles = list(mercantile.tiles(10.01, 15.01, 10.2, 15.2, const.ZOOM))
+
+    cells = aoi.shard_cells()
+
+    # cells of at most 4 x 4 tiles of the global tile grid
+    assert len(cells) == len({(tile.x // 4, tile.y // 4) for tile in tiles})
+    # cell edges are tile edges and each tile lies in exactly one cell
+    for tile in tiles:
+        bounds = mercantile.bounds(tile)
+        assert 1 == sum(
+            west <= bounds.west and bounds.east <= east
+            and south <= bounds.south and bounds.north <= north
+            for west, south, east, north in cells
+        )
+    edges = {bounds.west for bounds in map(mercantile.bounds, tiles)}
+    assert {cell[0] for cell in cells} <= edges
+
+
+def test_create_shards(aoi):
+    aoi.shard_tiles = 1
+    mock_db = MagicMock()
+    n_cells = len(aoi.shard_cells())
+    # tables of a former run with more shards
+    tables = [
+        "test_aoi_segmented_ways",
+        "test_aoi_s0_way_selection",
+        f"test_aoi_s{n_cells}_way_selection",
+        f"test_aoi_s{n_cells}_pipeline_stages",
+    ]
+    # harvest bbox of the first shard exceeds the area of interest, the second shard has no owned ways
+    mock_db.execute_sql_query = MagicMock(
+        side_effect=lambda query, params=None, **kwargs: (
+            [(table,) for table in tables]
+            if "information_schema" in str(query)
+            else [(10.0, 15.012, 10.015, 15.03)]
+            if "_s0_way_selection" in str(query)
+            else [(None, None, None, None)]
+            if "WHERE owned" in str(query)
+            else None
+        )
+    )
+
+    shards = aoi.create_shards(mock_db)
+
+    mock_db.execute_sql_query.assert_any_call(
+        f"DROP TABLE IF EXISTS test_aoi_s{n_cells}_way_selection, test_aoi_s{n_cells}_pipeline_stages;",
+        is_file=False,
     )
+    shard_selections = [
+        c for c in mock_db.execute_sql_query.call_args_list
+        if c[0][0] == const.SQL_SHARD_WAY_SELECTION
+    ]
+    assert len(shard_selections) == n_cells
+    params = shard_selections[0][0][1]
+    assert params["name"] == "test_aoi_s0"
+    assert params["parent"] == "test_aoi"
+    assert (params["cell0"], params["cell1"], params["cell2"], params["cell3"]) == (
+        aoi.shard_cells()[0]
+    )
+    assert len(shards) == 1
+    assert shards[0]["name"] == "test_aoi_s0"
+    assert shards[0]["shard"] is True
+    assert shards[0]["shard_tiles"] is None
+    assert shards[0]["shard_cell"] == list(aoi.shard_cells()[0])
+    assert (
+        shards[0]["minLon"], shards[0]["minLat"], shards[0]["maxLon"], shards[0]["maxLat"]
+    ) == (10.01, 15.012, 10.015, 15.02)
+    assert AreaOfInterest(shards[0]).shard
+
+
+def test_merge_shards(aoi):
+    mock_db = MagicMock()
+
+    aoi.merge_shards(mock_db, ["test_aoi_s0", "test_aoi_s1"])
+
+    queries = [c[0][0] for c in mock_db.execute_sql_query.call_args_list]
+    assert len(queries) == 3
+    assert "CREATE TABLE test_aoi_group_predictions" in queries[0]
+    # only predictions of owned ways
+    assert queries[0].count("WHERE owned") == 2
+    assert "CREATE TABLE test_aoi_img_metadata" in queries[1]
+    assert "FROM test_aoi_s1_img_metadata" in queries[1]
+    assert "CREATE TABLE test_aoi_img_classifications" in queries[2]
+
+
+def test_reuse_classifications(aoi):
+    mock_db = MagicMock()
+    mock_db.table_exists = MagicMock(side_effect=lambda table: table == "other_img_classifications")
+    mock_db.execute_sql_query = MagicMock(return_value=[[3]])
+
+    n_reused = aoi.reuse_classifications(mock_db, ["other", "not_classified"])
+
+    assert n_reused == 3
+    assert mock_db.execute_sql_query.call_args_list[0] == call(
+        const.SQL_PREP_MODEL_RESULT, aoi.query_params
+    )
+    query = mock_db.execute_sql_query.call_args_list[1][0][0]
+    assert "INSERT INTO test_aoi_img_classifications" in query
+    assert "FROM other_img_classifications" in query
+    assert "not_classified" not in query
+
+
+def test_reuse_classifications_without_other_classifications(aoi):
+    mock_db = MagicMock()
+    mock_db.table_exists = MagicMock(return_value=False)
+
+    assert aoi.reuse_classifications(mock_db, ["other"]) == 0
+    mock_db.execute_sql_query.assert_not_called()
@@ -0,0 +1,104 @@
+import os
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.ImageCache import ImageCache
+from src.modules.MapillaryInterface import MapillaryInterface
+
+TEST_IMG = root_dir / "tests" / "test_data" / "1000068877331935.jpg"
+
+
+@pytest.fixture
+def img_content():
+    with open(TEST_IMG, "rb") as f:
+        return f.read()
+
+
+def test_put_and_get(tmp_path, img_content):
+    cache = ImageCache(tmp_path)
+    assert cache.get("1", "thumb_1024_url") is None
+    cache.put("1", "thumb_1024_url", img_content)
+
+    assert cache.get("1", "thumb_1024_url") == img_content
+    assert cache.get("1", "thumb_2048_url") is None
+    assert ("1", "thumb_1024_url") in cache
+    assert cache.stats() == {
+        "hits": 1,
+        "misses": 2,
+        "evictions": 0,
+        "images": 1,
+        "bytes": len(img_content),
+    }
+    # no temporary files are left behind
+    assert [p.suffix for p in tmp_path.rglob("*") if p.is_file()] == [".jpg"]
+
+    # the index is restored from disk
+    assert ImageCache(tmp_path).get("1", "thumb_1024_url") == img_content
+
+
+def test_lru_eviction(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=25)
+    cache.put("1", "thumb_1024_url", b"1" * 10)
+    cache.put("2", "thumb_1024_url", b"2" * 10)
+    cache.get("1", "thumb_1024_url")  # 2 is now least recently used
+    cache.put("3", "thumb_1024_url", b"3" * 10)
+
+    assert ("1", "thumb_1024_url") in cache
+    assert ("2", "thumb_1024_url") not in cache
+    assert ("3", "thumb_1024_url") in cache
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 20
+    assert len(list(tmp_path.rglob("*.jpg"))) == 2
+
+
+def test_query_imgs_uses_cache(tmp_path, img_content, mocker):
+    cache = ImageCache(tmp_path)
+    cache.put("1", "thumb_1024_url", img_content)
+    mapillary_interface = MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN", image_cache=cache
+    )
+    mocker.patch.object(
+        mapillary_interface,
+        "query_img_urls",
+        return_value={"2": "https://IMG_URL/2"},
+    )
+    client_get = mocker.patch.object(
+        mapillary_interface.client,
+        "get",
+        return_value=MagicMock(status_code=200, content=img_content),
+    )
+
+    ids, imgs = mapillary_interface.query_imgs(
+        ["1", "2"], "thumb_1024_url", return_ids=True
+    )
+    assert ids == ["1", "2"]
+    mapillary_interface.query_img_urls.assert_called_once_with(["2"], "thumb_1024_url")
+    assert client_get.call_count == 1
+    # downloaded image was added to the cache
+    assert ("2", "thumb_1024_url") in cache
+    mapillary_interface.close()
+
+
+def test_query_imgs_offline(tmp_path, img_content, mocker):
+    cache = ImageCache(tmp_path)
+    cache.put("1", "thumb_1024_url", img_content)
+    mapillary_interface = MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN", image_cache=cache, offline=True
+    )
+    client_get = mocker.patch.object(mapillary_interface.client, "get")
+
+    ids, imgs = mapillary_interface.query_imgs(
+        ["1", "2"], "thumb_1024_url", return_ids=True
+    )
+    assert ids == ["1"]
+    client_get.assert_not_called()
+
+
+def test_offline_requires_cache():
+    with pytest.raises(ValueError):
+        MapillaryInterface(mapillary_token="MLY|MAPILLARY_TOKEN", offline=True)
@@ -0,0 +1,94 @@
+import json
+import os
+import sys
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.Instrumentation import Instrumentation, _clear_peak_rss, interval_peak_rss
+
+
+@pytest.fixture
+def instrumentation():
+    db = MagicMock()
+    db.table_exists = MagicMock(side_effect=lambda table: table != "test_aoi_missing")
+    db.execute_sql_query = MagicMock(return_value=[[42]])
+    mi = MagicMock()
+    mi.http_stats = MagicMock(
+        side_effect=[{"requests": 3, "bytes": 100}, {"requests": 8, "bytes": 2100}]
+    )
+    return Instrumentation("test_aoi", db, mi)
+
+
+def test_stage_record(instrumentation):
+    assert instrumentation.db.instrumentation is instrumentation
+
+    with instrumentation.stage("matching", ["test_aoi_img_metadata", "test_aoi_missing"]):
+        instrumentation.record_query("match_imgs_to_segments.sql", 1.5)
+    instrumentation.skipped("aggregation")
+    # outside of a stage
+    instrumentation.record_query("SELECT 1;", 0.1)
+
+    record, skipped = instrumentation.stages
+    assert record["stage"] == "matching"
+    assert record["wall_seconds"] >= 0
+    assert record["cpu_seconds"] >= 0
+    assert record["peak_rss_bytes"] > 0
+    assert record["http_requests"] == 5
+    assert record["http_bytes"] == 2000
+    assert record["rows"] == {"test_aoi_img_metadata": 42}
+    assert record["queries"] == [{"query": "match_imgs_to_segments.sql", "seconds": 1.5}]
+    assert skipped == {"stage": "aggregation", "skipped": True}
+
+
+def test_stage_record_on_error(instrumentation):
+    with pytest.raises(ValueError):
+        with instrumentation.stage("segments"):
+            raise ValueError("failed stage")
+
+    assert instrumentation.stages[0]["stage"] == "segments"
+    assert "wall_seconds" in instrumentation.stages[0]
+
+
+def test_interval_peak_rss(instrumentation):
+    if not _clear_peak_rss():
+        pytest.skip("peak RSS cannot be reset")
+    size = 256 * 2**20
+    with instrumentation.stage("classification"):
+        interval_peak_rss()
+        data = np.ones(size, dtype=np.uint8)
+        del data
+        first = interval_peak_rss()
+        second = interval_peak_rss()
+
+    # the peak of the interval is reset, the peak of the stage is kept
+    assert first - second > size / 2
+    assert instrumentation.stages[0]["peak_rss_bytes"] >= first
+
+
+def test_write_reports(instrumentation, tmp_path):
+    with instrumentation.stage("matching", ["test_aoi_img_metadata"]):
+        instrumentation.record_query("match_imgs_to_segments.sql", 1.5, plans=["Seq Scan"])
+    instrumentation.skipped("aggregation")
+
+    instrumentation.write(tmp_path)
+
+    report = json.loads((tmp_path / "test_aoi_run_report.json").read_text())
+    assert report["name"] == "test_aoi"
+    assert [stage["stage"] for stage in report["stages"]] == ["matching", "aggregation"]
+    assert report["stages"][0]["queries"][0]["plans"] == ["Seq Scan"]
+
+    prom = (tmp_path / "test_aoi.prom").read_text().splitlines()
+    assert "# TYPE surfaceai_stage_wall_seconds gauge" in prom
+    assert 'surfaceai_stage_http_requests{aoi="test_aoi",stage="matching"} 5' in prom
+    assert (
+        'surfaceai_stage_table_rows{aoi="test_aoi",stage="matching",table="test_aoi_img_metadata"} 42'
+        in prom
+    )
+    assert 'surfaceai_stage_sql_seconds{aoi="test_aoi",stage="matching"} 1.5' in prom
+    # skipped stages have no metrics
+    assert not any('stage="aggregation"' in line for line in prom)
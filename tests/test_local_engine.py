@@ -0,0 +1,277 @@
+import os
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+shapely = pytest.importorskip("shapely")
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.LocalEngine import (
+    LocalEngine,
+    _object_array,
+    columns_from_rows,
+    rows_from_columns,
+)
+
+
+def objects(values):
+    return _object_array(list(values))
+
+
+@pytest.fixture
+def engine():
+    return LocalEngine(segment_length=20, min_road_length=10, dist_from_road=10)
+
+
+@pytest.fixture
+def ways():
+    # way 1: 100 m along the x axis with sidewalks on both sides and a cycle track on the right,
+    # way 2: 50 m without road type, way 3: shorter than min_road_length
+    return {
+        "id": objects([1, 2, 3]),
+        "road_type": objects(["road", None, "footway"]),
+        "sidewalk": objects(["both", None, None]),
+        "sidewalk_left": objects([None] * 3),
+        "sidewalk_right": objects([None] * 3),
+        "cycleway_left": objects([None] * 3),
+        "cycleway_right": objects(["track", None, None]),
+        "cycleway_both": objects([None] * 3),
+        "geom": objects(
+            [
+                shapely.LineString([(0, 0), (30, 0), (100, 0)]),
+                shapely.LineString([(0, 100), (0, 150)]),
+                shapely.LineString([(0, 200), (5, 200)]),
+            ]
+        ),
+    }
+
+
+def test_segment_ways(engine, ways):
+    segments = engine.segment_ways(ways)
+
+    assert segments["segment_id"].tolist() == [
+        "1_0", "1_1", "1_2", "1_3", "1_4", "2_0", "2_1", "2_2"
+    ]
+    assert segments["segment_number"].tolist() == [0, 1, 2, 3, 4, 0, 1, 2]
+    assert segments["id"].tolist() == [1, 1, 1, 1, 1, 2, 2, 2]
+    # equal lengths of at most segment_length, as ST_LineSubstring in segment_ways.sql
+    np.testing.assert_allclose(
+        shapely.length(segments["geom"]), [20] * 5 + [50 / 3] * 3
+    )
+    # inner vertices of the way are kept
+    assert shapely.get_coordinates(segments["geom"][1]).tolist() == [
+        [20, 0],
+        [30, 0],
+        [40, 0],
+    ]
+    assert shapely.get_coordinates(segments["geom"][-1])[-1].tolist() == [0, 150]
+
+
+def test_separate_road_types_osm(engine, ways):
+    segments = engine.segment_ways(ways)
+
+    partitions = engine.separate_road_types(segments, ways)
+
+    is_way_1 = np.char.startswith(partitions["segment_id"].astype(str), "1_")
+    assert sorted(set(partitions["part_id"][is_way_1].tolist())) == [1, 2, 3, 6]
+    assert set(partitions["part_id"][~is_way_1].tolist()) == {1}
+    assert partitions["road_type"][partitions["part_id"] == 6].tolist() == [
+        "cycleway"
+    ] * 5
+    # right of the way direction (negative offset) for part 2, left for part 3
+    first_of = {
+        part_id: shapely.get_coordinates(
+            partitions["geom"][(partitions["part_id"] == part_id) & is_way_1][0]
+        )
+        for part_id in [2, 3, 6]
+    }
+    assert np.allclose(first_of[2][:, 1], -5)
+    assert np.allclose(first_of[3][:, 1], 5)
+    assert np.allclose(first_of[6][:, 1], -3.5)
+
+
+def test_separate_road_types_custom_network(engine, ways):
+    segments = engine.segment_ways(ways)
+
+    partitions = engine.separate_road_types(segments)
+
+    is_way_2 = np.char.startswith(partitions["segment_id"].astype(str), "2_")
+    assert sorted(set(partitions["part_id"][is_way_2].tolist())) == list(range(1, 8))
+    assert set(partitions["part_id"][~is_way_2].tolist()) == {1}
+    assert partitions["road_type"][is_way_2 & (partitions["part_id"] == 1)].tolist() == [
+        "road"
+    ] * 3
+
+
+def test_match_imgs_to_segments(engine, ways):
+    segments = engine.segment_ways(ways)
+    partitions = engine.separate_road_types(segments, ways)
+    imgs = {
+        "img_id": objects(["a", "b", "c"]),
+        "captured_at": np.array([1, 2, 3]),
+        "geom": shapely.points([(25, 4), (5, 130), (50, 50)]),
+    }
+
+    matched = engine.match_imgs_to_segments(imgs, segments, partitions)
+
+    # image c is too far from any road
+    assert matched["img_id"].tolist() == ["a", "b"]
+    assert matched["captured_at"].tolist() == [1, 2]
+    assert matched["segment_id"].tolist() == ["1_1", "2_1"]
+    assert matched["way_id"].tolist() == [1, 2]
+    np.testing.assert_allclose(matched["dist"], [4, 5])
+    assert matched["num_closeby_ways"].tolist() == [1, 1]
+    assert matched["part_ids"][0].tolist() == [1, 2, 3, 6]
+    np.testing.assert_allclose(matched["part_dists"][0], [4, 9, 1, 7.5])
+    assert matched["part_ids"][1].tolist() == [1]
+
+
+def test_match_imgs_counts_closeby_ways(engine):
+    # two parallel ways 8 m apart
+    ways = {
+        "id": objects([1, 2]),
+        "road_type": objects(["road", "road"]),
+        "geom": objects(
+            [
+                shapely.LineString([(0, 0), (40, 0)]),
+                shapely.LineString([(0, 8), (40, 8)]),
+            ]
+        ),
+    }
+    segments = engine.segment_ways(ways)
+    partitions = engine.separate_road_types(segments)
+    imgs = {
+        "img_id": objects(["a", "b"]),
+        "geom": shapely.points([(10, 3), (10, -5)]),
+    }
+
+    matched = engine.match_imgs_to_segments(imgs, segments, partitions)
+
+    assert matched["segment_id"].tolist() == ["1_0", "1_0"]
+    assert matched["num_closeby_ways"].tolist() == [2, 1]
+
+
+def aggregation_input(engine):
+    # way 1: 60 m road (3 subsegments), way 2: 60 m road with too few images
+    ways = {
+        "id": objects([1, 2]),
+        "road_type": objects(["road", "road"]),
+        "geom": objects(
+            [
+                shapely.LineString([(0, 0), (60, 0)]),
+                shapely.LineString([(0, 100), (60, 100)]),
+            ]
+        ),
+    }
+    segments = engine.segment_ways(ways)
+    partitions = engine.separate_road_types(segments)
+    # (x, y, type_pred, quality_pred, road_type_pred)
+    imgs = [
+        (5, 1, "asphalt", 1.0, "road"),
+        (10, 1, "asphalt", 2.0, "road"),
+        (15, 1, "sett", 4.0, "road"),
+        (25, 1, "asphalt", 1.5, "road"),
+        (30, 1, "asphalt", None, "road"),
+        (35, 1, "asphalt", 1.0, "other"),  # excluded
+        (50, 1, "sett", 3.0, "road"),
+        (10, 101, "asphalt", 1.0, "road"),
+    ]
+    img_ids = objects([str(i) for i in range(len(imgs))])
+    matched = engine.match_imgs_to_segments(
+        {
+            "img_id": img_ids,
+            "captured_at": np.array([1_600_000_000_000 + i * 1000 for i in range(len(imgs))]),
+            "geom": shapely.points([(x, y) for x, y, *_ in imgs]),
+        },
+        segments,
+        partitions,
+    )
+    classifications = {
+        "img_id": img_ids,
+        "road_type_pred": objects([img[4] for img in imgs]),
+        "type_pred": objects([img[2] for img in imgs]),
+        "type_class_prob": np.full(len(imgs), 0.9),
+        "quality_pred": np.array([img[3] for img in imgs], dtype=float),
+    }
+    return segments, partitions, matched, classifications
+
+
+def test_aggregate_on_roads(engine):
+    segments, partitions, imgs, classifications = aggregation_input(engine)
+
+    predictions = engine.aggregate_on_roads(segments, partitions, imgs, classifications)
+
+    rows = {
+        (id, part_id, group_num): i
+        for i, (id, part_id, group_num) in enumerate(
+            zip(predictions["id"], predictions["part_id"], predictions["group_num"])
+        )
+    }
+    assert sorted(rows) == [(1, 1, 0), (2, 1, 0)]
+
+    way_1 = rows[(1, 1, 0)]
+    # subsegment votes: asphalt (2 of 3 images), asphalt (2 of 2), sett (1 of 1)
+    assert predictions["type_pred"][way_1] == "asphalt"
+    assert predictions["segment_vote_count"][way_1] == 2
+    assert predictions["n_rated_segments"][way_1] == 3
+    assert predictions["n_segments"][way_1] == 3
+    assert predictions["n_imgs"][way_1] == 5
+    assert predictions["avg_img_counts"][way_1] == pytest.approx(2.5)
+    assert predictions["avg_rt_share"][way_1] == pytest.approx((2 / 3 + 1) / 2)
+    assert predictions["conf_score"][way_1] == pytest.approx((2 / 3 + 1) / 2 * 2 / 3)
+    # average quality of all selected asphalt images of the group
+    assert predictions["quali_pred"][way_1] == pytest.approx((1.0 + 2.0 + 1.5) / 3)
+    assert predictions["way_length"][way_1] == pytest.approx(60)
+    assert predictions["min_date"][way_1] == datetime.fromtimestamp(
+        1_600_000_000, timezone.utc
+    )
+    assert predictions["max_date"][way_1] == datetime.fromtimestamp(
+        1_600_000_004, timezone.utc
+    )
+    assert predictions["road_type"][way_1] == "road"
+
+    # placeholder without prediction: less than 3 images
+    way_2 = rows[(2, 1, 0)]
+    assert predictions["type_pred"][way_2] is None
+    assert predictions["conf_score"][way_2] is None
+    assert predictions["n_imgs"][way_2] is None
+    assert shapely.length(predictions["geometry"][way_2]) == pytest.approx(60)
+
+
+def test_aggregate_on_roads_with_groups(engine):
+    engine.segments_per_group = 2
+    segments, partitions, imgs, classifications = aggregation_input(engine)
+
+    predictions = engine.aggregate_on_roads(segments, partitions, imgs, classifications)
+
+    groups = list(zip(predictions["id"], predictions["group_num"]))
+    assert sorted(groups) == [(1, 0), (1, 1), (2, 0), (2, 1)]
+    group_0 = groups.index((1, 0))
+    assert predictions["type_pred"][group_0] == "asphalt"
+    np.testing.assert_allclose(shapely.length(predictions["geometry"][group_0]), 40)
+
+
+def test_rows_from_columns_roundtrip():
+    columns = {
+        "segment_id": objects(["1_0", "1_1"]),
+        "part_ids": objects([np.array([1, 2]), np.array([1, 3])]),
+        "geom": shapely.points([(0, 1), (2, 3)]),
+    }
+
+    rows = rows_from_columns(columns, ["segment_id", "part_ids", "geom"], 3035)
+
+    assert rows[0][:2] == ("1_0", "{1,2}")
+    assert shapely.get_srid(shapely.from_wkb(rows[1][2])) == 3035
+
+    # as read from the database: WKB geometries, arrays as lists
+    read = columns_from_rows(
+        [("1_0", [1, 2], shapely.to_wkb(shapely.Point(0, 1)))],
+        {"segment_id": object, "part_ids": "array", "geom": "geometry"},
+    )
+    assert read["segment_id"].tolist() == ["1_0"]
+    assert read["part_ids"][0].tolist() == [1, 2]
+    assert read["geom"][0].equals(shapely.Point(0, 1))
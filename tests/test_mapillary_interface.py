@@ -1,8 +1,13 @@
+import asyncio
+import io
 import os
 import sys
+import threading
 from pathlib import Path
+from unittest.mock import MagicMock
 
 import pytest
+from PIL import Image
 
 root_dir = Path(os.path.abspath(__file__)).parent.parent
 sys.path.append(str(root_dir))
@@ -40,6 +45,211 @@ def aoi():
     )
 
 
+TEST_IMG = root_dir / "tests" / "test_data" / "1000068877331935.jpg"
+
+
+def fake_response(url, params=None, **kwargs):
+    # graph API returns the thumbnail url, which returns the image content
+    if url == "https://graph.mapillary.com/images":
+        size = params["fields"].split(",")[1]
+        return MagicMock(
+            status_code=200,
+            json=MagicMock(
+                return_value={
+                    "data": [
+                        {"id": img_id, size: f"https://IMG_URL/{img_id}"}
+                        for img_id in params["image_ids"].split(",")
+                        if img_id != "500"  # no url available
+                    ]
+                }
+            ),
+        )
+    if url.startswith("https://graph.mapillary.com/"):
+        img_id = url.split("/")[-1]
+        return MagicMock(
+            status_code=200,
+            json=MagicMock(return_value={params["fields"]: f"https://IMG_URL/{img_id}"}),
+        )
+    if url.endswith("/404"):
+        return MagicMock(status_code=404, reason="Not Found")
+    with open(TEST_IMG, "rb") as f:
+        return MagicMock(status_code=200, content=f.read())
+
+
+def test_query_mapillary_reuses_client(mapillary_interface, mocker):
+    requests_get = mocker.patch("requests.get")
+    client_get = mocker.patch.object(
+        mapillary_interface.client, "get", side_effect=fake_response
+    )
+    for _ in range(3):
+        mapillary_interface.query_mapillary("https://IMG_URL/1", {})
+    assert client_get.call_count == 3
+    requests_get.assert_not_called()
+
+
+def test_http_stats(mapillary_interface, mocker):
+    mocker.patch.object(
+        mapillary_interface.client,
+        "get",
+        side_effect=lambda url, **kwargs: MagicMock(status_code=200, content=b"12345"),
+    )
+    for _ in range(3):
+        mapillary_interface.query_mapillary("https://IMG_URL/1", {})
+    assert mapillary_interface.http_stats() == {"requests": 3, "bytes": 15, "retries": 0}
+
+
+def test_query_mapillary_retries_throttled_requests(mocker):
+    mapillary_interface = MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN", retry_backoff=0
+    )
+    responses = [
+        MagicMock(status_code=429, headers={"Retry-After": "0"}),
+        MagicMock(status_code=503, headers={}),
+        MagicMock(status_code=200, content=b"12345"),
+    ]
+    client_get = mocker.patch.object(
+        mapillary_interface.client, "get", side_effect=responses
+    )
+    sleep = mocker.patch("time.sleep")
+
+    response = mapillary_interface.query_mapillary("https://IMG_URL/1", {})
+    assert response.status_code == 200
+    assert client_get.call_count == 3
+    assert sleep.call_count == 2
+    assert mapillary_interface.http_stats()["retries"] == 2
+
+    # retries are limited by max_retries
+    client_get.side_effect = [MagicMock(status_code=500, headers={})] * 2
+    assert mapillary_interface.query_mapillary("https://IMG_URL/1", {}, max_retries=2) is None
+
+
+def test_custom_urls(mocker):
+    mapillary_interface = MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN",
+        tile_url="http://127.0.0.1:8765/maps/vtp/{}/2/{}/{}/{}",
+        graph_url="http://127.0.0.1:8765/{}",
+    )
+    client_get = mocker.patch.object(
+        mapillary_interface.client,
+        "get",
+        side_effect=lambda url, **kwargs: MagicMock(
+            status_code=200, content=b"", json=MagicMock(return_value={"data": []})
+        ),
+    )
+    mapillary_interface.tile_content(MagicMock(x=8738, y=5555, z=14))
+    mapillary_interface.query_img_urls(["1"], "thumb_1024_url")
+
+    requested = [c.args[0] for c in client_get.call_args_list]
+    assert requested == [
+        "http://127.0.0.1:8765/maps/vtp/mly1_public/2/14/8738/5555",
+        "http://127.0.0.1:8765/images",
+    ]
+
+
+def test_query_imgs_threads(mapillary_interface, mocker):
+    mocker.patch.object(mapillary_interface.client, "get", side_effect=fake_response)
+    img_ids = ["1", "2", "404", "3"]
+
+    ids, imgs = mapillary_interface.query_imgs(
+        img_ids, "thumb_1024_url", return_ids=True
+    )
+    assert ids == ["1", "2", "3"]
+    assert all(img.size == (1024, 768) for img in imgs)
+    assert len(mapillary_interface.query_imgs(img_ids, "thumb_1024_url")) == 3
+    mapillary_interface.close()
+
+
+def test_query_imgs_encoded(mapillary_interface, mocker):
+    mocker.patch.object(mapillary_interface.client, "get", side_effect=fake_response)
+
+    ids, contents = mapillary_interface.query_imgs(
+        ["1", "404", "2"], "thumb_1024_url", return_ids=True, decode=False
+    )
+
+    assert ids == ["1", "2"]
+    assert all(isinstance(content, bytes) for content in contents)
+    assert Image.open(io.BytesIO(contents[0])).size == (1024, 768)
+    mapillary_interface.close()
+
+
+def test_query_imgs_async_limits_requests_in_flight():
+    mapillary_interface = MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN",
+        parallel=True,
+        download_mode="async",
+        max_in_flight=3,
+    )
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    class FakeAsyncClient:
+        async def get(self, url, params=None, **kwargs):
+            nonlocal in_flight, max_in_flight
+            with lock:
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            with lock:
+                in_flight -= 1
+            return fake_response(url, params)
+
+        async def aclose(self):
+            pass
+
+    # start the event loop, then replace the http client
+    mapillary_interface._run_async(asyncio.sleep(0))
+    mapillary_interface._async_client = FakeAsyncClient()
+
+    img_ids = [str(i) for i in range(1, 11)] + ["404"]
+    ids, imgs = mapillary_interface.query_imgs(
+        img_ids, "thumb_1024_url", return_ids=True
+    )
+    assert ids == img_ids[:-1]
+    assert len(imgs) == 10
+    assert max_in_flight == 3
+    mapillary_interface.close()
+
+
+def test_query_img_urls_batched(mocker):
+    mapillary_interface = MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN", parallel=True, graph_batch_size=4
+    )
+    client_get = mocker.patch.object(
+        mapillary_interface.client, "get", side_effect=fake_response
+    )
+    img_ids = [str(i) for i in range(1, 10)] + ["500"]
+    img_urls = mapillary_interface.query_img_urls(img_ids, "thumb_1024_url")
+
+    assert client_get.call_count == 3
+    assert img_urls == {img_id: f"https://IMG_URL/{img_id}" for img_id in img_ids[:-1]}
+    mapillary_interface.close()
+
+
+def test_query_imgs_known_urls(mapillary_interface, mocker):
+    client_get = mocker.patch.object(
+        mapillary_interface.client, "get", side_effect=fake_response
+    )
+    img_urls = {"1": "https://IMG_URL/1", "2": "https://IMG_URL/404"}
+
+    ids, imgs = mapillary_interface.query_imgs(
+        ["1", "2", "3"], "thumb_1024_url", return_ids=True, img_urls=img_urls
+    )
+    assert ids == ["1", "2", "3"]
+    requested = [c.args[0] for c in client_get.call_args_list]
+    # one batched url request for image 3, one retry for the outdated url of image 2
+    assert requested.count("https://graph.mapillary.com/images") == 2
+    assert "https://IMG_URL/1" in requested
+    # the url resolved again replaces the outdated one
+    assert img_urls["2"] == "https://IMG_URL/2"
+    mapillary_interface.close()
+
+
+def test_invalid_download_mode():
+    with pytest.raises(ValueError):
+        MapillaryInterface(mapillary_token="MLY|MAPILLARY_TOKEN", download_mode="foo")
+
+
 # def test_download_image(mapillary_interface, mocker):
 #     mock_response = MagicMock(status_code=200, content=b"binary image data 100")
 #     mock_response.json.return_value = {"thumb_2048_url": "https://IMG_URL"}
@@ -1,13 +1,18 @@
+import io
 import os
 import sys
 from pathlib import Path
 
 import pytest
+import torch
 from PIL import Image
+from torch import nn
 
 root_dir = Path(os.path.abspath(__file__)).parent.parent
 sys.path.append(str(root_dir))
-from src.modules.Models import ModelInterface
+from src import constants as const
+from src.modules.InferenceBackend import BackendModel, export_onnx, reduce_precision
+from src.modules.Models import ModelInterface, ModelRegistry
 
 
 @pytest.fixture
@@ -68,3 +73,253 @@ def test_model_predict(model_interface):
 
     output = model_interface.batch_classifications(input_data)
     assert output == expected_output
+
+
+def test_model_registry_loads_once(model_interface, mocker):
+    registry = ModelRegistry()
+    model_interface.registry = registry
+    entry = (mocker.MagicMock(), {"asphalt": 0}, False)
+    load_model = mocker.patch.object(model_interface, "load_model", return_value=entry)
+
+    for _ in range(3):
+        assert model_interface.get_model("v1/surface_type_v1.pt") == entry
+
+    load_model.assert_called_once_with("v1/surface_type_v1.pt")
+    entry[0].eval.assert_called_once()
+    assert registry.stats() == {"loads": 1, "hits": 2, "resident": 1}
+
+
+def test_preload_models(model_interface, mocker):
+    registry = ModelRegistry()
+    model_interface.registry = registry
+    mocker.patch.object(
+        model_interface,
+        "load_model",
+        side_effect=lambda model: (mocker.MagicMock(), {}, False),
+    )
+
+    futures = model_interface.preload_models()
+    for future in futures:
+        future.result()
+
+    assert len(futures) == 7
+    assert registry.stats() == {"loads": 7, "hits": 0, "resident": 7}
+    # already resident models are not scheduled again
+    assert model_interface.preload_models() == []
+
+
+class TinyClassifier(nn.Module):
+    def __init__(self):
+        super().__init__()
+        torch.manual_seed(0)
+        self.features = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(), nn.AdaptiveAvgPool2d(1))
+        self.classifier = nn.Linear(4, 2)
+
+    def forward(self, x):
+        return self.classifier(torch.flatten(self.features(x), 1))
+
+    def get_class_and_value(self, x):
+        x = nn.functional.softmax(x, dim=1)
+        return x.argmax(dim=1).tolist(), x.max(dim=1).values.tolist()
+
+
+def test_invalid_inference_backend():
+    with pytest.raises(ValueError):
+        ModelInterface(
+            dict(
+                transform_surface={},
+                transform_road_type={},
+                inference_backend="tensorrt",
+            )
+        )
+
+
+def test_torchscript_backend(model_interface, mocker):
+    model_interface.registry = ModelRegistry()
+    model_interface.inference_backend = "torchscript"
+    model_interface.transform_surface["resize"] = 32
+    mocker.patch.object(
+        model_interface, "load_model", return_value=(TinyClassifier(), {}, False)
+    )
+
+    model, _, _ = model_interface.get_model("v1/surface_type_v1.pt")
+    data = torch.rand(5, 3, 32, 32)
+
+    assert model.backend == "torchscript"
+    assert model_interface.predict(model, data)[0] == model_interface.predict(
+        TinyClassifier().eval(), data
+    )[0]
+
+
+def test_inference_backend_falls_back_to_eager(model_interface, mocker):
+    model_interface.registry = ModelRegistry()
+    model_interface.inference_backend = "torchscript"
+    model_interface.transform_surface["resize"] = 32
+    eager = TinyClassifier()
+    mocker.patch.object(model_interface, "load_model", return_value=(eager, {}, False))
+    deviating = BackendModel(eager, lambda x: -eager(x), "torchscript")
+    mocker.patch("src.modules.Models.build_backend", return_value=deviating)
+
+    model, _, _ = model_interface.get_model("v1/surface_type_v1.pt")
+
+    assert model is eager
+
+
+def test_onnx_export_per_precision(model_interface, mocker, tmp_path):
+    model_interface.model_root = str(tmp_path)
+    model_interface.inference_backend = "onnx"
+    model_interface.transform_surface["resize"] = 32
+    mocker.patch.object(
+        model_interface, "load_model", side_effect=lambda _: (TinyClassifier(), {}, False)
+    )
+    onnx_export = mocker.patch(
+        "src.modules.InferenceBackend.torch.onnx.export",
+        side_effect=lambda model, example, path, **kwargs: Path(path).touch(),
+    )
+
+    def build_backend(backend, model, example, onnx_path, checkpoint_path):
+        export_onnx(model, example, onnx_path, checkpoint_path)
+        return model
+
+    mocker.patch("src.modules.Models.build_backend", side_effect=build_backend)
+
+    for precision in ["fp32", "bf16", "fp32"]:
+        model_interface.registry = ModelRegistry()
+        model_interface.inference_precision = precision
+        model_interface.get_model("v1/surface_type_v1.pt")
+
+    # switching to bf16 exports again, switching back reuses the fp32 export
+    assert onnx_export.call_count == 2
+    assert sorted(os.listdir(tmp_path / "v1")) == [
+        "surface_type_v1.bf16.onnx",
+        "surface_type_v1.fp32.onnx",
+    ]
+
+
+@pytest.mark.parametrize("precision", ["bf16", "int8_dynamic", "int8_static"])
+def test_reduce_precision(precision):
+    data = torch.rand(8, 3, 32, 32)
+    with torch.no_grad():
+        expected = TinyClassifier().eval()(data)
+
+    model = reduce_precision(
+        precision, TinyClassifier().eval(), data[:2], calibration_batches=[data]
+    )
+    with torch.no_grad():
+        output = model(data)
+
+    assert output.dtype == torch.float32
+    assert torch.allclose(output, expected, atol=0.05)
+    assert model.get_class_and_value(output)[0] == expected.argmax(dim=1).tolist()
+
+
+def test_int8_static_requires_calibration_imgs():
+    with pytest.raises(ValueError):
+        ModelInterface(
+            dict(
+                transform_surface={},
+                transform_road_type={},
+                inference_precision="int8_static",
+            )
+        )
+
+
+def test_calibration_batches(model_interface):
+    model_interface.calibration_imgs = os.path.join(root_dir, "tests", "test_data")
+    model_interface.batch_size = 2
+
+    batches = model_interface._calibration_batches("v1/road_type_v1.pt")
+
+    assert [batch.shape for batch in batches] == [
+        (2, 3, 384, 384),
+        (1, 3, 384, 384),
+    ]
+
+
+def test_decode_once_preprocessing(model_interface):
+    imgs = []
+    for image_id in ["1000068877331935", "458670231871080", "1000140361462393"]:
+        imgs.append(os.path.join(root_dir, "tests", "test_data", f"{image_id}.jpg"))
+
+    expected = model_interface.batch_preprocessing([Image.open(img) for img in imgs])
+    model_interface.preprocessing_engine = "decode_once"
+    output = model_interface.batch_preprocessing([Image.open(img) for img in imgs])
+
+    # no downscaling on decode for thumb_1024 images: same tensors as the torchvision transforms
+    for data, expected_data in zip(output, expected):
+        assert torch.equal(data, expected_data)
+
+
+def test_decode_once_preprocessing_drafts_large_jpegs(model_interface):
+    image_path = os.path.join(root_dir, "tests", "test_data", "1000068877331935.jpg")
+    content = io.BytesIO()
+    Image.open(image_path).resize((4096, 3072)).save(content, "JPEG")
+    img = Image.open(content)
+
+    road_data, surface_data = model_interface.decode_once_preprocessing(
+        [img], [model_interface.transform_road_type, model_interface.transform_surface]
+    )
+
+    # lower half and lower middle half of 384 pixels require 768 x 768 pixels
+    assert img.size == (1024, 768)
+    assert road_data.shape == surface_data.shape == (1, 3, 384, 384)
+
+
+def test_invalid_preprocessing_engine():
+    with pytest.raises(ValueError):
+        ModelInterface(
+            dict(
+                transform_surface={},
+                transform_road_type={},
+                preprocessing_engine="opencv",
+            )
+        )
+
+
+def test_batch_buffers(model_interface, mocker):
+    imgs = []
+    for image_id in ["1000068877331935", "458670231871080", "1000140361462393"]:
+        with open(os.path.join(root_dir, "tests", "test_data", f"{image_id}.jpg"), "rb") as f:
+            imgs.append(f.read())
+    expected = model_interface.batch_preprocessing(imgs)
+    model_interface.batch_buffers = 2
+
+    for engine in ["transforms", "decode_once"]:
+        model_interface.preprocessing_engine = engine
+        output = model_interface.batch_preprocessing(imgs)
+        assert all(torch.equal(data, e) for data, e in zip(output, expected))
+        model_interface.release_batch(*output)
+
+    # both engines reused the same input buffer
+    assert model_interface.buffer_stats()["misses"] == 0
+    assert model_interface.batch_preprocessing(imgs)[0].data_ptr() == output[0].data_ptr()
+
+
+def test_batch_buffers_large_jpeg(model_interface):
+    # large enough to be decoded at a reduced scale by decode_once, not by the transforms engine
+    content = io.BytesIO()
+    Image.effect_noise((2048, 1536), 64).convert("RGB").save(content, format="JPEG")
+    imgs = [content.getvalue()] * 2
+    expected = model_interface.batch_preprocessing(imgs)
+    model_interface.batch_buffers = 1
+
+    output = model_interface.batch_preprocessing(imgs)
+
+    assert all(torch.equal(data, e) for data, e in zip(output, expected))
+
+
+def test_sub_batches(model_interface):
+    model_interface.batch_buffers = 1
+    data = torch.rand(100, 3, 4, 4)
+
+    contiguous = list(model_interface._sub_batches(data, [3, 4, 5]))
+    indices = list(range(0, 100, 3)) + list(range(1, 100, 3))
+    chunks = [chunk.clone() for chunk in model_interface._sub_batches(data, indices)]
+
+    assert contiguous[0].data_ptr() == data[3].data_ptr()
+    assert [len(chunk) for chunk in chunks] == [
+        const.QUALITY_SUB_BATCH_SIZE,
+        len(indices) - const.QUALITY_SUB_BATCH_SIZE,
+    ]
+    assert torch.equal(torch.cat(chunks), data[indices])
+
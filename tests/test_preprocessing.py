@@ -0,0 +1,100 @@
+import io
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.Preprocessing import (
+    BufferPool,
+    PreprocessingPool,
+    decode_crops,
+    draft_size,
+    to_tensor,
+)
+
+TRANSFORMS = [
+    {"resize": 384, "crop": "lower_half", "normalize": ([0.4, 0.4, 0.4], [0.2, 0.2, 0.2])},
+    {"resize": (384, 384), "crop": "lower_middle_half"},
+]
+
+
+@pytest.fixture
+def contents():
+    contents = []
+    for image_id in ["1000068877331935", "458670231871080", "1000140361462393"]:
+        image_path = os.path.join(root_dir, "tests", "test_data", f"{image_id}.jpg")
+        with open(image_path, "rb") as f:
+            contents.append(f.read())
+    return contents
+
+
+def test_draft_size():
+    assert draft_size(["lower_half", "lower_middle_half"], [(384, 384), (384, 384)]) == (768, 768)
+    assert draft_size([None], [(100, 200)]) == (200, 100)
+
+
+def test_decode_crops(contents):
+    outputs = [np.zeros((2, 384, 384, 3), dtype=np.uint8) for _ in range(2)]
+
+    decode_crops(
+        contents[0], ["lower_half", None], [(384, 384), (384, 384)], (768, 768), outputs, 1
+    )
+
+    img = Image.open(io.BytesIO(contents[0]))
+    expected = img.crop((0, 384, 1024, 768)).resize((384, 384), Image.BILINEAR)
+    assert np.array_equal(outputs[0][1], np.asarray(expected))
+    assert np.array_equal(outputs[1][1], np.asarray(img.resize((384, 384), Image.BILINEAR)))
+    assert not outputs[0][0].any()
+
+
+def test_to_tensor():
+    batch = np.full((2, 4, 4, 3), 255, dtype=np.uint8)
+
+    data = to_tensor(batch, ([0.5, 0.5, 0.5], [0.25, 0.25, 0.25]))
+
+    assert data.shape == (2, 3, 4, 4)
+    assert torch.all(data == 2)
+
+
+def test_preprocessing_pool(contents):
+    batches = [np.empty((3, 384, 384, 3), dtype=np.uint8) for _ in TRANSFORMS]
+    crops = [transform["crop"] for transform in TRANSFORMS]
+    for i, content in enumerate(contents):
+        decode_crops(content, crops, [(384, 384)] * 2, (768, 768), batches, i)
+    expected = [
+        to_tensor(batch, transform.get("normalize"))
+        for batch, transform in zip(batches, TRANSFORMS)
+    ]
+
+    pool = PreprocessingPool(2)
+    try:
+        output = pool.preprocess(contents, TRANSFORMS)
+        # shared memory and output buffers are reused by the next batch
+        out = [torch.empty(3, 3, 384, 384) for _ in TRANSFORMS]
+        reused = pool.preprocess(contents[:2], TRANSFORMS, out=[o[:2] for o in out])
+    finally:
+        pool.close()
+
+    assert all(torch.equal(data, e) for data, e in zip(output, expected))
+    assert all(torch.equal(data, e[:2]) for data, e in zip(reused, expected))
+    assert reused[0].data_ptr() == out[0].data_ptr()
+
+
+def test_buffer_pool():
+    pool = BufferPool(1, [(4, 2), (4, 3)])
+
+    first = pool.acquire(3)
+    temporary = pool.acquire(2)
+    pool.release(first)
+    second = pool.acquire(4)
+
+    assert [tuple(t.shape) for t in first] == [(3, 2), (3, 3)]
+    assert second[0].data_ptr() == first[0].data_ptr()
+    assert temporary[0].data_ptr() != first[0].data_ptr()
+    assert pool.stats()["misses"] == 1
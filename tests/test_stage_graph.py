@@ -0,0 +1,160 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.StageGraph import PipelineStage, StageGraph
+
+
+class FakeDatabase:
+    """Keeps the records of `{name}_pipeline_stages` in memory, all other tables exist."""
+
+    def __init__(self, missing_tables=()):
+        self.records = {}
+        self.missing_tables = set(missing_tables)
+
+    def table_exists(self, table):
+        return table not in self.missing_tables
+
+    def execute_sql_query(self, query, params={}, is_file=True, get_response=False):
+        if get_response:
+            return [(stage, *record) for stage, record in self.records.items()]
+        if str(query).startswith("DELETE"):
+            self.records.pop(str(query).split("'")[1], None)
+
+    def add_rows_to_table(self, table, header, rows):
+        for stage, fingerprint, output in rows:
+            self.records[stage] = (fingerprint, output)
+
+
+def run(db, params, calls, force=(), policy="stale", complete=None):
+    graph = StageGraph(db, "test_aoi", force=force)
+    graph.add(
+        PipelineStage(
+            "ways", lambda: calls.append("ways"), params={"bbox": params["bbox"]},
+            outputs=["test_aoi_ways"],
+        )
+    )
+    graph.add(
+        PipelineStage(
+            "imgs", lambda: calls.append("imgs"), outputs=["test_aoi_imgs"],
+            policy=policy, digest=lambda: params["n_imgs"],
+        )
+    )
+    graph.add(
+        PipelineStage(
+            "segments", lambda: calls.append("segments"),
+            params={"segment_length": params["segment_length"]}, upstream=["ways"],
+            outputs=["test_aoi_segments"],
+        )
+    )
+    graph.add(
+        PipelineStage(
+            "aggregation", lambda: calls.append("aggregation"),
+            upstream=["segments", "imgs"], outputs=["test_aoi_predictions"], complete=complete,
+        )
+    )
+    graph.run()
+    return graph
+
+
+@pytest.fixture
+def params():
+    return {"bbox": [1, 2, 3, 4], "segment_length": 20, "n_imgs": 10}
+
+
+def test_rerun_skips_up_to_date_stages(params):
+    db = FakeDatabase()
+    calls = []
+    run(db, params, calls)
+    assert calls == ["ways", "imgs", "segments", "aggregation"]
+
+    calls.clear()
+    graph = run(db, params, calls)
+    assert calls == []
+    assert graph.ran == set()
+
+
+def test_changed_params_invalidate_downstream_stages(params):
+    db = FakeDatabase()
+    run(db, params, [])
+
+    calls = []
+    params["segment_length"] = 30
+    graph = run(db, params, calls)
+
+    assert calls == ["segments", "aggregation"]
+    assert graph.ran == {"segments", "aggregation"}
+
+
+def test_missing_output_reruns_stage(params):
+    db = FakeDatabase()
+    run(db, params, [])
+
+    calls = []
+    db.missing_tables = {"test_aoi_segments"}
+    run(db, params, calls)
+
+    # the rerun produces the same outputs, thus the aggregation stays up to date
+    assert calls == ["segments"]
+
+
+def test_always_run_stage_invalidates_downstream_only_on_changed_digest(params):
+    db = FakeDatabase()
+    run(db, params, [], policy="always")
+
+    calls = []
+    run(db, params, calls, policy="always")
+    assert calls == ["imgs"]
+
+    calls.clear()
+    params["n_imgs"] = 11
+    run(db, params, calls, policy="always")
+    assert calls == ["imgs", "aggregation"]
+
+
+def test_incomplete_stage_resumes(params):
+    db = FakeDatabase()
+    run(db, params, [])
+
+    calls = []
+    run(db, params, calls, complete=lambda: False)
+    assert calls == ["aggregation"]
+
+
+def test_interrupted_stage_runs_again(params):
+    db = FakeDatabase()
+    run(db, params, [])
+
+    graph = StageGraph(db, "test_aoi")
+    graph.add(PipelineStage("ways", lambda: 1 / 0, params={"changed": True}))
+    with pytest.raises(ZeroDivisionError):
+        graph.run()
+    assert "ways" not in db.records
+
+    calls = []
+    run(db, params, calls)
+    assert calls == ["ways"]
+
+
+def test_forced_and_never_run_stages(params):
+    db = FakeDatabase()
+    run(db, params, [])
+
+    calls = []
+    run(db, params, calls, force=["segments"])
+    assert calls == ["segments"]
+
+    calls.clear()
+    params["n_imgs"] = 11
+    run(db, params, calls, policy="never")
+    assert calls == []
+
+
+def test_unknown_upstream_stage():
+    graph = StageGraph(FakeDatabase(), "test_aoi")
+    with pytest.raises(ValueError):
+        graph.add(PipelineStage("segments", lambda: None, upstream=["ways"]))
@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.StagedPipeline import Stage, StagedPipeline
+
+
+def test_pipeline_processes_all_items_in_order():
+    results = []
+    pipeline = StagedPipeline(
+        [
+            Stage("double", lambda x: 2 * x),
+            Stage("skip_odd", lambda x: None if x % 3 == 0 else x),
+            Stage("collect", results.append),
+        ]
+    )
+    pipeline.run(range(10))
+    assert results == [2, 4, 8, 10, 14, 16]
+    assert pipeline.stats() == {"double": 10, "skip_odd": 10, "collect": 6}
+
+
+def test_pipeline_stages_overlap():
+    active = set()
+    overlap = []
+    lock = threading.Lock()
+
+    def slow(name):
+        def func(x):
+            with lock:
+                active.add(name)
+                if len(active) > 1:
+                    overlap.append(x)
+            time.sleep(0.02)
+            with lock:
+                active.discard(name)
+            return x
+
+        return func
+
+    pipeline = StagedPipeline([Stage("a", slow("a")), Stage("b", slow("b"))])
+    pipeline.run(range(5))
+    assert len(overlap) > 0
+
+
+def test_pipeline_multiple_workers():
+    results = []
+    lock = threading.Lock()
+
+    def collect(x):
+        with lock:
+            results.append(x)
+
+    pipeline = StagedPipeline(
+        [Stage("square", lambda x: x * x, workers=3), Stage("collect", collect)]
+    )
+    pipeline.run(range(20))
+    assert sorted(results) == [x * x for x in range(20)]
+    assert pipeline.stats() == {"square": 20, "collect": 20}
+
+
+def test_pipeline_counts_items_of_concurrent_workers():
+    pipeline = StagedPipeline([Stage("identity", lambda x: x, depth=64, workers=8)])
+    pipeline.run(range(5000))
+    assert pipeline.stats() == {"identity": 5000}
+
+
+def test_pipeline_raises_stage_error():
+    def fail(x):
+        if x == 3:
+            raise ValueError("failed")
+        return x
+
+    pipeline = StagedPipeline(
+        [Stage("fail", fail, depth=1), Stage("sink", lambda x: None, depth=1)]
+    )
+    with pytest.raises(ValueError):
+        pipeline.run(range(100))
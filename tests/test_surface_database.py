@@ -0,0 +1,190 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pydriosm")
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.SurfaceDatabase import (
+    SurfaceDatabase,
+    _copy_text_value,
+    _CopyStream,
+    split_sql_statements,
+)
+
+
+@pytest.fixture
+def surface_database(mocker):
+    mocker.patch.object(SurfaceDatabase, "setup_database")
+    return SurfaceDatabase("test_db", "test_user", dbpool_size=2)
+
+
+@pytest.fixture
+def pool(surface_database, mocker):
+    pool = MagicMock()
+    pool.getconn.side_effect = lambda: MagicMock(closed=0)
+    mocker.patch.object(surface_database, "_get_pool", return_value=pool)
+    return pool
+
+
+def test_copy_text_value():
+    assert _copy_text_value(None) == "\\N"
+    assert _copy_text_value(True) == "t"
+    assert _copy_text_value(np.bool_(False)) == "f"
+    assert _copy_text_value(np.int64(42)) == "42"
+    assert _copy_text_value(0.5) == "0.5"
+    assert _copy_text_value("a\tb\nc\\d") == "a\\tb\\nc\\\\d"
+
+
+def test_copy_stream_reads_in_chunks():
+    rows = ((i, f"seq_{i}", i % 2 == 0) for i in range(100))
+    stream = _CopyStream(rows)
+
+    chunks = []
+    while True:
+        chunk = stream.read(64)
+        if chunk == "":
+            break
+        assert len(chunk) <= 64
+        chunks.append(chunk)
+
+    lines = "".join(chunks).splitlines()
+    assert stream.n_rows == 100
+    assert lines[0] == "0\tseq_0\tt"
+    assert lines[99] == "99\tseq_99\tf"
+
+
+def test_add_rows_to_table_copy(surface_database, pool):
+    conn = MagicMock(closed=0)
+    pool.getconn.side_effect = None
+    pool.getconn.return_value = conn
+    cursor = conn.cursor.return_value.__enter__.return_value
+    copied = []
+    cursor.copy_expert.side_effect = lambda query, stream: copied.append(
+        (query, stream.read())
+    )
+
+    surface_database.add_rows_to_table(
+        "test_img_classifications",
+        ["img_id", "type_pred", "quality_pred"],
+        [["1", "asphalt", 1.5], ["2", None, 2.0]],
+    )
+
+    assert copied == [
+        (
+            "COPY test_img_classifications (img_id, type_pred, quality_pred) FROM STDIN",
+            "1\tasphalt\t1.5\n2\t\\N\t2.0\n",
+        )
+    ]
+    conn.commit.assert_called_once()
+    pool.putconn.assert_called_once_with(conn, close=False)
+
+
+def test_add_rows_to_table_insert(surface_database, mocker):
+    execute_many = mocker.patch.object(surface_database, "execute_many_sql_query")
+
+    surface_database.add_rows_to_table(
+        "test_img_urls", ["img_id", "img_url"], [["1", "url_1"]], method="insert"
+    )
+
+    execute_many.assert_called_once_with(
+        "INSERT INTO test_img_urls (img_id, img_url) VALUES (%s, %s);",
+        [("1", "url_1")],
+        is_file=False,
+    )
+
+
+def test_transaction_commits_and_reuses_connection(surface_database, pool):
+    with surface_database.transaction() as conn:
+        surface_database.execute_sql_query("SELECT 1;", is_file=False)
+        with surface_database.transaction() as nested_conn:
+            assert nested_conn is conn
+        conn.commit.assert_not_called()
+
+    pool.getconn.assert_called_once()
+    conn.commit.assert_called_once()
+    pool.putconn.assert_called_once_with(conn, close=False)
+
+
+def test_transaction_rolls_back_on_error(surface_database, pool):
+    with pytest.raises(ValueError):
+        with surface_database.transaction() as conn:
+            raise ValueError("failed statement")
+
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once()
+    pool.putconn.assert_called_once_with(conn, close=False)
+
+
+def test_connections_are_shared_by_threads(surface_database, pool):
+    lock = threading.Lock()
+    borrowed = {"current": 0, "max": 0}
+
+    def getconn():
+        with lock:
+            borrowed["current"] += 1
+            borrowed["max"] = max(borrowed["max"], borrowed["current"])
+        time.sleep(0.01)
+        return MagicMock(closed=0)
+
+    def putconn(conn, close=False):
+        with lock:
+            borrowed["current"] -= 1
+
+    pool.getconn.side_effect = getconn
+    pool.putconn.side_effect = putconn
+
+    def query(_):
+        return surface_database.execute_sql_query(
+            "SELECT 1;", is_file=False, get_response=True
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(query, range(32)))
+
+    # threads wait for a free connection instead of exceeding the pool size
+    assert pool.getconn.call_count == 32
+    assert borrowed == {"current": 0, "max": 2}
+
+
+def test_split_sql_statements():
+    query = """-- comment; with semicolon
+    drop table if exists t;
+    CREATE TABLE t AS SELECT 1; -- trailing comment
+    """
+    assert split_sql_statements(query) == [
+        "drop table if exists t",
+        "CREATE TABLE t AS SELECT 1",
+    ]
+
+
+def test_execute_sql_query_records_explained_plans(surface_database, pool, tmp_path):
+    script = tmp_path / "script.sql"
+    script.write_text(
+        "drop table if exists {name}_t;\nCREATE TABLE {name}_t AS SELECT 1;\nCREATE INDEX i ON {name}_t (x);"
+    )
+    instrumentation = MagicMock(explain_analyze=True)
+    surface_database.instrumentation = instrumentation
+
+    with surface_database.transaction() as conn:
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [("Seq Scan",), ("Execution Time: 1 ms",)]
+        surface_database.execute_sql_query(script, {"name": "aoi"})
+
+    executed = [str(c[0][0].string) for c in cursor.execute.call_args_list]
+    assert executed == [
+        "drop table if exists aoi_t",
+        "EXPLAIN (ANALYZE, BUFFERS) CREATE TABLE aoi_t AS SELECT 1",
+        "CREATE INDEX i ON aoi_t (x)",
+    ]
+    label, seconds, plans = instrumentation.record_query.call_args[0]
+    assert label == "script.sql"
+    assert plans == ["Seq Scan\nExecution Time: 1 ms"]
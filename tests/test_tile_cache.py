@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import mercantile
+import pytest
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src.modules.MapillaryInterface import MapillaryInterface
+from src.modules.TileCache import TileCache
+
+TILE = mercantile.Tile(8738, 5555, 14)
+TILE_FILE = root_dir / "tests" / "test_data" / "test_aoi" / "mly1_public-2-14-8738-5555.pbf"
+
+
+@pytest.fixture
+def tile_content():
+    with open(TILE_FILE, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def mapillary_interface(tmp_path):
+    return MapillaryInterface(
+        mapillary_token="MLY|MAPILLARY_TOKEN", tile_cache=TileCache(tmp_path)
+    )
+
+
+def test_tile_cache_put_and_get(tmp_path, tile_content):
+    cache = TileCache(tmp_path, ttl=60)
+    assert cache.get("mly1_public", TILE) is None
+    cache.put("mly1_public", TILE, tile_content, etag='"abc"')
+
+    cached = cache.get("mly1_public", TILE)
+    assert cached.content == tile_content
+    assert cached.etag == '"abc"'
+    assert cache.is_fresh(cached)
+    cached.fetched_at = time.time() - 61
+    assert not cache.is_fresh(cached)
+
+
+def test_tile_content_miss_then_hit(mapillary_interface, tile_content, mocker):
+    client_get = mocker.patch.object(
+        mapillary_interface.client,
+        "get",
+        return_value=MagicMock(
+            status_code=200, content=tile_content, headers={"ETag": '"abc"'}
+        ),
+    )
+    assert mapillary_interface.tile_content(TILE) == tile_content
+    assert mapillary_interface.tile_content(TILE) == tile_content
+    assert client_get.call_count == 1
+    assert mapillary_interface.tile_cache.stats() == {
+        "hits": 1,
+        "revalidated": 0,
+        "misses": 1,
+    }
+
+
+def test_tile_content_revalidation(mapillary_interface, tile_content, mocker):
+    mapillary_interface.tile_cache.ttl = 0
+    mapillary_interface.tile_cache.put("mly1_public", TILE, tile_content, '"abc"')
+    client_get = mocker.patch.object(
+        mapillary_interface.client,
+        "get",
+        return_value=MagicMock(status_code=304, content=b"", headers={}),
+    )
+    assert mapillary_interface.tile_content(TILE) == tile_content
+    assert client_get.call_args.kwargs["headers"] == {"If-None-Match": '"abc"'}
+    assert mapillary_interface.tile_cache.stats()["revalidated"] == 1
+
+
+def test_metadata_in_tile(mapillary_interface, tile_content, mocker):
+    mocker.patch.object(
+        mapillary_interface.client,
+        "get",
+        return_value=MagicMock(status_code=200, content=tile_content, headers={}),
+    )
+    header, output = mapillary_interface.metadata_in_tile(TILE)
+    assert header[0] == "img_id"
+    assert len(output) > 0
+    assert all(len(row) == len(header) for row in output)
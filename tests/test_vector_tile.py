@@ -0,0 +1,54 @@
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from vt2geojson.tools import vt_bytes_to_geojson
+
+root_dir = Path(os.path.abspath(__file__)).parent.parent
+sys.path.append(str(root_dir))
+from src import constants as const
+from src.modules.VectorTile import decode_point_layer
+
+TILE_FILE = root_dir / "tests" / "test_data" / "test_aoi" / "mly1_public-2-14-8738-5555.pbf"
+
+
+@pytest.fixture
+def tile_content():
+    with open(TILE_FILE, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_decode_point_layer_matches_geojson(tile_content):
+    columns = decode_point_layer(
+        tile_content, 8738, 5555, 14, "image", const.TILE_IMG_PROPERTIES
+    )
+    features = vt_bytes_to_geojson(tile_content, 8738, 5555, 14, layer="image")[
+        "features"
+    ]
+
+    assert len(columns["id"]) == len(features) == 360
+    assert columns["id"].dtype == np.int64
+    assert columns["is_pano"].dtype == bool
+    assert columns["lon"].dtype == np.float64
+    for prop in ["id", "sequence_id", "captured_at", "is_pano", "creator_id"]:
+        assert columns[prop].tolist() == [f["properties"][prop] for f in features]
+    assert np.allclose(
+        columns["compass_angle"], [f["properties"]["compass_angle"] for f in features]
+    )
+    assert np.allclose(columns["lon"], [f["geometry"]["coordinates"][0] for f in features])
+    assert np.allclose(columns["lat"], [f["geometry"]["coordinates"][1] for f in features])
+
+
+def test_decode_missing_layer_and_property(tile_content):
+    columns = decode_point_layer(
+        tile_content, 8738, 5555, 14, "overview", const.TILE_IMG_PROPERTIES
+    )
+    assert all(len(column) == 0 for column in columns.values())
+
+    columns = decode_point_layer(
+        tile_content, 8738, 5555, 14, "image", {"not_a_property": "float64"}
+    )
+    assert np.isnan(columns["not_a_property"]).all()